@@ -0,0 +1,368 @@
+"""
+Offline throughput benchmark of the message pipeline.
+
+A Bot logs in against FakeSession, a local stand-in for the requests session itchat talks
+to WeChat through, and synthetic text, picture, emoji and system messages of templates.User,
+templates.Chatroom and templates.MassivePlatform users are put into Bot.msgList at a fixed
+rate. A message counts as handled once its row is committed.
+
+    python bench.py --messages 20000 --save baseline.json
+    python bench.py --messages 20000 --baseline baseline.json
+"""
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from itchat import content
+from itchat.components.register import templates
+from test import Bot
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MIXES = {"text": 70, "picture": 10, "emoji": 10, "system": 10}
+# result: True if higher is better
+COMPARED = {"throughput": True, "latency.p50": False, "latency.p99": False,
+            "dbBytesPerMsg": False, "peakRssKiB": False}
+
+
+class FakeResponse:
+    def __init__(self, body=b'', data=None):
+        self.status_code = 200
+        self.content = body if data is None else json.dumps(data).encode()
+
+    def json(self):
+        return json.loads(self.content.decode())
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunkSize=1):
+        for i in range(0, len(self.content), chunkSize):
+            yield self.content[i:i + chunkSize]
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    """
+    Answers the requests of itchat locally: contacts from self.contacts, sends succeed,
+    media are mediaSize bytes derived from the message id so reposts hash the same.
+    """
+
+    def __init__(self, contacts, mediaSize=32 * 1024, latency=0.0):
+        self.contacts = contacts
+        self.mediaSize = mediaSize
+        self.latency = latency
+        self.cookies = {}
+        self.sent = 0
+
+    def post(self, url, data=None, headers=None, **kwargs):
+        time.sleep(self.latency)
+        if 'webwxbatchgetcontact' in url:
+            names = [i['UserName'] for i in json.loads(data)['List']]
+            return FakeResponse(data={"BaseResponse": {"Ret": 0, "ErrMsg": ""},
+                                      "ContactList": [self.contacts[i] for i in names if i in self.contacts]})
+        self.sent += 1
+        return FakeResponse(data={"BaseResponse": {"Ret": 0, "ErrMsg": ""}, "MsgID": str(self.sent)})
+
+    def get(self, url, params=None, headers=None, stream=False, timeout=None, **kwargs):
+        time.sleep(self.latency)
+        if 'webwxgetcontact' in url:
+            return FakeResponse(data={"BaseResponse": {"Ret": 0, "ErrMsg": ""}, "Seq": 0,
+                                      "MemberList": list(self.contacts.values())})
+        seed = hashlib.md5(str((params or {}).get('msgid')).encode()).digest()
+        return FakeResponse(seed * (self.mediaSize // len(seed) + 1))
+
+
+class BenchBot(Bot):
+    """
+    A Bot logged in against FakeSession; rows committed by its writer are reported to onSaved.
+    """
+
+    def __init__(self, session, onSaved, **kwargs):
+        super().__init__(**kwargs)
+        self.s = session
+        self.onSaved = onSaved
+        self.loginInfo = {"url": "https://localhost/cgi-bin/mmwebwx-bin", "fileUrl": "https://localhost",
+                          "skey": "@bench", "wxuin": "1", "BaseRequest": {},
+                          "User": templates.User({"UserName": "@bench", "NickName": "bench", "Uin": 1})}
+        self.storageClass.userName = '@bench'
+        self.storageClass.nickName = 'bench'
+
+    def login_callback(self):
+        super().login_callback()
+        callback = self.writer.commitCallback
+
+        def committed(rows):
+            # only the rows the writer committed, not the ones that failed into dead letters
+            now = time.perf_counter()
+            for sql, args, msg in rows:
+                if msg is not None:
+                    self.onSaved(msg, now)
+            if callback:
+                callback(rows)
+        self.writer.commitCallback = committed
+
+
+class Generator:
+    """
+    Synthetic messages of `friends` users, `groups` chatrooms and `mps` public accounts.
+    """
+
+    def __init__(self, friends=50, groups=20, mps=5, mix=None, seed=0):
+        self.random = random.Random(seed)
+        self.users = [templates.User({"UserName": "@f{}".format(i), "NickName": "friend{}".format(i),
+                                      "RemarkName": ""}) for i in range(friends)]
+        self.users += [templates.Chatroom({"UserName": "@@g{}".format(i), "NickName": "group{}".format(i),
+                                           "MemberList": []}) for i in range(groups)]
+        self.users += [templates.MassivePlatform({"UserName": "@m{}".format(i), "NickName": "mp{}".format(i)})
+                       for i in range(mps)]
+        mix = mix or MIXES
+        self.kinds = list(mix)
+        self.weights = [mix[i] for i in self.kinds]
+        self.msgId = 0
+
+    def contacts(self):
+        """
+        :return: {UserName: contact} as webwxbatchgetcontact returns them
+        """
+        contacts = {i["UserName"]: dict(i, VerifyFlag=24 if isinstance(i, templates.MassivePlatform) else 0, Sex=0)
+                    for i in self.users}
+        contacts['@bench'] = {"UserName": "@bench", "NickName": "bench", "RemarkName": "", "Uin": 1, "VerifyFlag": 0,
+                              "Sex": 0}
+        contacts['filehelper'] = {"UserName": "filehelper", "NickName": "filehelper", "RemarkName": "",
+                                  "VerifyFlag": 0, "Sex": 0}
+        return contacts
+
+    def message(self):
+        """
+        :return: dict of a message as produce_msg makes it, msgList.put turns it into a Message
+        """
+        self.msgId += 1
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        user = self.random.choice(self.users)
+        msg = {"MsgId": str(self.msgId), "NewMsgId": str(self.msgId), "CreateTime": int(time.time()),
+               "User": user, "FromUserName": user["UserName"], "ToUserName": "@bench"}
+        if kind == "text":
+            text = ' '.join(self.random.choice(('hello', 'world', '你好', '天气', 'ok', 'bench'))
+                            for _ in range(self.random.randint(1, 20)))
+            msg.update(Type=content.TEXT, MsgType=1, Content=text, Text=text)
+        elif kind == "picture":
+            msg.update(Type=content.PICTURE, MsgType=3, Content='', FileName='{}.png'.format(self.msgId))
+        elif kind == "emoji":
+            # a small set of stickers, so most of them are reposts
+            md5 = hashlib.md5(str(self.random.randint(0, 20)).encode()).hexdigest()
+            msg.update(Type=content.PICTURE, MsgType=47, HasProductId=0, FileName='{}.gif'.format(self.msgId),
+                       Content='<msg><emoji md5="{}" len="1024"/></msg>'.format(md5), NewMsgId=md5)
+        else:
+            user = self.random.choice([i for i in self.users if not isinstance(i, templates.User)] or self.users)
+            msg.update(Type=content.SYSTEM, MsgType=51, Content='', Text=[], SystemInfo='uins',
+                       User=user, FromUserName=user["UserName"])
+        if isinstance(msg["User"], templates.Chatroom) and kind != "system":
+            msg.update(ActualUserName='@member{}'.format(self.random.randint(0, 99)),
+                       ActualNickName='member{}'.format(self.random.randint(0, 99)), IsAt=False)
+        return msg
+
+
+def size(pattern):
+    return sum(os.path.getsize(i) for i in glob.glob(pattern, recursive=True) if os.path.isfile(i))
+
+
+def peak_rss():
+    """
+    :return: peak resident set size of this process in KiB, None where unknown
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def percentile(values, q):
+    return values[min(int(q * len(values)), len(values) - 1)] if values else None
+
+
+def run(messages=20000, rate=0, friends=50, groups=20, mps=5, mix=None, mediaSize=32 * 1024,
+        latency=0.0, reply=False, useAsyncio=False, setting=None, timeout=600, keep=False):
+    """
+    :param messages: messages to feed
+    :param rate: messages per second, 0 is as fast as msgList takes them
+    :param mix: {"text": weight, "picture": weight, "emoji": weight, "system": weight}
+    :param mediaSize: bytes of each fake picture
+    :param latency: seconds FakeSession waits on each request
+    :param reply: echo text messages so reply functions and send are exercised
+    :param useAsyncio: Bot.run(useAsyncio=True)
+    :param setting: Bot setting overrides, like {"database": {...}}
+    :param timeout: seconds to wait for the rows to be committed
+    :param keep: keep the work directory
+    :return: dict of results
+    """
+    generator = Generator(friends, groups, mps, mix)
+    session = FakeSession(generator.contacts(), mediaSize, latency)
+    workDir = tempfile.mkdtemp(prefix='wechathelper-bench-')
+    started, latencies = {}, []  # MsgId: time put in msgList, seconds until committed
+    finished = threading.Event()
+
+    def done(msg, now):
+        start = started.pop(msg.get('MsgId'), None)
+        if start is not None:
+            latencies.append(now - start)
+            if len(latencies) == messages:
+                finished.set()
+
+    setting = dict({"metrics": {"enabled": True, "window": 60, "port": None}}, **(setting or {}))
+    bot = BenchBot(session, done, dir={"workDir": workDir}, **setting)
+    try:
+        if reply:
+            @bot.msg_register(content.TEXT, isFriendChat=True, isGroupChat=True, isMpChat=True)
+            def echo(msg):
+                return msg.text
+        bot.login_callback()
+        bot.memberList.extend(i for i in generator.users if isinstance(i, templates.User))
+        bot.chatroomList.extend(i for i in generator.users if isinstance(i, templates.Chatroom))
+        bot.mpList.extend(i for i in generator.users if isinstance(i, templates.MassivePlatform))
+        bot.writer.flush()
+        dbFiles = os.path.join(os.path.abspath(bot.setting["dir"]["dataDir"]), '*.db*')
+        mediaFiles = os.path.join(os.path.abspath(bot.setting["dir"]["mediaDir"]), '**')
+        sizeBefore = size(dbFiles)
+        bot.alive = True
+        bot.run(blockThread=False, useAsyncio=useAsyncio)
+        begin = time.perf_counter()
+        for i in range(messages):
+            if rate:
+                delay = begin + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            msg = generator.message()
+            started[msg['MsgId']] = time.perf_counter()
+            bot.msgList.put(msg)
+        if not finished.wait(timeout):
+            logging.warning('{} of {} messages were not saved in {}s'.format(len(started), messages, timeout))
+        elapsed = time.perf_counter() - begin
+        bot.writer.flush()
+        if bot.mediaStore:
+            bot.mediaStore.close()
+        bot.writer.flush()
+        bot.writer.submit(lambda db: db.execute('PRAGMA wal_checkpoint(TRUNCATE)')).result()
+        stats = bot.stats()
+        latencies.sort()
+        growth = size(dbFiles) - sizeBefore
+        result = {
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "python": sys.version.split()[0],
+            "sqlite": sqlite3.sqlite_version,
+            "options": {"messages": messages, "rate": rate, "friends": friends, "groups": groups, "mps": mps,
+                        "mix": mix or MIXES, "mediaSize": mediaSize, "latency": latency, "reply": reply,
+                        "useAsyncio": useAsyncio, "setting": setting},
+            "saved": len(latencies),
+            "seconds": elapsed,
+            "throughput": len(latencies) / elapsed if elapsed else 0.0,
+            "latency": {"p50": percentile(latencies, 0.5), "p99": percentile(latencies, 0.99),
+                        "max": latencies[-1] if latencies else None},
+            "dbBytes": growth,
+            "dbBytesPerMsg": growth / len(latencies) if latencies else None,
+            "mediaBytes": size(mediaFiles),
+            "peakRssKiB": peak_rss(),
+            "stages": {name: {"p50": i["p50"], "p99": i["p99"], "count": i["count"]}
+                       for name, i in stats.get("stages", {}).items()},
+        }
+        return result
+    finally:
+        bot.alive = False
+        if bot.db is not None:
+            bot.exit_callback()
+        if keep:
+            logging.info('Work directory kept in {}'.format(workDir))
+        else:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+
+def _get(result, key):
+    for i in key.split('.'):
+        result = result.get(i) if isinstance(result, dict) else None
+    return result
+
+
+def compare(result, baseline, tolerance=0.1):
+    """
+    :return: lines describing each compared result, names of the ones worse than tolerance
+    """
+    lines, regressions = [], []
+    for key, higher in COMPARED.items():
+        new, old = _get(result, key), _get(baseline, key)
+        if not new or not old:
+            continue
+        change = (new - old) / old
+        worse = change < -tolerance if higher else change > tolerance
+        if worse:
+            regressions.append(key)
+        lines.append('{:<16} {:>14.6g} {:>14.6g} {:>+8.1%}{}'.format(key, old, new, change,
+                                                                      '  REGRESSION' if worse else ''))
+    return lines, regressions
+
+
+def report(result):
+    lines = ['messages         {saved} in {seconds:.2f}s'.format(**result),
+             'throughput       {:.1f} msg/s'.format(result["throughput"]),
+             'latency          p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(
+                 *((result["latency"][i] or 0) * 1000 for i in ("p50", "p99", "max"))),
+             'database growth  {} bytes, {:.1f} bytes/msg'.format(result["dbBytes"], result["dbBytesPerMsg"] or 0),
+             'media stored     {} bytes'.format(result["mediaBytes"]),
+             'peak RSS         {} KiB'.format(result["peakRssKiB"])]
+    for name, stage in result["stages"].items():
+        lines.append('stage {:<10} p50 {:.3f} ms, p99 {:.3f} ms, {} samples'.format(
+            name, stage["p50"] * 1000, stage["p99"] * 1000, stage["count"]))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline throughput benchmark of wechathelper')
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--rate', type=float, default=0, help='messages per second, 0 is unthrottled')
+    parser.add_argument('--friends', type=int, default=50)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--mps', type=int, default=5)
+    parser.add_argument('--mix', default=','.join('{}={}'.format(*i) for i in MIXES.items()),
+                        help='weights of text, picture, emoji and system messages')
+    parser.add_argument('--media-size', type=int, default=32 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds of each fake network request')
+    parser.add_argument('--reply', action='store_true', help='echo text messages')
+    parser.add_argument('--asyncio', action='store_true', help='run the asyncio reply loop')
+    parser.add_argument('--setting', type=json.loads, default=None, help='JSON of Bot setting overrides')
+    parser.add_argument('--save', help='write the result to this JSON file')
+    parser.add_argument('--baseline', help='compare with the result saved in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change counted as regression')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory')
+    parser.add_argument('--log-level', default='WARNING')
+    options = parser.parse_args()
+    logging.basicConfig(level=options.log_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logging.getLogger('itchat').setLevel(options.log_level)
+    save = options.save and os.path.abspath(options.save)
+    baseline = options.baseline and os.path.abspath(options.baseline)
+    _result = run(options.messages, options.rate, options.friends, options.groups, options.mps,
+                  {k: float(v) for k, v in (i.split('=') for i in options.mix.split(','))},
+                  options.media_size, options.latency, options.reply, options.asyncio, options.setting,
+                  keep=options.keep)
+    print(report(_result))
+    if save:
+        with open(save, 'w', encoding='utf-8') as f:
+            json.dump(_result, f, indent=2, ensure_ascii=False)
+    if baseline:
+        with open(baseline, encoding='utf-8') as f:
+            _lines, _regressions = compare(_result, json.load(f), options.tolerance)
+        print('\n{:<16} {:>14} {:>14} {:>8}'.format('', 'baseline', 'result', 'change'))
+        print('\n'.join(_lines))
+        if _regressions:
+            sys.exit(1)
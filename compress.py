@@ -0,0 +1,127 @@
+"""
+Compression of large Content and Comments values: raw deflate with a preset dictionary of
+the XML WeChat sends for emoji, favorites and shared articles. A compressed value is a BLOB
+starting with MARKER, anything else is stored as it was, so old rows read unchanged.
+Readers go through unpack(), registered as an SQL function by register().
+"""
+import time
+import zlib
+from logging import getLogger
+logger = getLogger('sql')
+
+# columns of the message tables whose values are compressed
+PACKED_COLUMNS = ("Content", "Comments")
+# first byte of a value compressed with DICTIONARY; the dictionary must never change once
+# values were stored with it, a new one needs a new marker
+MARKER = b'\x01'
+
+_EMOJI = ('<msg><emoji fromusername = "" tousername = "" type="2" idbuffer="media:0_0" md5="" len = "" '
+          'productid="" androidmd5="" androidlen="" s60v3md5 = "" s60v3len="" s60v5md5 = "" s60v5len="" '
+          'cdnurl = "http://emoji.qpic.cn/wx_emoji//" designerid = "" thumburl = "" '
+          'encrypturl = "http://emoji.qpic.cn/wx_emoji//" aeskey= "" '
+          'externurl = "http://emoji.qpic.cn/wx_emoji//" externmd5 = "" width= "240" height= "240" tpurl= "" '
+          'tpauthkey= "" attachedtext= "" attachedtextcolor= "" lensid= "" emojiattr= "" linkid= "" desc= "" >'
+          '</emoji> <gameext type="0" content="0" ></gameext></msg>')
+_APPMSG = ('<?xml version="1.0"?>\n<msg>\n\t<appmsg appid="" sdkver="0">\n\t\t<title></title>\n\t\t<des></des>\n'
+           '\t\t<action />\n\t\t<type>5</type>\n\t\t<showtype>0</showtype>\n\t\t<soundtype>0</soundtype>\n'
+           '\t\t<mediatagname />\n\t\t<messageext />\n\t\t<messageaction />\n\t\t<content />\n'
+           '\t\t<contentattr>0</contentattr>\n'
+           '\t\t<url>http://mp.weixin.qq.com/s?__biz=&amp;mid=&amp;idx=1&amp;sn=&amp;chksm=&amp;scene=21#rd</url>\n'
+           '\t\t<lowurl />\n\t\t<dataurl />\n\t\t<lowdataurl />\n\t\t<appattach>\n\t\t\t<totallen>0</totallen>\n'
+           '\t\t\t<attachid />\n\t\t\t<emoticonmd5 />\n\t\t\t<fileext />\n\t\t\t<cdnthumburl></cdnthumburl>\n'
+           '\t\t\t<cdnthumbmd5></cdnthumbmd5>\n\t\t\t<cdnthumblength></cdnthumblength>\n'
+           '\t\t\t<cdnthumbwidth></cdnthumbwidth>\n\t\t\t<cdnthumbheight></cdnthumbheight>\n'
+           '\t\t\t<cdnthumbaeskey></cdnthumbaeskey>\n\t\t\t<aeskey></aeskey>\n\t\t\t<encryver>0</encryver>\n'
+           '\t\t</appattach>\n\t\t<extinfo />\n\t\t<sourceusername>gh_</sourceusername>\n'
+           '\t\t<sourcedisplayname></sourcedisplayname>\n'
+           '\t\t<thumburl>http://mmbiz.qpic.cn/mmbiz_jpg//640?wx_fmt=jpeg</thumburl>\n\t\t<md5 />\n'
+           '\t\t<statextstr />\n\t\t<mmreadershare>\n\t\t\t<itemshowtype>0</itemshowtype>\n'
+           '\t\t</mmreadershare>\n\t</appmsg>\n\t<fromusername></fromusername>\n\t<scene>0</scene>\n'
+           '\t<appinfo>\n\t\t<version>1</version>\n\t\t<appname></appname>\n\t</appinfo>\n'
+           '\t<commenturl></commenturl>\n</msg>')
+
+
+def _escaped(xml):
+    # the web client gets the XML html-escaped, with <br/> for line breaks
+    return xml.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\n', '<br/>')
+
+
+# zlib matches the end of a dictionary at the shortest distances, so the most common text comes last
+DICTIONARY = ''.join((_escaped(_APPMSG), _escaped(_EMOJI), _APPMSG, _EMOJI)).encode('utf-8')
+
+
+def pack(value, minSize=256, level=6):
+    """
+    :param value: a column value, only a str of at least minSize characters is compressed
+    :return: MARKER + the compressed utf-8, or value when that would not be smaller
+    """
+    if not isinstance(value, str) or len(value) < minSize:
+        return value
+    data = value.encode('utf-8')
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=DICTIONARY)
+    packed = MARKER + compressor.compress(data) + compressor.flush()
+    return packed if len(packed) < len(data) else value
+
+
+def unpack(value):
+    """
+    :return: the text of a value made by pack(), any other value as it is
+    """
+    if isinstance(value, bytes) and value[:1] == MARKER:
+        decompressor = zlib.decompressobj(-15, zdict=DICTIONARY)
+        return (decompressor.decompress(value[1:]) + decompressor.flush()).decode('utf-8')
+    return value
+
+
+def register(db):
+    """
+    Make unpack(value) available to the SQL of db; the full-text index reads through it.
+    """
+    db.create_function('unpack', 1, unpack, deterministic=True)
+
+
+def recompress(db, table, columns=PACKED_COLUMNS, batchSize=1000, minSize=256, level=6, decompress=False):
+    """
+    Compress the values of columns stored before compression was enabled, or with decompress
+    store them as text again, batchSize rows per transaction so the writer is never held long.
+    :param db: a connection of the database, register() is called on it
+    :return: (rows changed, bytes before, bytes after)
+    """
+    register(db)
+    trigger = db.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?",
+                         (table + 'Fts_au',)).fetchone()
+    select = "SELECT rowid, {} FROM {} WHERE rowid > ? ORDER BY rowid LIMIT ?".format(', '.join(columns), table)
+    update = "UPDATE {} SET {} WHERE rowid = ?".format(table, ', '.join('{} = ?'.format(i) for i in columns))
+    changed, before, after, last = 0, 0, 0, 0
+    start = time.time()
+    while True:
+        rows = db.execute(select, (last, batchSize)).fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+        updates = []
+        for row in rows:
+            old = row[1:]
+            new = tuple(unpack(i) if decompress else pack(unpack(i), minSize, level) for i in old)
+            if new != old:
+                updates.append(new + (row[0],))
+                before += sum(_size(i) for i in old)
+                after += sum(_size(i) for i in new)
+        if updates:
+            with db:
+                # the text is unchanged, so is the full-text index
+                if trigger:
+                    db.execute('DROP TRIGGER {}Fts_au'.format(table))
+                db.executemany(update, updates)
+                if trigger:
+                    db.execute(trigger[0])
+            changed += len(updates)
+    logger.info('{} {} rows of {} in {:.1f} seconds, {} bytes to {}'.format(
+        'Decompress' if decompress else 'Compress', changed, table, time.time() - start, before, after))
+    return changed, before, after
+
+
+def _size(value):
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    return len(value) if isinstance(value, bytes) else 0
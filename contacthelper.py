@@ -0,0 +1,370 @@
+import json
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from logging import getLogger
+from sqlhelper import MAX_VARIABLES, sqlitehelper
+logger = getLogger('itchat')
+
+# table: (key column, synced columns); History holds the previous values of changed columns
+CONTACT_TABLES = {
+    "Friends": ("UserId", ("NickName", "RemarkName", "Province", "City", "Sex", "StarFriend",
+                           "AttrStatus", "SnsFlag", "ContactFlag", "HeadImgUrl")),
+    "Groups": ("GroupId", ("EncryChatRoomId", "NickName", "IsOwner", "ContactFlag", "MemberCount", "HeadImgUrl",
+                           "MemberList")),
+    "Mps": ("NickName", ("NickName", "Province", "City", "SnsFlag", "ContactFlag", "HeadImgUrl")),
+}
+# changes of these columns are stored but not appended to History
+NO_HISTORY = ("MemberList", "EncryChatRoomId")
+SESSION_PARAMS = re.compile(r'&?(username|skey|chatroomid)=[^&]*')
+SELECT_MEMBER = sqlitehelper.select("GroupMembers", "MemberId", ("ChatRoom", "Name"))
+INSERT_MEMBER = sqlitehelper.upsert("GroupMembers", ("MemberId", "ChatRoom", "Name", "FirstSeen"), ("ChatRoom", "Name"), ())
+
+
+def upsert(table, key, columns):
+    """
+    :return: sql inserting a row or updating every column but key when key exists
+    """
+    return sqlitehelper.upsert(table, _columns(key, columns), key)
+
+
+def _columns(key, columns):
+    return (key,) + tuple(i for i in columns if i != key) + ("History",)
+
+
+def upgrade_groups(db):
+    """
+    Number the rows of a Groups table keyed by NickName, as made before groups of the same
+    name were told apart; the unique index on NickName is dropped.
+    """
+    columns = [row[1] for row in db.execute("PRAGMA table_info(Groups)")]
+    if not columns or "GroupId" in columns:
+        return
+    with db:
+        db.execute("DROP INDEX IF EXISTS Groups_NickName")
+        db.execute("ALTER TABLE Groups ADD COLUMN GroupId INT(4)")
+        db.execute("ALTER TABLE Groups ADD COLUMN EncryChatRoomId VARCHAR")
+        db.execute("UPDATE Groups SET GroupId = rowid")
+        db.execute(sqlitehelper.create_index("Groups", "GroupId", unique=True))
+    logger.info('Numbered the rows of Groups')
+
+
+class ContactSync:
+    """
+    Keeps Friends, Groups and Mps in step with the contact lists of itchat.
+    The stored snapshot is read once and then kept in memory; each sync diffs the current
+    contacts against it and writes only new and changed rows, as many per statement as
+    SQLite binds. Friends and groups are numbered, as neither names nor user names identify
+    them for good; a group is found again by its user name within the session, then by
+    EncryChatRoomId, then by name.
+    """
+
+    def __init__(self, core, writer, readers, historySize=50, delay=5):
+        """
+        :param core: the logged in itchat Core
+        :param writer: dbhelper.BatchWriter
+        :param readers: dbhelper.ReadPool
+        :param historySize: changes kept in the History column of each contact
+        :param delay: seconds schedule() waits so a burst of contact events makes one sync
+        """
+        self.core = core
+        self.writer = writer
+        self.readers = readers
+        self.historySize = historySize
+        self.delay = delay
+        self.snapshot = None
+        self.groupIds = {}  # UserName of the session: GroupId
+        self.lock = threading.Lock()
+        self.timer = None
+        self.metrics = {"syncs": 0, "inserted": 0, "updated": 0}
+
+    def schedule(self):
+        """
+        Sync in delay seconds unless a sync is already scheduled.
+        """
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self._scheduled)
+                self.timer.setDaemon(True)
+                self.timer.start()
+
+    def cancel(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+    def _scheduled(self):
+        with self.lock:
+            self.timer = None
+        try:
+            self.sync()
+        except Exception:
+            logger.exception('Contact sync failed')
+
+    def sync(self):
+        """
+        :return: {table: (inserted, updated)}
+        """
+        with self.core.storageClass.updateLock:
+            contacts = {"Friends": [dict(i) for i in self.core.memberList],
+                        "Groups": [dict(i) for i in self.core.chatroomList],
+                        "Mps": [dict(i) for i in self.core.mpList]}
+        if self.snapshot is None:
+            self.snapshot = {table: self._load(table) for table in CONTACT_TABLES}
+        now = round(time.time())
+        rows, result = {}, {}
+        for table, (key, columns) in CONTACT_TABLES.items():
+            rows[table], result[table] = self._diff(table, contacts[table], now)
+        if any(rows.values()):
+            self.writer.submit(lambda db: self._write(db, rows)).result()
+        self.metrics["syncs"] += 1
+        for inserted, updated in result.values():
+            self.metrics["inserted"] += inserted
+            self.metrics["updated"] += updated
+        logger.info('Contact sync: {}'.format(
+            ', '.join('{} +{} ~{}'.format(table, *i) for table, i in result.items())))
+        return result
+
+    def _load(self, table):
+        key, columns = CONTACT_TABLES[table]
+        return {row[key]: dict(row) for row in self.readers.fetchall(sqlitehelper.select(table))}
+
+    def _diff(self, table, contacts, now):
+        key, columns = CONTACT_TABLES[table]
+        snapshot = self.snapshot[table]
+        if table == "Friends":
+            byName = {}
+            for row in snapshot.values():
+                byName.setdefault(row["RemarkName"] or row["NickName"], row)
+                byName.setdefault(row["NickName"], row)
+            nextId = max(snapshot, default=0) + 1
+        elif table == "Groups":
+            byName, byEncry = {}, {}
+            for row in snapshot.values():
+                byName.setdefault(row["NickName"], []).append(row)
+                if row["EncryChatRoomId"]:
+                    byEncry[row["EncryChatRoomId"]] = row
+            claimed = set(self.groupIds.values())
+            nextId = max(snapshot, default=0) + 1
+        rows, inserted, updated, seen = [], 0, 0, set()
+        for contact in contacts:
+            new = {i: _value(i, contact.get(i)) for i in columns if i != "MemberCount"}
+            if "MemberCount" in columns:
+                new["MemberCount"] = contact.get("MemberCount") or len(contact.get("MemberList") or ())
+            if table == "Friends":
+                old = byName.get(contact.get("RemarkName") or contact.get("NickName")) or \
+                    byName.get(contact.get("NickName"))
+                if old is not None and old["UserId"] in seen:
+                    old = None
+                new["UserId"] = old["UserId"] if old else nextId
+            elif table == "Groups":
+                new["EncryChatRoomId"] = new["EncryChatRoomId"] or None
+                old = snapshot.get(self.groupIds.get(contact.get("UserName"))) or \
+                    byEncry.get(new["EncryChatRoomId"] or None)
+                if old is None:  # the first group of that name not claimed yet
+                    old = next((row for row in byName.get(new["NickName"], ())
+                                if row["GroupId"] not in seen and row["GroupId"] not in claimed
+                                and not (new["EncryChatRoomId"] and row["EncryChatRoomId"])), None)
+                if old is not None and old["GroupId"] in seen:
+                    old = None
+                new["GroupId"] = old["GroupId"] if old else nextId
+                if old is not None and not new["EncryChatRoomId"]:
+                    new["EncryChatRoomId"] = old["EncryChatRoomId"]
+                if contact.get("UserName"):
+                    self.groupIds[contact["UserName"]] = new["GroupId"]
+            else:
+                if not new[key]:  # an unnamed group or mp can not be told apart
+                    continue
+                old = snapshot.get(new[key])
+            if old is not None and "MemberList" in new and not contact.get("MemberList"):
+                # members are not loaded yet, keep the known ones
+                new["MemberList"] = old["MemberList"]
+                new["MemberCount"] = contact.get("MemberCount") or old["MemberCount"]
+            if old is None:
+                new["History"] = None
+                inserted += 1
+                if table in ("Friends", "Groups"):
+                    nextId += 1
+            else:
+                changed = {i: old[i] for i in columns if old.get(i) != new[i]}
+                if not changed:
+                    seen.add(new[key])
+                    continue
+                history = json.loads(old["History"]) if old.get("History") else []
+                change = {i: v for i, v in changed.items() if i not in NO_HISTORY}
+                if change:
+                    history.append(dict(change, Time=now))
+                new["History"] = json.dumps(history[-self.historySize:], ensure_ascii=False) if history else None
+                updated += 1
+            seen.add(new[key])
+            snapshot[new[key]] = new
+            rows.append(new)
+        return rows, (inserted, updated)
+
+    @staticmethod
+    def _write(db, rows):
+        limit = db.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER) if hasattr(db, 'getlimit') else MAX_VARIABLES
+        with db:
+            for table, _rows in rows.items():
+                if _rows:
+                    key, columns = CONTACT_TABLES[table]
+                    names = _columns(key, columns)
+                    for sql, params in sqlitehelper.bulk(upsert(table, key, columns),
+                                                         [[row[i] for i in names] for row in _rows], limit):
+                        db.execute(sql, params)
+
+
+class ContactCache:
+    """
+    The contact lists of itchat as fetched, kept in <uin>.contacts.db next to <uin>.db so a
+    login can start from them instead of fetching every contact first. A list is stored with
+    the user name of the account when it was saved: user names of contacts only hold within
+    the session they were given in, so the lists are loaded for that session only. Lists are
+    pickled like itchat pickles them for a hot reload.
+    """
+    LISTS = ("memberList", "mpList", "chatroomList")
+
+    def __init__(self, path):
+        """
+        :param path: the database file, created when missing
+        """
+        self.path = path
+        self.metrics = {"loaded": 0, "saved": 0, "resolved": 0, "refreshed": None}
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute("CREATE TABLE IF NOT EXISTS Contacts ("
+                   "List VARCHAR PRIMARY KEY, Session VARCHAR, SavedTime INT(10), Data BLOB)")
+        return db
+
+    def load(self, storage):
+        """
+        Replace the contact lists of storage by the cached ones of its session.
+        :param storage: itchat storageClass
+        :return: number of contacts loaded, 0 if nothing is cached for the session
+        """
+        if not os.path.exists(self.path):
+            return 0
+        db = self._connect()
+        try:
+            rows = db.execute("SELECT List, Data FROM Contacts WHERE Session = ?", (storage.userName,)).fetchall()
+        finally:
+            db.close()
+        lists = {name: pickle.loads(data) for name, data in rows if name in self.LISTS}
+        if len(lists) != len(self.LISTS):
+            return 0
+        with storage.updateLock:
+            storage.loads(dict(storage.dumps(), **lists))
+        self.metrics["loaded"] = sum(len(i) for i in lists.values())
+        logger.info('Loaded {} contacts of the last session from {}'.format(self.metrics["loaded"], self.path))
+        return self.metrics["loaded"]
+
+    def save(self, storage):
+        now = round(time.time())
+        with storage.updateLock:
+            rows = [(name, storage.userName, now, pickle.dumps(getattr(storage, name)))
+                    for name in self.LISTS]
+        db = self._connect()
+        try:
+            with db:
+                db.executemany("INSERT OR REPLACE INTO Contacts VALUES (?, ?, ?, ?)", rows)
+        finally:
+            db.close()
+        self.metrics["saved"] = now
+
+
+class MemberIds:
+    """
+    MemberId of GroupMembers by chatroom and member name, the names of the most recently
+    seen maxSize members kept in memory. A member missing there is read from GroupMembers,
+    a new one is given the next id here and its row is written behind on the writer, so
+    ids come from a single counter and a message never waits for the write. New members stay
+    in self.pending until written() sees their row committed, so one evicted before that is
+    not given a second id.
+    """
+
+    def __init__(self, writer, readers, maxSize=10000):
+        """
+        :param writer: dbhelper.BatchWriter
+        :param readers: dbhelper.ReadPool
+        :param maxSize: members kept in memory
+        """
+        self.writer = writer
+        self.readers = readers
+        self.maxSize = max(int(maxSize), 1)
+        self.cache = OrderedDict()  # (ChatRoom, Name): MemberId
+        self.pending = {}  # (ChatRoom, Name): MemberId queued on the writer
+        self.lastId = readers.fetchone("SELECT IFNULL(max(MemberId), 0) FROM GroupMembers")[0]
+        self.metrics = {"hits": 0, "misses": 0, "created": 0}
+        self.lock = threading.Lock()
+
+    def get(self, chatRoom, name):
+        """
+        :param chatRoom: the group as stored in GroupMsgs.ChatRoom
+        :param name: the member's name in the group, actualNickName
+        :return: MemberId, created when the member is new
+        """
+        key = (chatRoom or '', name or '')
+        with self.lock:
+            memberId = self.cache.get(key)
+            if memberId is not None:
+                self.metrics["hits"] += 1
+                self.cache.move_to_end(key)
+                return memberId
+            memberId = self.pending.get(key)
+            if memberId is not None:
+                self.metrics["hits"] += 1
+                self._cache(key, memberId)
+                return memberId
+        row = self.readers.fetchone(SELECT_MEMBER, key)
+        created = None
+        with self.lock:
+            self.metrics["misses"] += 1
+            memberId = self.cache.get(key) or self.pending.get(key)  # another thread resolved it meanwhile
+            if memberId is None:
+                if row is not None:
+                    memberId = row[0]
+                else:
+                    self.lastId += 1
+                    memberId = self.lastId
+                    self.metrics["created"] += 1
+                    created = (memberId,) + key + (round(time.time()),)
+                    self.pending[key] = memberId
+                self._cache(key, memberId)
+        if created:
+            self.writer.put(INSERT_MEMBER, created)
+        return memberId
+
+    def _cache(self, key, memberId):
+        self.cache[key] = memberId
+        if len(self.cache) > self.maxSize:
+            self.cache.popitem(last=False)
+
+    def written(self, rows):
+        """
+        Forget the pending members among rows committed by the writer, see
+        dbhelper.BatchWriter commitCallback.
+        :param rows: [(sql, args, msg), ...]
+        """
+        with self.lock:
+            for sql, args, _ in rows:
+                if sql == INSERT_MEMBER:
+                    self.pending.pop(tuple(args[1:3]), None)
+
+    def info(self):
+        with self.lock:
+            return dict(self.metrics, size=len(self.cache), pending=len(self.pending))
+
+
+def _value(column, value):
+    if column == "HeadImgUrl" and value:
+        return SESSION_PARAMS.sub('', value)
+    if column == "MemberList":
+        names = sorted(i.get("DisplayName") or i.get("NickName") or '' for i in value or ())
+        return json.dumps(names, ensure_ascii=False) if names else None
+    return value
@@ -0,0 +1,409 @@
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from logging import getLogger
+from queue import Queue, Empty
+from urllib.request import pathname2url
+from compress import register
+from sqlhelper import MAX_VARIABLES, VALUES, sqlitehelper
+logger = getLogger('sql')
+
+# pragmas that only matter on the connection that writes
+WRITER_PRAGMAS = ("auto_vacuum", "journal_mode", "synchronous")
+
+
+def apply_pragmas(db, profile, reader=False):
+    """
+    :param db: sqlite3.Connection
+    :param profile: dict like {"auto_vacuum": "INCREMENTAL", "journal_mode": "WAL", "synchronous": "NORMAL",
+                               "cache_size": -16000, "mmap_size": 268435456, "temp_store": "MEMORY"};
+                    auto_vacuum must come before anything creates a table of a new database
+    :param reader: skip the pragmas in WRITER_PRAGMAS
+    """
+    for pragma, value in (profile or {}).items():
+        if value is None or (reader and pragma in WRITER_PRAGMAS):
+            continue
+        if not pragma.replace('_', '').isalpha():
+            raise ValueError('Invalid pragma {}'.format(pragma))
+        row = db.execute('PRAGMA {} = {}'.format(pragma, value)).fetchone()
+        if pragma == 'journal_mode' and row and row[0].lower() != str(value).lower():
+            logger.warning('journal_mode {} is not available, using {}'.format(value, row[0]))
+
+
+def fts_init(db, table, columns=("Content", "Comments"), tokenize="trigram"):
+    """
+    Create an FTS5 index over columns of table, kept in sync by triggers.
+    The index is external-content: it stores tokens only and reads rows back from the view
+    <table>Text, which unpacks compressed values; connections using it need compress.register.
+    :param tokenize: trigram matches any substring of 3+ characters, which Chinese text needs;
+                     unicode61 is smaller but only matches whole words
+    :return: True if the index was just created over existing rows and must be rebuilt
+    """
+    fts, text = table + 'Fts', table + 'Text'
+    exists = db.execute("SELECT sql FROM sqlite_master WHERE name = ?", (fts,)).fetchone()
+    if exists and "content='{}'".format(text) not in exists[0]:
+        # an index made before values could be compressed reads the table itself, make it again
+        for trigger in ('_ai', '_ad', '_au'):
+            db.execute('DROP TRIGGER IF EXISTS {}{}'.format(fts, trigger))
+        db.execute('DROP TABLE {}'.format(fts))
+        exists = None
+    _columns = ', '.join(columns)
+    _new = ', '.join('unpack(new.{})'.format(i) for i in columns)
+    _old = ', '.join('unpack(old.{})'.format(i) for i in columns)
+    db.execute('CREATE VIEW IF NOT EXISTS {} AS SELECT rowid AS rowid, {} FROM {}'.format(
+        text, ', '.join('unpack({0}) AS {0}'.format(i) for i in columns), table))
+    db.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({}, content='{}', content_rowid='rowid',
+                  tokenize='{}')'''.format(fts, _columns, text, tokenize))
+    db.execute('''CREATE TRIGGER IF NOT EXISTS {0}_ai AFTER INSERT ON {1} BEGIN
+                    INSERT INTO {0}(rowid, {2}) VALUES (new.rowid, {3});
+                  END'''.format(fts, table, _columns, _new))
+    db.execute('''CREATE TRIGGER IF NOT EXISTS {0}_ad AFTER DELETE ON {1} BEGIN
+                    INSERT INTO {0}({0}, rowid, {2}) VALUES ('delete', old.rowid, {3});
+                  END'''.format(fts, table, _columns, _old))
+    db.execute('''CREATE TRIGGER IF NOT EXISTS {0}_au AFTER UPDATE ON {1} BEGIN
+                    INSERT INTO {0}({0}, rowid, {2}) VALUES ('delete', old.rowid, {3});
+                    INSERT INTO {0}(rowid, {2}) VALUES (new.rowid, {4});
+                  END'''.format(fts, table, _columns, _old, _new))
+    return not exists and db.execute("SELECT 1 FROM {} LIMIT 1".format(table)).fetchone() is not None
+
+
+def fts_rebuild(db, table):
+    """
+    Re-index every row of table, for databases that held messages before fts_init.
+    """
+    fts = table + 'Fts'
+    start = time.time()
+    with db:
+        db.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(fts))
+    logger.info('Rebuild {} in {:.1f} seconds'.format(fts, time.time() - start))
+
+
+class ReadPool:
+    """
+    A fixed set of read-only connections, so queries never queue behind the writer.
+    With journal_mode=WAL readers and the writer do not block each other.
+    """
+
+    def __init__(self, path, size=2, profile=None):
+        """
+        :param path: the database file, it must exist already
+        :param size: number of connections
+        :param profile: pragmas applied to each connection, see apply_pragmas
+        """
+        self.path = path
+        self.size = max(int(size), 1)
+        self.pool = Queue()
+        uri = 'file:{}?mode=ro'.format(pathname2url(path))
+        for _ in range(self.size):
+            db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            register(db)
+            apply_pragmas(db, profile, reader=True)
+            self.pool.put(db)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        db = self.pool.get(timeout=timeout)
+        try:
+            yield db
+        finally:
+            if db.in_transaction:
+                db.rollback()
+            self.pool.put(db)
+
+    def fetchall(self, sql, args=()):
+        with self.connection() as db:
+            return db.execute(sql, args).fetchall()
+
+    def fetchone(self, sql, args=()):
+        with self.connection() as db:
+            return db.execute(sql, args).fetchone()
+
+    def close(self):
+        for _ in range(self.size):
+            self.pool.get().close()
+
+
+class BatchWriter:
+    """
+    Write-behind stage owning every write on a connection.
+    Statements are queued with put() and flushed by a single thread, one transaction per
+    batch; consecutive rows of one INSERT are written as multi-row VALUES statements, or
+    with executemany when multiRow is off. A batch is flushed when it holds batchSize rows or
+    its oldest row is maxDelay seconds old, whichever comes first.
+    """
+
+    def __init__(self, db, batchSize=500, maxDelay=1.0, maxQueue=0, multiRow=True, errorCallback=None,
+                 commitCallback=None, metrics=None):
+        """
+        :param db: sqlite3.Connection opened with check_same_thread=False
+        :param batchSize: flush when the pending batch reaches this many rows
+        :param maxDelay: flush when the oldest pending row is older than this (seconds)
+        :param maxQueue: bound of the incoming queue, 0 is unbounded; put() blocks when full
+        :param multiRow: join the rows of a single-row INSERT into statements binding as many
+                         parameters as SQLite allows
+        :param errorCallback: fn(sql, args, msg, exc) called on the writer thread for a row that fails
+        :param commitCallback: fn(rows) called on the writer thread once a batch is committed, with the
+                               (sql, args, msg) of its rows that changed the database; rows ignored
+                               by INSERT OR IGNORE and the like are left out
+        :param metrics: metrics.Metrics timing the execute and commit of each batch, None is off
+        """
+        self.db = db
+        self.batchSize = max(int(batchSize), 1)
+        self.maxDelay = maxDelay
+        self.multiRow = multiRow
+        self.variables = db.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER) if hasattr(db, 'getlimit') \
+            else MAX_VARIABLES
+        self.errorCallback = errorCallback
+        self.commitCallback = commitCallback
+        self.metrics = metrics
+        self.queue = Queue(maxQueue)
+        self.thread = None
+
+    @property
+    def alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if not self.alive:
+            self.thread = threading.Thread(target=self._loop, name='BatchWriter')
+            self.thread.setDaemon(True)
+            self.thread.start()
+        return self
+
+    def put(self, sql, args=(), msg=None):
+        """
+        :param sql: str statement with ? placeholders
+        :param args: the parameters of sql
+        :param msg: passed back to errorCallback if the row fails
+        """
+        self.queue.put((sql, args, msg))
+
+    def submit(self, fn):
+        """
+        Run fn(db) on the writer thread once the pending batch is committed.
+        :return: concurrent.futures.Future of fn's result
+        """
+        future = Future()
+        self.queue.put((None, fn, future))
+        return future
+
+    def flush(self, timeout=None):
+        """
+        Block until everything put before this call is committed.
+        """
+        if self.alive:
+            self.submit(lambda db: None).result(timeout)
+
+    def close(self, timeout=None):
+        if self.alive:
+            future = self.submit(_stop)
+            future.result(timeout)
+            self.thread.join(timeout)
+        self.thread = None
+
+    def _loop(self):
+        batch = []
+        deadline = 0
+        while True:
+            try:
+                item = self.queue.get(timeout=(max(deadline - time.time(), 0) if batch else None))
+            except Empty:
+                self._flush(batch)
+                batch = []
+                continue
+            sql, args, msg = item
+            if sql is not None:
+                if not batch:
+                    deadline = time.time() + self.maxDelay
+                batch.append(item)
+                if len(batch) >= self.batchSize:
+                    self._flush(batch)
+                    batch = []
+                continue
+            self._flush(batch)
+            batch = []
+            fn, future = args, msg
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(self.db))
+            except _Stop:
+                future.set_result(None)
+                break
+            except BaseException as e:
+                if self.db.in_transaction:
+                    self.db.rollback()
+                future.set_exception(e)
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        metrics = self.metrics
+        written = [] if self.commitCallback else None
+        try:
+            with self.db:
+                start = metrics and time.perf_counter()
+                if written is not None and not self.db.in_transaction:
+                    self.db.execute('BEGIN')  # or releasing the first savepoint would commit
+                for sql, items in _runs(batch):
+                    rows = [args for _, args, _ in items]
+                    if written is None:
+                        self._execute(sql, rows)
+                        continue
+                    self.db.execute('SAVEPOINT batch_run')
+                    if self._execute(sql, rows) == len(rows):
+                        written.extend(items)
+                    else:  # some rows changed nothing, find out which one by one
+                        self.db.execute('ROLLBACK TO batch_run')
+                        written.extend(item for item in items if self.db.execute(sql, item[1]).rowcount > 0)
+                    self.db.execute('RELEASE batch_run')
+                if metrics:
+                    executed = time.perf_counter()
+                    metrics.observe("execute", executed - start)
+            if metrics:
+                metrics.observe("commit", time.perf_counter() - executed)
+                metrics.mark("rowsWritten", len(batch))
+        except Exception:  # not only sqlite3.Error: binding a value can raise OverflowError and the like
+            if self.db.in_transaction:
+                self.db.rollback()
+            logger.warning('Batch of {} rows failed, replaying row by row'.format(len(batch)))
+            self._replay(batch)
+            return
+        if written:
+            self.committed(written)
+
+    def _execute(self, sql, rows):
+        """
+        :return: number of rows changed
+        """
+        if self.multiRow and len(rows) > 1 and not isinstance(rows[0], dict) and VALUES.search(sql):
+            return sum(self.db.execute(_sql, params).rowcount
+                       for _sql, params in sqlitehelper.bulk(sql, rows, self.variables))
+        return self.db.executemany(sql, rows).rowcount
+
+    def _replay(self, batch):
+        written = []
+        for sql, args, msg in batch:
+            try:
+                if self.db.execute(sql, args).rowcount > 0:
+                    written.append((sql, args, msg))
+            except Exception as e:
+                self._failed(sql, args, msg, e)
+        try:
+            self.db.commit()
+        except Exception:
+            logger.exception('Commit of {} replayed rows failed, they are lost'.format(len(batch)))
+            if self.db.in_transaction:
+                self.db.rollback()
+            return
+        if written:
+            self.committed(written)
+
+    def committed(self, rows):
+        """
+        Pass rows committed on the writer thread to commitCallback, see __init__.
+        """
+        if self.commitCallback:
+            try:
+                self.commitCallback(rows)
+            except Exception:
+                logger.exception('commitCallback failed')
+
+    def _failed(self, sql, args, msg, exc):
+        if self.errorCallback:
+            try:
+                self.errorCallback(sql, args, msg, exc)
+                return
+            except Exception:
+                logger.exception('errorCallback failed')
+        logger.warning('{}: {} {}'.format(exc.__class__.__name__, sql, args))
+
+
+class _Stop(Exception):
+    pass
+
+
+def _stop(db):
+    raise _Stop()
+
+
+def _runs(batch):
+    """
+    Group consecutive rows sharing the same statement, keeping their order.
+    :return: iterator of (sql, [(sql, args, msg), ...])
+    """
+    sql, items = None, []
+    for item in batch:
+        if item[0] != sql:
+            if items:
+                yield sql, items
+            sql, items = item[0], []
+        items.append(item)
+    if items:
+        yield sql, items
+
+
+if __name__ == '__main__':
+    import argparse
+    import logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Maintenance of a wechathelper database')
+    parser.add_argument('database', help='path of <uin>.db')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('fts-rebuild', help='build the full-text index of existing messages')
+    command.add_argument('--tables', nargs='+', default=("FriendMsgs", "GroupMsgs", "MpMsgs"))
+    command.add_argument('--tokenize', default='trigram')
+    command = commands.add_parser('compress', help='compress the Content and Comments stored uncompressed')
+    command.add_argument('--tables', nargs='+', default=("FriendMsgs", "GroupMsgs", "MpMsgs"))
+    command.add_argument('--batch', type=int, default=1000, help='rows per transaction')
+    command.add_argument('--min-size', type=int, default=256, help='characters of the smallest value compressed')
+    command.add_argument('--level', type=int, default=6)
+    command.add_argument('--decompress', action='store_true', help='store every value as text again')
+    command.add_argument('--vacuum', action='store_true', help='give the freed pages back to the file system')
+    command.add_argument('--tokenize', default='trigram', help='of a full-text index made again')
+    command = commands.add_parser('msg-stats', help='count the stored messages into MsgStats again')
+    command.add_argument('--tables', nargs='+', default=("FriendMsgs", "GroupMsgs", "MpMsgs"))
+    command.add_argument('--partitions', action='store_true', help='count the <uin>-<period>.db partitions too')
+    command = commands.add_parser('vacuum', help='rebuild the database, switching it to auto_vacuum INCREMENTAL')
+    command.add_argument('--auto-vacuum', default='INCREMENTAL', choices=('NONE', 'FULL', 'INCREMENTAL'))
+    options = parser.parse_args()
+    connection = sqlite3.connect(options.database, timeout=30)
+    register(connection)
+    if options.command == 'fts-rebuild':
+        for _table in options.tables:
+            fts_init(connection, _table, tokenize=options.tokenize)
+            fts_rebuild(connection, _table)
+    elif options.command == 'compress':
+        from compress import recompress
+        _tables = {row[0] for row in connection.execute(sqlitehelper.show_tables)}
+        for _table in options.tables:
+            if _table not in _tables:
+                continue
+            rebuild = _table + 'Fts' in _tables and fts_init(connection, _table, tokenize=options.tokenize)
+            recompress(connection, _table, batchSize=options.batch, minSize=options.min_size,
+                       level=options.level, decompress=options.decompress)
+            if rebuild:
+                fts_rebuild(connection, _table)
+        if options.vacuum:
+            connection.execute('VACUUM')
+    elif options.command == 'msg-stats':
+        from glob import glob
+        from rollup import backfill
+        if options.partitions:  # attached one at a time, SQLite attaches few databases at once
+            backfill(connection, options.tables)
+            for _path in sorted(glob(options.database[:-3] + '-*.db')):
+                connection.execute('ATTACH DATABASE ? AS partition', (_path,))
+                backfill(connection, options.tables, ('partition',), reset=False)
+                connection.execute('DETACH DATABASE partition')
+        else:
+            backfill(connection, options.tables)
+    elif options.command == 'vacuum':
+        # a new auto_vacuum mode only takes effect on a database made again by VACUUM
+        connection.execute('PRAGMA auto_vacuum = {}'.format(options.auto_vacuum))
+        connection.execute('VACUUM')
+    else:
+        parser.print_help()
+    connection.close()
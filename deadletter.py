@@ -0,0 +1,210 @@
+import base64
+import json
+import threading
+import time
+from collections import deque
+from logging import getLogger
+from partition import unroute
+from sqlhelper import sqlitehelper
+logger = getLogger('sql')
+
+# message fields kept in a dead letter, enough to find and replay it by hand
+MSG_FIELDS = ("MsgId", "CreateTime", "Type", "MsgType", "FromUserName", "ToUserName",
+              "ActualUserName", "ActualNickName", "Content")
+MAX_CONTENT = 4096
+
+INSERT_DEAD_LETTER = sqlitehelper.insert(
+    "DeadLetters", ("FailTime", "MsgId", "Sql", "Args", "Message", "ErrorClass", "Error", "Attempts", "NextTry"))
+SELECT_DUE = sqlitehelper.select(
+    "DeadLetters", ("Id", "Sql", "Args", "Attempts", "Message"),
+    "Sql IS NOT NULL AND Attempts < ? AND NextTry <= ?", order="NextTry") + " LIMIT ?"
+UPDATE_FAILED = "UPDATE DeadLetters SET Attempts = ?, NextTry = ?, ErrorClass = ?, Error = ? WHERE Id = ?"
+DELETE_RECOVERED = "DELETE FROM DeadLetters WHERE Id = ?"
+# all but the newest ? rows
+DELETE_OLDEST = "DELETE FROM DeadLetters WHERE Id <= (SELECT Id FROM DeadLetters ORDER BY Id DESC LIMIT 1 OFFSET ?)"
+
+
+def compact(msg):
+    """
+    :param msg: itchat message
+    :return: dict of MSG_FIELDS with the chat name, Content cut to MAX_CONTENT
+    """
+    if msg is None:
+        return None
+    _msg = {}
+    for key in MSG_FIELDS:
+        value = msg.get(key)
+        if isinstance(value, (str, int, float)):
+            _msg[key] = value[:MAX_CONTENT] if isinstance(value, str) else value
+    user = msg.get("User") or {}
+    _msg["User"] = user.get("RemarkName") or user.get("NickName") or user.get("UserName")
+    return _msg
+
+
+def dumps(value):
+    return json.dumps(value, ensure_ascii=False, default=_encode)
+
+
+def loads(value):
+    return json.loads(value, object_hook=_decode)
+
+
+def _encode(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {"$b": base64.b64encode(bytes(value)).decode()}
+    raise TypeError(repr(value))
+
+
+def _decode(value):
+    if len(value) == 1 and "$b" in value:
+        return base64.b64decode(value["$b"])
+    return value
+
+
+class DeadLetters:
+    """
+    Failed saves go to the DeadLetters table instead of memory. Only the last bufferSize
+    failures are kept in memory; a background job replays due rows in batches and backs
+    off exponentially on each failure until maxAttempts. The table keeps the newest maxRows
+    dead letters, older ones are deleted by the same job. With partitions, statements are
+    stored for the unpartitioned table and routed again when replayed, as the partition they
+    failed on may be sealed by then.
+    """
+
+    def __init__(self, writer, readers, bufferSize=100, batchSize=100, interval=30,
+                 backoff=60, maxBackoff=3600, maxAttempts=10, maxRows=10000, route=None):
+        """
+        :param writer: dbhelper.BatchWriter
+        :param readers: dbhelper.ReadPool
+        :param bufferSize: failures kept in memory in self.recent
+        :param batchSize: dead letters replayed per transaction
+        :param interval: seconds between two retry rounds
+        :param backoff: seconds before the first retry, doubled on each failure up to maxBackoff
+        :param maxAttempts: give up after this many retries, the row is kept for inspection
+        :param maxRows: dead letters kept in the table at most, None is unbounded
+        :param route: fn(sql, createTime) giving the statement for the table holding the message,
+                      see partition.Partitions.route
+        """
+        self.writer = writer
+        self.readers = readers
+        self.recent = deque(maxlen=bufferSize)
+        self.batchSize = batchSize
+        self.interval = interval
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.maxAttempts = maxAttempts
+        self.maxRows = maxRows
+        self.route = route
+        self.metrics = {"failed": 0, "retried": 0, "recovered": 0, "abandoned": 0, "trimmed": 0}
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def add(self, msg, exc, info='', sql=None, args=None):
+        """
+        :param msg: the itchat message whose save failed
+        :param exc: the exception
+        :param info: formatted traceback
+        :param sql: the failed statement, None if the save function failed before producing it
+        :param args: the parameters of sql
+        """
+        _msg = compact(msg)
+        now = round(time.time())
+        if sql and self.route:
+            sql = unroute(sql)
+        self.metrics["failed"] += 1
+        self.recent.append((_msg, info or repr(exc)))
+        row = (now, (_msg or {}).get("MsgId"), sql, None if args is None else dumps(args), dumps(_msg),
+               exc.__class__.__name__, str(exc), 0, now + self.backoff)
+        if threading.current_thread() is self.writer.thread:
+            # a row failed on the writer, store it with the batch being committed
+            self.writer.db.execute(INSERT_DEAD_LETTER, row)
+        else:
+            self.writer.put(INSERT_DEAD_LETTER, row)
+
+    def start(self):
+        if self.thread is None:
+            self.stopEvent.clear()
+            self.thread = threading.Thread(target=self._loop, name='DeadLetters')
+            self.thread.setDaemon(True)
+            self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def retry(self):
+        """
+        Replay one batch of due dead letters on the writer.
+        :return: number of dead letters replayed
+        """
+        rows = self.readers.fetchall(SELECT_DUE, (self.maxAttempts, round(time.time()), self.batchSize))
+        if rows:
+            # routed here: attaching a partition is a task of the writer, _replay runs on it
+            rows = [(row["Id"], self._route(row), row["Args"], row["Attempts"]) for row in rows]
+            self.writer.submit(lambda db: self._replay(db, rows)).result()
+        return len(rows)
+
+    def _route(self, row):
+        if not self.route:
+            return row["Sql"]
+        try:
+            createTime = (loads(row["Message"]) or {}).get("CreateTime")
+        except ValueError:
+            createTime = None
+        return self.route(row["Sql"], createTime)
+
+    def trim(self):
+        """
+        Delete the oldest dead letters beyond maxRows on the writer.
+        :return: number of dead letters deleted
+        """
+        if self.maxRows is None:
+            return 0
+
+        def delete(db):
+            with db:
+                return db.execute(DELETE_OLDEST, (max(int(self.maxRows), 0),)).rowcount
+
+        trimmed = self.writer.submit(delete).result()
+        if trimmed:
+            self.metrics["trimmed"] += trimmed
+            logger.warning('Deleted the {} oldest dead letters beyond {}'.format(trimmed, self.maxRows))
+        return trimmed
+
+    def _loop(self):
+        while not self.stopEvent.wait(self.interval):
+            try:
+                while self.retry() == self.batchSize and not self.stopEvent.is_set():
+                    pass
+                self.trim()
+            except Exception:
+                logger.exception('Dead letter retry failed')
+
+    def _replay(self, db, rows):
+        now = round(time.time())
+        recovered = []
+        for _id, sql, args, attempts in rows:
+            self.metrics["retried"] += 1
+            db.execute('SAVEPOINT dead_letter')
+            try:
+                args = loads(args)
+                if db.execute(sql, args).rowcount > 0:
+                    recovered.append((sql, args, None))
+            except Exception as e:
+                db.execute('ROLLBACK TO dead_letter')
+                attempts += 1
+                if attempts >= self.maxAttempts:
+                    self.metrics["abandoned"] += 1
+                    logger.warning('Give up dead letter {} after {} attempts: {}'.format(_id, attempts, e))
+                db.execute(UPDATE_FAILED, (attempts, now + min(self.backoff * 2 ** attempts, self.maxBackoff),
+                                           e.__class__.__name__, str(e), _id))
+            else:
+                self.metrics["recovered"] += 1
+                db.execute(DELETE_RECOVERED, (_id,))
+            db.execute('RELEASE dead_letter')
+        db.commit()
+        if recovered:
+            self.writer.committed(recovered)
@@ -0,0 +1,56 @@
+import threading
+from collections import OrderedDict
+
+
+class RecentIds:
+    """
+    MsgIds of the messages seen within the last `window` seconds of CreateTime, at most maxSize
+    of them, the first seen forgotten first. Checking a message is a dict lookup and insert.
+    """
+
+    def __init__(self, window=86400, maxSize=100000):
+        """
+        :param window: seconds of CreateTime before the newest message an id is kept
+        :param maxSize: ids kept at most
+        """
+        self.window = window
+        self.maxSize = max(int(maxSize), 1)
+        self.ids = OrderedDict()  # MsgId: CreateTime, in the order they were seen
+        self.newest = 0
+        self.duplicates = 0
+        self.lock = threading.Lock()
+
+    def seen(self, msgId, createTime):
+        """
+        Remember msgId.
+        :return: True if it was seen before, the message is a duplicate
+        """
+        key = str(msgId)
+        with self.lock:
+            if key in self.ids:
+                self.duplicates += 1
+                return True
+            self._add(key, createTime or 0)
+            return False
+
+    def seed(self, rows):
+        """
+        :param rows: (MsgId, CreateTime) of stored messages, oldest first
+        """
+        with self.lock:
+            for msgId, createTime in rows:
+                self._add(str(msgId), createTime or 0)
+
+    def _add(self, key, createTime):
+        ids = self.ids
+        ids[key] = createTime
+        if createTime > self.newest:
+            self.newest = createTime
+        horizon = self.newest - self.window
+        while len(ids) > self.maxSize or next(iter(ids.values())) < horizon:
+            ids.popitem(last=False)
+            if not ids:
+                break
+
+    def info(self):
+        return {"size": len(self.ids), "duplicates": self.duplicates}
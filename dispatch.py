@@ -0,0 +1,98 @@
+from collections import namedtuple
+from logging import getLogger
+logger = getLogger('itchat')
+
+# what a message of one chat kind and type goes through: save functions and reply functions,
+# each already wrapped in the middleware of the slot
+Slot = namedtuple("Slot", ("kind", "table", "sf", "rf"))
+FTYPES = ("sf", "rf")
+
+
+class Dispatcher:
+    """
+    Flat (chat kind, message type) -> Slot table, compiled when handlers or middleware are
+    registered so routing a message is two dict lookups. A slot holds ordered chains of
+    handlers; a message of a kind or type nothing is registered for routes to None.
+    """
+
+    def __init__(self, kinds):
+        """
+        :param kinds: ((user class, chat kind, message table), ...) like
+                      ((templates.User, "FriendChat", "FriendMsgs"), ...)
+        """
+        self.tables = {kind: table for _, kind, table in kinds}
+        self.classes = {cls: kind for cls, kind, _ in kinds}
+        self.bases = tuple((cls, kind) for cls, kind, _ in kinds)
+        self.handlers = {}  # (kind, msgType, fType): [fn]
+        self.middleware = {}  # (kind, msgType, fType): [fn]
+        self.table = {}  # (kind, msgType): Slot
+
+    def register(self, kinds, msgTypes, fType, fn, replace=False):
+        """
+        Append fn to the chain of each slot, a function already in a chain is not added twice.
+        :param replace: drop the handlers registered before for these slots
+        """
+        for key in self._keys(kinds, msgTypes, fType):
+            chain = self.handlers.setdefault(key, [])
+            if replace:
+                del chain[:]
+            if fn not in chain:
+                chain.append(fn)
+            self._compile(*key[:2])
+
+    def use(self, kinds, msgTypes, fType, mw):
+        """
+        Wrap every handler of the slots in mw(msg, handler) -> result; the first middleware
+        registered is the outermost. Returning without calling handler(msg) skips the handler.
+        """
+        for key in self._keys(kinds, msgTypes, fType):
+            self.middleware.setdefault(key, []).append(mw)
+            self._compile(*key[:2])
+
+    def kind(self, user):
+        kind = self.classes.get(user.__class__)
+        if kind is None:
+            # a subclass of a known user class, resolved once
+            kind = next((kind for cls, kind in self.bases if isinstance(user, cls)), False)
+            self.classes[user.__class__] = kind
+        return kind
+
+    def route(self, msg):
+        """
+        :return: Slot of msg, None when nothing handles it
+        """
+        kind = self.classes.get(msg['User'].__class__)
+        if kind is None:
+            kind = self.kind(msg['User'])
+        return self.table.get((kind, msg['Type']))
+
+    def _keys(self, kinds, msgTypes, fType):
+        if fType not in FTYPES:
+            raise ValueError('fType must be one of {}'.format(FTYPES))
+        for kind in kinds:
+            if kind not in self.tables:
+                raise ValueError('unknown chat kind {}'.format(kind))
+            for msgType in msgTypes:
+                yield kind, msgType, fType
+
+    def _compile(self, kind, msgType):
+        chains = []
+        for fType in FTYPES:
+            middleware = self.middleware.get((kind, msgType, fType), ())
+            chain = []
+            for fn in self.handlers.get((kind, msgType, fType), ()):
+                for mw in reversed(middleware):
+                    fn = _wrap(mw, fn)
+                chain.append(fn)
+            chains.append(tuple(chain))
+        if any(chains):
+            self.table[(kind, msgType)] = Slot(kind, self.tables[kind], *chains)
+        else:
+            self.table.pop((kind, msgType), None)
+
+
+def _wrap(mw, handler):
+    def wrapper(msg):
+        return mw(msg, handler)
+    wrapper.__wrapped__ = handler
+    return wrapper
@@ -0,0 +1,243 @@
+import base64
+import csv
+import glob
+import gzip
+import io
+import json
+import os
+import sqlite3
+import time
+from logging import getLogger
+from urllib.request import pathname2url
+from compress import PACKED_COLUMNS, unpack
+from sqlhelper import sqlitehelper
+logger = getLogger('sql')
+
+# table: column naming the chat, None if the table has none
+EXPORT_TABLES = {"FriendMsgs": "User", "GroupMsgs": "ChatRoom", "MpMsgs": "NickName", "SystemMsgs": None}
+FORMATS = ("jsonl", "csv")
+
+
+def sources(path):
+    """
+    :param path: path of <uin>.db
+    :return: it and its partitions <uin>-<key>.db, oldest first
+    """
+    return [path] + sorted(glob.glob(glob.escape(os.path.splitext(path)[0]) + '-*.db'))
+
+
+def chunks(cursor, chunkSize):
+    while True:
+        rows = cursor.fetchmany(chunkSize)
+        if not rows:
+            return
+        yield rows
+
+
+def iter_rows(db, table, chat=None, since=None, until=None, after=0, chunkSize=5000):
+    """
+    Rows of table in rowid order, fetched chunkSize at a time so memory does not grow with the table.
+    :param after: only rows with rowid > after, the last rowid of a previous run
+    :return: generator of (columns, rows); rows start with their rowid
+    """
+    condition, args = ["rowid > ?"], [after]
+    if chat is not None:
+        condition.append("{} = ?".format(EXPORT_TABLES[table]))
+        args.append(chat)
+    if since is not None:
+        condition.append("CreateTime >= ?")
+        args.append(since)
+    if until is not None:
+        condition.append("CreateTime < ?")
+        args.append(until)
+    cursor = db.execute(sqlitehelper.select(table, ("rowid", "*"), ' AND '.join(condition), order="rowid"), args)
+    columns = [i[0] for i in cursor.description[1:]]
+    packed = [i + 1 for i, column in enumerate(columns) if column in PACKED_COLUMNS]
+    try:
+        for rows in chunks(cursor, chunkSize):
+            if packed:
+                rows = [tuple(unpack(v) if i in packed else v for i, v in enumerate(row)) for row in rows]
+            yield columns, rows
+    finally:
+        cursor.close()
+
+
+class Checkpoint:
+    """
+    Progress of an export kept in a JSON file, replaced atomically after each chunk:
+    the output size, the finished (source, table) pairs and the last rowid of the current one.
+    """
+
+    def __init__(self, path, filters):
+        self.path = path
+        self.filters = filters
+        self.offset = 0
+        self.done = []
+        self.current = None  # [source, table, rowid]
+        self.complete = False
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                state = json.load(f)
+            if state["filters"] != filters:
+                raise ValueError('checkpoint {} was made with other options: {}'.format(path, state["filters"]))
+            self.offset, self.done, self.current, self.complete = \
+                state["offset"], state["done"], state["current"], state["complete"]
+
+    @property
+    def resumed(self):
+        return bool(self.offset)
+
+    def after(self, source, table):
+        """
+        :return: rowid to resume the table after, None if it is finished
+        """
+        if [source, table] in self.done:
+            return None
+        if self.current and self.current[:2] == [source, table]:
+            return self.current[2]
+        return 0
+
+    def save(self, offset, source=None, table=None, rowid=None, finished=False):
+        self.offset = offset
+        if finished:
+            self.done.append([source, table])
+            self.current = None
+        elif source is not None:
+            self.current = [source, table, rowid]
+        if self.path:
+            temp = self.path + '.tmp'
+            with open(temp, 'w', encoding='utf-8') as f:
+                json.dump({"filters": self.filters, "offset": self.offset, "done": self.done,
+                           "current": self.current, "complete": self.complete}, f)
+            os.replace(temp, self.path)
+
+
+def export(path, output, fmt="jsonl", compress=None, tables=None, chat=None, since=None, until=None,
+           checkpoint=None, chunkSize=5000):
+    """
+    Stream the message tables of a database and its partitions to one file.
+    Each chunk is encoded, appended and fsynced before the checkpoint moves past it, so an
+    interrupted export resumes where it stopped: the output is cut back to the size in
+    the checkpoint and the rows after the recorded rowid are written again.
+    :param path: path of <uin>.db
+    :param output: file to write, each row gets the name of its table in a "Table" field
+    :param fmt: jsonl or csv; csv has the union of the columns of tables
+    :param compress: gzip the output, default when output ends with .gz; every chunk is
+                     one gzip member so the file stays readable when cut at a chunk
+    :param tables: names from EXPORT_TABLES, default all
+    :param chat: only this chat, tables without a chat column are skipped
+    :param since: only rows with CreateTime >= since
+    :param until: only rows with CreateTime < until
+    :param checkpoint: path of the checkpoint file, None to start over every time
+    :param chunkSize: rows fetched and written at a time
+    :return: number of rows written
+    """
+    if fmt not in FORMATS:
+        raise ValueError('fmt must be one of {}'.format(FORMATS))
+    tables = [i for i in (tables or EXPORT_TABLES) if chat is None or EXPORT_TABLES[i]]
+    if compress is None:
+        compress = output.endswith('.gz')
+    state = Checkpoint(checkpoint, {"path": os.path.abspath(path), "fmt": fmt, "compress": compress,
+                                    "tables": tables, "chat": chat, "since": since, "until": until})
+    if state.complete:
+        logger.info('Export to {} is already complete'.format(output))
+        return 0
+    count = 0
+    f = open(output, 'r+b' if state.resumed else 'wb')
+    try:
+        f.truncate(state.offset)
+        f.seek(state.offset)
+        header = None
+        for source in sources(path):
+            db = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(source)), uri=True)
+            try:
+                existing = set(i[0] for i in db.execute(sqlitehelper.show_tables))
+                if fmt == "csv" and header is None:
+                    header = ["Table"]
+                    for table in tables:
+                        header.extend(i[1] for i in db.execute('PRAGMA table_info({})'.format(table))
+                                      if i[1] not in header)
+                    if not state.resumed:
+                        _write(f, _csv([header], None), compress)
+                for table in tables:
+                    name = os.path.basename(source)
+                    after = state.after(name, table)
+                    if after is None or table not in existing:
+                        continue
+                    for columns, rows in iter_rows(db, table, chat, since, until, after, chunkSize):
+                        if fmt == "csv":
+                            index = [header.index(i) for i in columns]
+                            data = _csv(rows, index, len(header), table)
+                        else:
+                            data = ''.join(json.dumps(dict(zip(columns, _row[1:]), Table=table), ensure_ascii=False,
+                                                      default=_encode) + '\n' for _row in rows)
+                        state.save(_write(f, data, compress), name, table, rows[-1][0])
+                        count += len(rows)
+                    state.save(f.tell(), name, table, finished=True)
+                    logger.info('Export {} of {}: {} rows so far'.format(table, name, count))
+            finally:
+                db.close()
+        state.complete = True
+        state.save(f.tell())
+    finally:
+        f.close()
+    return count
+
+
+def _csv(rows, index, width=0, table=None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if index is None:
+        writer.writerows(rows)
+    else:
+        for _row in rows:
+            line = [''] * width
+            line[0] = table
+            for i, value in zip(index, _row[1:]):
+                line[i] = _encode(value) if isinstance(value, bytes) else value
+            writer.writerow(line)
+    return buffer.getvalue()
+
+
+def _write(f, data, compress):
+    data = data.encode('utf-8')
+    f.write(gzip.compress(data) if compress else data)
+    f.flush()
+    os.fsync(f.fileno())
+    return f.tell()
+
+
+def _encode(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(bytes(value)).decode()
+    raise TypeError(repr(value))
+
+
+def _time(value):
+    """
+    :param value: unix time or a local date like 2026-01-31 or 2026-01-31T08:00:00
+    """
+    if value is None or value.isdigit():
+        return value and int(value)
+    return int(time.mktime(time.strptime(value, '%Y-%m-%dT%H:%M:%S' if 'T' in value else '%Y-%m-%d')))
+
+
+if __name__ == '__main__':
+    import argparse
+    import logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Export the messages of a wechathelper database')
+    parser.add_argument('database', help='path of <uin>.db, its partitions are exported too')
+    parser.add_argument('output', help='file to write, gzipped when it ends with .gz')
+    parser.add_argument('--format', choices=FORMATS, default='jsonl')
+    parser.add_argument('--tables', nargs='+', choices=tuple(EXPORT_TABLES))
+    parser.add_argument('--chat', help='RemarkName or NickName of the chat')
+    parser.add_argument('--since', help='unix time or local date, inclusive')
+    parser.add_argument('--until', help='unix time or local date, exclusive')
+    parser.add_argument('--checkpoint', help='resume from and save progress to this file')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    options = parser.parse_args()
+    logger.info('Exported {} rows'.format(export(
+        options.database, options.output, options.format, tables=options.tables, chat=options.chat,
+        since=_time(options.since), until=_time(options.until), checkpoint=options.checkpoint,
+        chunkSize=options.chunk_size)))
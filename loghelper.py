@@ -0,0 +1,191 @@
+import json
+import logging
+import random
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+
+
+class LazyTime:
+    """
+    Log argument formatting a unix time only when the record is written.
+    """
+    __slots__ = ("t",)
+
+    def __init__(self, t):
+        self.t = t
+
+    def __str__(self):
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.t))
+
+
+class ChatLimiter(logging.Filter):
+    """
+    Samples and rate-limits the records of each chat, records carry the chat in
+    extra={"chat": ...}. Warnings and records without a chat always pass.
+    """
+
+    def __init__(self, rate=0, burst=10, sample=1.0):
+        """
+        :param rate: records per second per chat, 0 is unlimited
+        :param burst: records a quiet chat may log at once
+        :param sample: fraction of the records kept
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample = sample
+        self.buckets = {}  # chat: [tokens, last time]
+        self.sampled = 0
+        self.limited = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        chat = getattr(record, "chat", None)
+        if chat is None or record.levelno >= logging.WARNING:
+            return True
+        if self.sample < 1 and random.random() >= self.sample:
+            self.sampled += 1
+            return False
+        if self.rate:
+            now = time.monotonic()
+            with self.lock:
+                bucket = self.buckets.get(chat)
+                if bucket is None:
+                    bucket = self.buckets[chat] = [self.burst, now]
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                if bucket[0] < 1:
+                    self.limited += 1
+                    return False
+                bucket[0] -= 1
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Adds the key/values of extra={"fields": {...}} to what the wrapped formatter writes,
+    as " key=value" pairs or, with asJson, one JSON object per record.
+    """
+
+    def __init__(self, formatter=None, asJson=False):
+        super().__init__()
+        self.formatter = formatter or logging.Formatter()
+        self.asJson = asJson
+
+    def format(self, record):
+        fields = getattr(record, "fields", None) or {}
+        if self.asJson:
+            data = {"time": record.created, "level": record.levelname, "logger": record.name,
+                    "message": record.getMessage()}
+            chat = getattr(record, "chat", None)
+            if chat is not None:
+                data["chat"] = chat
+            data.update(fields)
+            if record.exc_info:
+                data["exc"] = self.formatException(record.exc_info)
+            return json.dumps(data, ensure_ascii=False, default=str)
+        text = self.formatter.format(record)
+        if fields:
+            text += ' ' + ' '.join('{}={}'.format(k, v) for k, v in fields.items())
+        return text
+
+
+class _QueueHandler(QueueHandler):
+    """
+    Enqueues records as they are: the message is formatted by the listener thread, and a
+    full queue drops the record instead of blocking the caller.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if record.exc_info or record.stack_info:
+            return super().prepare(record)  # tracebacks can not wait
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class _QueueListener(QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # waits for room instead of failing on a full queue
+
+
+class LogPipeline:
+    """
+    Moves the handlers of some loggers behind a bounded queue written by a background
+    thread, so logging on the message path costs a filter and an enqueue.
+    """
+
+    def __init__(self, names=("itchat", "sql"), queueSize=10000, rate=0, burst=10, sample=1.0,
+                 structured=None):
+        """
+        :param names: loggers whose records go through the queue
+        :param queueSize: records waiting to be written at most, more are dropped
+        :param rate: records per second per chat, see ChatLimiter
+        :param burst: see ChatLimiter
+        :param sample: see ChatLimiter
+        :param structured: None, "kv" or "json" to write the fields of the records, see StructuredFormatter
+        """
+        self.names = names
+        self.limiter = ChatLimiter(rate, burst, sample)
+        self.handler = _QueueHandler(Queue(max(int(queueSize), 1)))
+        self.handler.addFilter(self.limiter)
+        self.structured = structured
+        self.saved = {}  # name: (handlers, propagate)
+        self.formatters = {}  # handler: formatter
+        self.listener = None
+
+    def start(self):
+        if self.listener is not None:
+            return self
+        handlers = []
+        for name in self.names:
+            _logger = logging.getLogger(name)
+            self.saved[name] = (list(_logger.handlers), _logger.propagate)
+            for handler in _logger.handlers or logging.getLogger().handlers:
+                if handler not in handlers:
+                    handlers.append(handler)
+            for handler in list(_logger.handlers):
+                _logger.removeHandler(handler)
+            _logger.addHandler(self.handler)
+            _logger.propagate = False
+        if self.structured:
+            for handler in handlers:
+                self.formatters[handler] = handler.formatter
+                handler.setFormatter(StructuredFormatter(handler.formatter, self.structured == "json"))
+        self.listener = _QueueListener(self.handler.queue, *(handlers or [logging.lastResort]),
+                                       respect_handler_level=True)
+        self.listener.start()
+        return self
+
+    def stop(self):
+        """
+        Write what is queued and give the loggers their handlers back.
+        """
+        if self.listener is None:
+            return
+        self.listener.stop()
+        self.listener = None
+        for name, (handlers, propagate) in self.saved.items():
+            _logger = logging.getLogger(name)
+            _logger.removeHandler(self.handler)
+            for handler in handlers:
+                _logger.addHandler(handler)
+            _logger.propagate = propagate
+        for handler, formatter in self.formatters.items():
+            handler.setFormatter(formatter)
+        self.saved.clear()
+        self.formatters.clear()
+
+    def info(self):
+        return {"queued": self.handler.queue.qsize(), "dropped": self.handler.dropped,
+                "sampled": self.limiter.sampled, "limited": self.limiter.limited}
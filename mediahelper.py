@@ -0,0 +1,161 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+logger = getLogger('itchat')
+
+USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+              '(KHTML, like Gecko) Chrome/54.0.2840.71 Safari/537.36')
+# Content of a message row once its media is stored
+MEDIA_REF = '#media#'
+INSERT_MEDIA = "INSERT OR IGNORE INTO MediaMsgs (Md5, Type, Content, Comment, FileName) VALUES (?, ?, ?, ?, ?)"
+UPDATE_MSG = "UPDATE {} SET Content = ? WHERE MsgId = ? AND CreateTime = ?"
+EMOJI_MD5 = re.compile(r'md5\s*=\s*"([0-9a-fA-F]{32})"')
+
+
+class MediaStore:
+    """
+    Downloads pictures, voice, video and files on a bounded pool of threads.
+    Each file is streamed to tempDir in chunks while its MD5 is computed, then moved to
+    mediaDir/<md5[:2]>/<md5>; a file already stored is not written again.
+    MediaMsgs keeps one row per MD5 and the message row's Content becomes MEDIA_REF + md5.
+    """
+
+    def __init__(self, core, mediaDir, tempDir, writer, workers=4, maxPending=1000,
+                 chunkSize=64 * 1024, timeout=60, route=None):
+        """
+        :param core: the logged in itchat Core, its session does the downloads
+        :param mediaDir: root of the content-addressed store
+        :param tempDir: where downloads are written before they are hashed
+        :param writer: dbhelper.BatchWriter
+        :param workers: parallel downloads
+        :param maxPending: downloads queued at most, more are dropped so the reply thread never waits
+        :param chunkSize: bytes read from the network at a time
+        :param timeout: seconds without data before a download fails
+        :param route: fn(sql, createTime) giving the statement for the table holding the message,
+                      see partition.Partitions.route
+        """
+        self.core = core
+        self.mediaDir = mediaDir
+        self.tempDir = tempDir
+        self.writer = writer
+        self.chunkSize = chunkSize
+        self.timeout = timeout
+        self.route = route
+        self.executor = ThreadPoolExecutor(max(int(workers), 1), 'Media')
+        self.pending = threading.BoundedSemaphore(max(int(maxPending), 1))
+        self.metrics = {"stored": 0, "duplicated": 0, "dropped": 0, "failed": 0, "bytes": 0}
+
+    def path(self, md5):
+        return os.path.join(self.mediaDir, md5[:2], md5)
+
+    def submit(self, msg, table):
+        """
+        :param msg: itchat message of type Picture, Recording, Video or Attachment
+        :param table: message table whose row references the media
+        :return: Future of the md5, None if dropped
+        """
+        if not self.pending.acquire(blocking=False):
+            self.metrics["dropped"] += 1
+            logger.warning('Too many pending downloads, drop media of message {}'.format(msg.get('MsgId')))
+            return None
+        future = self.executor.submit(self._store, msg, table)
+        future.add_done_callback(lambda f: self.pending.release())
+        return future
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def _store(self, msg, table):
+        try:
+            md5, size = self._known(msg) or self._download(msg)
+        except Exception as e:
+            self.metrics["failed"] += 1
+            logger.warning('Download media of message {} failed: {!r}'.format(msg.get('MsgId'), e))
+            return None
+        self.writer.put(INSERT_MEDIA, (md5, msg.get('Type'), os.path.relpath(self.path(md5), self.mediaDir),
+                                       size, msg.get('FileName')))
+        sql = UPDATE_MSG.format(table)
+        if self.route:
+            sql = self.route(sql, msg.get('CreateTime'))
+        self.writer.put(sql, (MEDIA_REF + md5, msg.get('MsgId'), msg.get('CreateTime')))
+        return md5
+
+    def _known(self, msg):
+        """
+        Stickers carry the MD5 of their file, reposts are not downloaded again.
+        """
+        if msg.get('MsgType') == 47:
+            md5 = EMOJI_MD5.search(msg.get('Content') or '')
+            if md5 and os.path.exists(self.path(md5.group(1).lower())):
+                self.metrics["duplicated"] += 1
+                return md5.group(1).lower(), os.path.getsize(self.path(md5.group(1).lower()))
+        return None
+
+    def _download(self, msg):
+        md5, size = hashlib.md5(), 0
+        fd, temp = tempfile.mkstemp(dir=self.tempDir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                source = self._source(msg)
+                if source is None:
+                    # unknown kind of media, let itchat write it and hash the file afterwards
+                    msg.download(temp)
+                    with open(temp, 'rb') as _f:
+                        for block in iter(lambda: _f.read(self.chunkSize), b''):
+                            md5.update(block)
+                            size += len(block)
+                else:
+                    url, params, headers = source
+                    r = self.core.s.get(url, params=params, headers=headers, stream=True, timeout=self.timeout)
+                    try:
+                        r.raise_for_status()
+                        for block in r.iter_content(self.chunkSize):
+                            md5.update(block)
+                            f.write(block)
+                            size += len(block)
+                    finally:
+                        r.close()
+            if not size:
+                raise ValueError('empty media')
+            md5 = md5.hexdigest()
+            path = self.path(md5)
+            if os.path.exists(path):
+                self.metrics["duplicated"] += 1
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                shutil.move(temp, path)
+                self.metrics["stored"] += 1
+                self.metrics["bytes"] += size
+            return md5, size
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def _source(self, msg):
+        """
+        :return: url, params, headers of the media as itchat would request them; None if unknown
+        """
+        loginInfo = self.core.loginInfo
+        headers = {'User-Agent': USER_AGENT}
+        msgType = msg.get('MsgType')
+        if msgType in (3, 47) or (msgType == 49 and msg.get('AppMsgType') == 8):
+            return ('{}/webwxgetmsgimg'.format(loginInfo['url']),
+                    {'msgid': msg['NewMsgId'], 'skey': loginInfo['skey']}, headers)
+        elif msgType == 34:
+            return ('{}/webwxgetvoice'.format(loginInfo['url']),
+                    {'msgid': msg['NewMsgId'], 'skey': loginInfo['skey']}, headers)
+        elif msgType in (43, 62):
+            headers['Range'] = 'bytes=0-'
+            return ('{}/webwxgetvideo'.format(loginInfo['url']),
+                    {'msgid': msg['MsgId'], 'skey': loginInfo['skey']}, headers)
+        elif msgType == 49 and msg.get('AppMsgType') == 6:
+            return ('{}/webwxgetmedia'.format(loginInfo['fileUrl']),
+                    {'sender': msg['FromUserName'], 'mediaid': msg['MediaId'], 'filename': msg['FileName'],
+                     'fromuser': loginInfo['wxuin'], 'pass_ticket': 'undefined',
+                     'webwx_data_ticket': self.core.s.cookies.get('webwx_data_ticket')}, headers)
+        return None
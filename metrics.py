@@ -0,0 +1,176 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+logger = getLogger('itchat')
+
+# upper bounds of the histogram buckets: 10µs doubling up to about 5.8 days
+BOUNDS = tuple(1e-5 * 2 ** i for i in range(36))
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+
+class Histogram:
+    """
+    Fixed log-scale buckets: observing is a bisect and a few additions, the memory never grows.
+    Percentiles are the upper bound of the bucket they fall in, so within a factor of 2.
+    """
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def percentile(self, q):
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return 0.0
+
+    def snapshot(self):
+        with self.lock:
+            return {"count": self.count, "mean": self.sum / self.count if self.count else 0.0,
+                    "p50": self.percentile(0.5), "p90": self.percentile(0.9), "p99": self.percentile(0.99),
+                    "max": self.max}
+
+
+class Rate:
+    """
+    Events per second over the last `window` seconds, kept in one counter per second.
+    """
+
+    def __init__(self, window=60):
+        self.window = max(int(window), 1)
+        self.seconds = [0] * self.window
+        self.counts = [0] * self.window
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def mark(self, n=1):
+        second = int(time.time())
+        i = second % self.window
+        with self.lock:
+            if self.seconds[i] != second:
+                self.seconds[i], self.counts[i] = second, 0
+            self.counts[i] += n
+            self.total += n
+
+    def per_second(self):
+        now = int(time.time())
+        with self.lock:
+            return sum(n for second, n in zip(self.seconds, self.counts) if now - second < self.window) / self.window
+
+
+class Metrics:
+    """
+    Latency histograms per pipeline stage, event rates and gauges read when stats are taken.
+    Callers keep `None` instead of an instance when instrumentation is off, so the cost then
+    is one truth test per stage.
+    """
+
+    def __init__(self, window=60):
+        """
+        :param window: seconds the rates are averaged over
+        """
+        self.window = window
+        self.start = time.time()
+        self.histograms = {}
+        self.rates = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(stage, Histogram())
+        histogram.observe(seconds)
+
+    def mark(self, name, n=1):
+        rate = self.rates.get(name)
+        if rate is None:
+            with self.lock:
+                rate = self.rates.setdefault(name, Rate(self.window))
+        rate.mark(n)
+
+    def gauge(self, name, fn):
+        """
+        :param fn: called without arguments by stats()
+        """
+        self.gauges[name] = fn
+
+    def stats(self):
+        gauges = {}
+        for name, fn in list(self.gauges.items()):
+            try:
+                gauges[name] = fn()
+            except Exception as e:
+                gauges[name] = repr(e)
+        return {"uptime": time.time() - self.start,
+                "stages": {name: i.snapshot() for name, i in list(self.histograms.items())},
+                "rates": {name: {"perSecond": i.per_second(), "total": i.total} for name, i in list(self.rates.items())},
+                "gauges": gauges}
+
+    def serve(self, port=0, host="127.0.0.1", stats=None):
+        """
+        Serve stats on a local-only HTTP endpoint: /json as JSON, any other path as text.
+        :param stats: fn returning the dict to serve, default self.stats
+        :return: the server, its port is server.server_address[1]; stop it with shutdown()
+        """
+        if host not in LOCAL_HOSTS:
+            raise ValueError('stats are only served on {}'.format(LOCAL_HOSTS))
+        stats = stats or self.stats
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') == '/json':
+                    body, contentType = json.dumps(stats(), default=str).encode(), 'application/json'
+                else:
+                    body, contentType = text(stats()).encode(), 'text/plain; charset=utf-8'
+                self.send_response(200)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, name='Metrics')
+        thread.setDaemon(True)
+        thread.start()
+        logger.info('Serve stats on http://{}:{}/'.format(host, server.server_address[1]))
+        return server
+
+
+def text(stats, prefix=''):
+    """
+    Flatten nested stats to "a.b.c value" lines.
+    """
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            lines.append(text(value, prefix + key + '.'))
+        elif isinstance(value, float):
+            lines.append('{}{} {:.6g}\n'.format(prefix, key, value))
+        else:
+            lines.append('{}{} {}\n'.format(prefix, key, value))
+    return ''.join(lines)
@@ -0,0 +1,252 @@
+import glob
+import os
+import re
+import sqlite3
+import stat
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from logging import getLogger
+from urllib.request import pathname2url
+from compress import register
+from dbhelper import apply_pragmas
+logger = getLogger('sql')
+
+PERIODS = {"day": "%Y%m%d", "month": "%Y%m", "year": "%Y"}
+ATTACHED = 10  # SQLITE_LIMIT_ATTACHED of a default build
+DML = re.compile(r'^\s*((?:INSERT|REPLACE|UPDATE)(?:\s+OR\s+\w+)?(?:\s+INTO)?\s+)(\w+)\b', re.IGNORECASE)
+ROUTED = re.compile(r'^(\s*(?:INSERT|REPLACE|UPDATE)(?:\s+OR\s+\w+)?(?:\s+INTO)?\s+)p\d+\.', re.IGNORECASE)
+
+
+def unroute(sql):
+    """
+    :return: the statement route() was given for a routed one, like INSERT INTO GroupMsgs
+             for INSERT INTO p202610.GroupMsgs
+    """
+    return ROUTED.sub(r'\1', sql, count=1)
+
+
+class Partitions:
+    """
+    Messages stored in one database file per period: <uin>-<YYYYMM>.db next to <uin>.db.
+    Writes go to the partition of the message's CreateTime, attached to the writer connection
+    on first use. Only the newest `writable` partitions stay attached; older ones are detached
+    and sealed read-only, so they can be archived or compressed on their own. Rows too old for
+    any writable partition stay in the main database, which every query includes.
+    A partition pushed out by a new one is sealed by a later writer task, after the rows
+    already routed to it; a row routed to it even later is written by reroute().
+    """
+
+    def __init__(self, db_dir, uin, tables, writer, create, period="month", writable=2,
+                 readOnly=True, profile=None):
+        """
+        :param db_dir: directory of <uin>.db
+        :param uin: user's uin
+        :param tables: names of the partitioned tables
+        :param writer: dbhelper.BatchWriter on <uin>.db
+        :param create: fn(db) creating the partitioned tables in a new partition
+        :param period: day/month/year
+        :param writable: partitions kept attached for writing, the others are sealed
+        :param readOnly: chmod sealed partitions read-only
+        :param profile: pragmas of the new partitions, see dbhelper.apply_pragmas
+        """
+        if period not in PERIODS:
+            raise ValueError('period must be one of {}'.format(tuple(PERIODS)))
+        self.dir = db_dir
+        self.uin = uin
+        self.tables = tuple(tables)
+        self.writer = writer
+        self.create = create
+        self.period = period
+        self.writable = max(int(writable), 1)
+        self.readOnly = readOnly
+        self.profile = profile
+        self.attached = set()
+        self.retiring = set()  # attached partitions to seal once the rows queued for them are written
+        self.sealed = set(i for i in self.keys() if not os.access(self.path(i), os.W_OK))
+        self.lock = threading.Lock()
+
+    def key(self, t):
+        return time.strftime(PERIODS[self.period], time.localtime(t))
+
+    def path(self, key):
+        return os.path.join(self.dir, '{}-{}.db'.format(self.uin, key))
+
+    def keys(self):
+        prefix = len(str(self.uin)) + 1
+        return sorted(os.path.basename(i)[prefix:-3] for i in glob.glob(self.path('*')))
+
+    def span(self, key):
+        """
+        :return: first second of the partition, first second of the next one
+        """
+        start = datetime.strptime(key, PERIODS[self.period])
+        if self.period == "day":
+            end = datetime.fromordinal(start.toordinal() + 1)
+        elif self.period == "month":
+            end = start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+        else:
+            end = start.replace(year=start.year + 1)
+        return time.mktime(start.timetuple()), time.mktime(end.timetuple())
+
+    def table(self, table, createTime=None):
+        """
+        :return: the name to write a row of table created at createTime to, like p202610.GroupMsgs
+        """
+        if table not in self.tables:
+            return table
+        key = self.key(createTime or time.time())
+        if key not in self.attached:
+            with self.lock:
+                if key not in self.writable_keys(key):
+                    return table
+                if key not in self.attached:
+                    self.writer.submit(lambda db: self._attach(db, key)).result()
+                    if self.retiring:  # not waited for, it runs after what is queued now
+                        self.writer.submit(self._retire)
+        return 'p{}.{}'.format(key, table)
+
+    def writable_keys(self, key=None):
+        """
+        :return: the newest `writable` partitions that are not sealed, counting key as existing
+        """
+        keys = (set(self.keys()) - self.sealed) | self.attached
+        if key is not None:
+            keys.add(key)
+        return sorted(keys)[-self.writable:]
+
+    def route(self, sql, createTime=None):
+        """
+        Rewrite the table of an INSERT/REPLACE/UPDATE statement to its partition.
+        """
+        match = DML.match(sql)
+        if match is None:
+            return sql
+        return sql[:match.start(2)] + self.table(match.group(2), createTime) + sql[match.end(2):]
+
+    def reroute(self, sql, createTime=None):
+        """
+        Route again a statement that failed as its partition was sealed meanwhile: to the
+        partition of createTime if it is attached, else to the main database. Never attaches,
+        so it may run on the writer.
+        """
+        sql = unroute(sql)
+        match = DML.match(sql)
+        if match is None or match.group(2) not in self.tables:
+            return sql
+        key = self.key(createTime or time.time())
+        table = 'p{}.{}'.format(key, match.group(2)) if key in self.attached else match.group(2)
+        return sql[:match.start(2)] + table + sql[match.end(2):]
+
+    def _attach(self, db, key):
+        path = self.path(key)
+        new = not os.path.exists(path)
+        _db = sqlite3.connect(path)
+        register(_db)
+        apply_pragmas(_db, self.profile)
+        self.create(_db)  # brings the schema of an existing partition up to date too
+        _db.close()
+        if new:
+            logger.info('Create partition {}'.format(path))
+        db.execute('ATTACH DATABASE ? AS p{}'.format(key), (path,))
+        if self.profile and self.profile.get("synchronous"):
+            db.execute('PRAGMA p{}.synchronous = {}'.format(key, self.profile["synchronous"]))
+        self.attached.add(key)
+        keep = self.writable_keys()
+        self.retiring.update(i for i in (set(self.keys()) - self.sealed) | self.attached if i not in keep)
+
+    def _retire(self, db):
+        keep = self.writable_keys()
+        for key in sorted(self.retiring):
+            if key not in keep:
+                self._seal(db, key)
+        self.retiring.clear()
+
+    def _seal(self, db, key):
+        if key in self.attached:
+            db.execute('DETACH DATABASE p{}'.format(key))
+            self.attached.discard(key)
+        path = self.path(key)
+        _db = sqlite3.connect(path)
+        _db.execute('PRAGMA journal_mode = DELETE')  # a read-only file can not keep a WAL
+        _db.close()
+        if self.readOnly:
+            os.chmod(path, os.stat(path).st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        self.sealed.add(key)
+        logger.info('Seal partition {}'.format(path))
+
+    def drop(self, key):
+        """
+        Delete the file of a sealed partition; run on the writer like _attach.
+        :return: True if it was deleted
+        """
+        if key not in self.sealed or key in self.attached:
+            return False
+        path = self.path(key)
+        for _path in (path, path + '-wal', path + '-shm', path + '-journal'):
+            if os.path.exists(_path):
+                os.remove(_path)
+        self.sealed.discard(key)
+        logger.info('Drop partition {}'.format(path))
+        return True
+
+    def overlapping(self, since=None, until=None):
+        """
+        :return: keys of the partitions holding rows with since <= CreateTime < until
+        """
+        keys = []
+        for key in self.keys():
+            start, end = self.span(key)
+            if (since is None or end > since) and (until is None or start < until):
+                keys.append(key)
+        return keys
+
+    def windows(self, since=None, until=None, size=None):
+        """
+        Split [since, until) into time ranges of at most size partitions each, newest first,
+        so a range overlapping more partitions than a connection can attach is read window by
+        window. The ranges do not overlap, the rows of main are bounded by them like the rest.
+        :param size: partitions per window, ATTACHED - 1 by default
+        :return: list of (since, until, keys) for connect()
+        """
+        size = max(int(size or ATTACHED - 1), 1)
+        keys = self.overlapping(since, until)[::-1]
+        if not keys:
+            return [(since, until, [])]
+        windows = []
+        for i in range(0, len(keys), size):
+            group = keys[i:i + size]
+            start = self.span(group[-1])[0] if i + size < len(keys) else since  # the last one takes older rows of main
+            windows.append((start if since is None or start is None else max(start, since), until, group))
+            until = start
+        return windows
+
+    @contextmanager
+    def connect(self, main, since=None, until=None, profile=None, keys=None):
+        """
+        A read-only connection to the main database with the partitions overlapping
+        [since, until) attached. Each partitioned table is shadowed by a temporary view
+        of the same name over main and those partitions, so queries need no change.
+        :param main: path of <uin>.db
+        :param keys: the partitions to attach instead, like a window of windows()
+        """
+        db = sqlite3.connect('file:{}?mode=ro'.format(pathname2url(main)), uri=True, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        register(db)
+        try:
+            apply_pragmas(db, profile, reader=True)
+            if keys is None:
+                keys = self.overlapping(since, until)
+            limit = db.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED) if hasattr(db, 'getlimit') else ATTACHED
+            if len(keys) > limit:
+                raise ValueError('{} partitions overlap the range, only {} can be attached, '
+                                 'see windows()'.format(len(keys), limit))
+            for key in keys:
+                db.execute('ATTACH DATABASE ? AS p{}'.format(key), ('file:{}?mode=ro'.format(pathname2url(self.path(key))),))
+            for table in self.tables:
+                db.execute('CREATE TEMP VIEW {0} AS SELECT * FROM main.{0}{1}'.format(
+                    table, ''.join(' UNION ALL SELECT * FROM p{}.{}'.format(key, table) for key in keys)))
+            yield db
+        finally:
+            db.close()
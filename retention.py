@@ -0,0 +1,187 @@
+import sqlite3
+import threading
+import time
+from logging import getLogger
+logger = getLogger('sql')
+
+# column holding the time of a row, CreateTime when missing
+TIME_COLUMNS = {"DeadLetters": "FailTime"}
+AUTO_VACUUM = ("NONE", "FULL", "INCREMENTAL")
+
+
+class Retention:
+    """
+    Deletes the rows older than the retention of their table in the background, then gives
+    the freed pages back with incremental_vacuum. Every batch is a task on the writer sized
+    to run about maxTime seconds, so saves are only ever delayed by one short batch.
+    Rows are walked in rowid order, which is the order messages are saved in, and a round
+    stops at the first batch holding no expired row, so it never scans the live rows.
+    With partitions, a sealed partition is deleted once every table in it has expired.
+    """
+
+    def __init__(self, writer, tables, partitions=None, interval=3600, batchSize=1000, maxTime=0.05,
+                 vacuumPages=256):
+        """
+        :param writer: dbhelper.BatchWriter
+        :param tables: days each table is kept, like {"SystemMsgs": 30, "GroupMsgs": 365}
+        :param partitions: partition.Partitions of the message tables or None
+        :param interval: seconds between two rounds
+        :param batchSize: rows examined by a batch at most
+        :param maxTime: seconds a batch should take, its size is adapted to it
+        :param vacuumPages: free pages given back per incremental_vacuum step
+        """
+        self.writer = writer
+        self.tables = dict(tables)
+        self.partitions = partitions
+        self.interval = interval
+        self.batchSize = max(int(batchSize), 1)
+        self.maxTime = maxTime
+        self.vacuumPages = max(int(vacuumPages), 1)
+        self.sizes = {}  # table: rows per batch, as adapted
+        self.warned = set()
+        self.metrics = {"rounds": 0, "deleted": 0, "vacuumed": 0, "dropped": 0, "lastRound": None}
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.stopEvent.clear()
+            self.thread = threading.Thread(target=self._loop, name='Retention')
+            self.thread.setDaemon(True)
+            self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def _loop(self):
+        while True:
+            try:
+                self.run()
+            except Exception:
+                logger.exception('Retention round failed')
+            if self.stopEvent.wait(self.interval):
+                break
+
+    def cutoff(self, table, now=None):
+        return round((now or time.time()) - self.tables[table] * 86400)
+
+    def run(self):
+        """
+        One round: delete the expired rows of every table, drop the expired partitions and
+        vacuum the freed pages.
+        :return: {table: rows deleted}
+        """
+        now = time.time()
+        result = {}
+        schemas = ['main']
+        if self.partitions:  # attached changes on the writer only
+            schemas += ['p' + key for key in self.writer.submit(lambda db: sorted(self.partitions.attached)).result()]
+        for table in self.tables:
+            result[table] = 0
+            for schema in schemas:
+                if schema != 'main' and table not in self.partitions.tables:
+                    continue
+                result[table] += self.expire(schema, table, self.cutoff(table, now))
+                if self.stopEvent.is_set():
+                    return result
+        if self.partitions:
+            self.metrics["dropped"] += self.drop_partitions(now)
+        for schema in schemas:
+            self.vacuum(schema)
+        self.metrics["rounds"] += 1
+        self.metrics["lastRound"] = round(now)
+        if any(result.values()):
+            logger.info('Retention: {}'.format(', '.join('{} -{}'.format(*i) for i in result.items())))
+        return result
+
+    def expire(self, schema, table, cutoff):
+        """
+        Delete the rows of schema.table older than cutoff, batch by batch.
+        :return: rows deleted
+        """
+        column = TIME_COLUMNS.get(table, "CreateTime")
+        select = 'SELECT rowid, {} FROM {}.{} WHERE rowid > ? ORDER BY rowid LIMIT ?'.format(column, schema, table)
+        delete = 'DELETE FROM {}.{} WHERE rowid = ?'.format(schema, table)
+
+        def batch(db, last, size):
+            try:
+                rows = db.execute(select, (last, size)).fetchall()
+            except sqlite3.OperationalError as e:  # a table missing in this database
+                if 'no such table' not in str(e):
+                    raise
+                return None, 0
+            if not rows:
+                return None, 0
+            expired = [(rowid,) for rowid, t in rows if t is not None and t < cutoff]
+            if expired:
+                with db:
+                    db.executemany(delete, expired)
+            return rows[-1][0], len(expired)
+
+        deleted, last = 0, 0
+        while not self.stopEvent.is_set():
+            size = self.sizes.get(table, min(100, self.batchSize))
+            start = time.perf_counter()
+            last, count = self.writer.submit(lambda db: batch(db, last, size)).result()
+            self.sizes[table] = self._adapt(size, time.perf_counter() - start)
+            deleted += count
+            if last is None or not count:
+                break
+        self.metrics["deleted"] += deleted
+        return deleted
+
+    def _adapt(self, size, elapsed):
+        if elapsed > self.maxTime:
+            return max(size // 2, 1)
+        if elapsed < self.maxTime / 2:
+            return min(size * 2, self.batchSize)
+        return size
+
+    def drop_partitions(self, now):
+        """
+        Delete the sealed partitions whose every table has expired.
+        :return: number of partitions deleted
+        """
+        if any(table not in self.tables for table in self.partitions.tables):
+            return 0
+        cutoff = min(self.cutoff(table, now) for table in self.partitions.tables)
+        dropped = 0
+        for key in self.partitions.keys():
+            if key in self.partitions.sealed and self.partitions.span(key)[1] <= cutoff:
+                if self.writer.submit(lambda db: self.partitions.drop(key)).result():
+                    dropped += 1
+        return dropped
+
+    def vacuum(self, schema='main'):
+        """
+        Give the free pages of schema back to the file system, vacuumPages per writer task.
+        :return: pages given back
+        """
+        def step(db):
+            mode = db.execute('PRAGMA {}.auto_vacuum'.format(schema)).fetchone()[0]
+            free = db.execute('PRAGMA {}.freelist_count'.format(schema)).fetchone()[0]
+            if not free:
+                return 0
+            if AUTO_VACUUM[mode] != "INCREMENTAL":
+                if schema not in self.warned:
+                    self.warned.add(schema)
+                    logger.warning('auto_vacuum of {} is {}, its {} free pages are reused but the file does not '
+                                   'shrink; "python dbhelper.py <uin>.db vacuum" switches it to INCREMENTAL'.format(
+                                       schema, AUTO_VACUUM[mode], free))
+                return 0
+            db.execute('PRAGMA {}.incremental_vacuum({})'.format(schema, self.vacuumPages)).fetchall()
+            return free - db.execute('PRAGMA {}.freelist_count'.format(schema)).fetchone()[0]
+
+        vacuumed = 0
+        while not self.stopEvent.is_set():
+            pages = self.writer.submit(step).result()
+            if not pages:
+                break
+            vacuumed += pages
+        self.metrics["vacuumed"] += vacuumed
+        return vacuumed
+
@@ -0,0 +1,199 @@
+"""
+MsgStats: the number of messages saved per day, table, chat, sender and MsgType, kept up
+to date by the save path so dashboards read a few rows per day and chat instead of
+grouping every message. Rows of an existing database are counted by backfill(), see
+"python dbhelper.py <uin>.db msg-stats".
+"""
+import re
+import sqlite3
+import threading
+import time
+from logging import getLogger
+from sqlhelper import MAX_VARIABLES, sqlitehelper
+logger = getLogger('sql')
+
+# message table: the column of the chat
+CHAT_COLUMNS = {"FriendMsgs": "User", "GroupMsgs": "ChatRoom", "MpMsgs": "NickName"}
+# Chat and Sender are never NULL, NULLs would never conflict in the primary key
+MSG_STATS_TABLE = {
+    "columns": ("Day INT(8) NOT NULL --local date like 20261018\n",
+                "Source VARCHAR NOT NULL --the message table\n",
+                "Chat VARCHAR NOT NULL DEFAULT ''",
+                "Sender VARCHAR NOT NULL DEFAULT '' --FromUser of the message\n",
+                "MsgType INT(2) NOT NULL DEFAULT 0",
+                "Count INT NOT NULL"),
+    "primary_key": ("Day", "Source", "Chat", "Sender", "MsgType"),
+    "indexes": (("Source", "Chat", "Day"),)
+}
+GROUPS = ("Day", "Source", "Chat", "Sender", "MsgType")
+UPSERT_STATS = sqlitehelper.upsert("MsgStats", GROUPS + ("Count",), GROUPS, {"Count": "Count + excluded.Count"})
+# the message table of an INSERT, also when routed to a partition like p202610.GroupMsgs
+INSERT = re.compile(r'^\s*(?:INSERT|REPLACE)(?:\s+OR\s+\w+)?\s+INTO\s+(?:\w+\.)?(\w+)\b', re.IGNORECASE)
+# the local date of CreateTime as Day, the same as day()
+SQL_DAY = "CAST(strftime('%Y%m%d', CreateTime, 'unixepoch', 'localtime') AS INT)"
+
+
+class MsgStats:
+    """
+    Counts of the saved messages accumulated in memory and added to MsgStats every interval
+    seconds with one multi-row upsert on the writer. Messages are counted by written(), the
+    commitCallback of the writer, so only rows that were committed count.
+    """
+
+    def __init__(self, writer, interval=10):
+        """
+        :param writer: dbhelper.BatchWriter
+        :param interval: seconds between two flushes
+        """
+        self.writer = writer
+        self.interval = interval
+        self.counts = {}  # (Day, Source, Chat, Sender, MsgType): Count
+        self.span = (0, 0, 0)  # first second of the last day seen, first second of the next, the day
+        self.metrics = {"flushes": 0, "rows": 0}
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.stopEvent.clear()
+            self.thread = threading.Thread(target=self._loop, name='MsgStats')
+            self.thread.setDaemon(True)
+            self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+        self.flush()
+
+    def _loop(self):
+        while not self.stopEvent.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Saving the message statistics failed')
+
+    def day(self, createTime):
+        """
+        Like day(), the last day is kept so the messages of a day convert their time once.
+        """
+        start, end, _day = self.span
+        if not start <= createTime < end:
+            t = time.localtime(createTime)
+            start = time.mktime(t[:3] + (0, 0, 0, 0, 0, -1))
+            end = time.mktime(t[:2] + (t[2] + 1, 0, 0, 0, 0, 0, -1))
+            _day = t.tm_year * 10000 + t.tm_mon * 100 + t.tm_mday
+            self.span = start, end, _day
+        return _day
+
+    def add(self, table, args):
+        """
+        Count a message row of table.
+        :param args: the row, (MsgId, CreateTime, chat, FromUser, MsgType, ...)
+        """
+        if table not in CHAT_COLUMNS:
+            return
+        key = (self.day(args[1] or 0), table, _text(args[2]), _text(args[3]), args[4] or 0)
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def written(self, rows):
+        """
+        Count the messages among rows committed by the writer.
+        :param rows: [(sql, args, msg), ...]
+        """
+        for sql, args, _ in rows:
+            match = INSERT.match(sql)
+            if match and isinstance(args, (tuple, list)):
+                self.add(match.group(1), args)
+
+    def flush(self):
+        """
+        Add the counts accumulated so far to MsgStats, the rows pending on the writer included.
+        :return: number of rows upserted
+        """
+        if not self.writer.alive:  # a task submitted now would never run
+            with self.lock:
+                if self.counts:
+                    logger.warning('The writer is closed, the counts of {} rows are lost'.format(len(self.counts)))
+                self.counts = {}
+            return 0
+        return self.writer.submit(self._write).result()
+
+    def _write(self, db):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        if not counts:
+            return 0
+        try:
+            write(db, counts)
+        except Exception:
+            with self.lock:  # counted again on the next flush
+                for key, count in counts.items():
+                    self.counts[key] = self.counts.get(key, 0) + count
+            raise
+        self.metrics["flushes"] += 1
+        self.metrics["rows"] += len(counts)
+        return len(counts)
+
+    def info(self):
+        with self.lock:
+            return dict(self.metrics, pending=len(self.counts))
+
+
+def day(createTime):
+    """
+    :return: the local date of createTime as an int like 20261018, the Day of MsgStats
+    """
+    return int(time.strftime('%Y%m%d', time.localtime(createTime)))
+
+
+def write(db, counts):
+    """
+    :param counts: {(Day, Source, Chat, Sender, MsgType): Count}
+    """
+    limit = db.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER) if hasattr(db, 'getlimit') else MAX_VARIABLES
+    with db:
+        for sql, params in sqlitehelper.bulk(UPSERT_STATS, [key + (count,) for key, count in counts.items()], limit):
+            db.execute(sql, params)
+
+
+def backfill(db, tables=tuple(CHAT_COLUMNS), schemas=('main',), reset=True):
+    """
+    Count the stored messages of tables into MsgStats, created when missing.
+    :param db: a connection of the database holding MsgStats, with schemas attached
+    :param schemas: the schemas whose tables are counted, like main and partitions
+    :param reset: delete the counts of tables first, so counting twice does not add up
+    :return: number of messages in MsgStats for tables
+    """
+    tables = tuple(tables)
+    if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'MsgStats'").fetchone() is None:
+        db.execute(sqlitehelper.create_table("MsgStats", MSG_STATS_TABLE["columns"],
+                                             primary_key=MSG_STATS_TABLE["primary_key"]))
+        for index in MSG_STATS_TABLE["indexes"]:
+            db.execute(sqlitehelper.create_index("MsgStats", index))
+    sources = ', '.join('?' * len(tables))
+    with db:
+        if reset:
+            db.execute("DELETE FROM MsgStats WHERE Source IN ({})".format(sources), tables)
+        for schema in schemas:
+            for table in tables:
+                if db.execute("SELECT 1 FROM {}.sqlite_master WHERE name = ?".format(schema), (table,)).fetchone() is None:
+                    continue
+                # WHERE true tells the parser ON CONFLICT is an upsert and not a join constraint
+                db.execute("INSERT INTO MsgStats ({}) SELECT {}, ?, IFNULL({}, ''), IFNULL(FromUser, ''), "
+                           "IFNULL(MsgType, 0), count(*) FROM {}.{} WHERE true GROUP BY 1, 3, 4, 5 "
+                           "ON CONFLICT({}) DO UPDATE SET Count = Count + excluded.Count".format(
+                               ', '.join(GROUPS + ("Count",)), SQL_DAY, CHAT_COLUMNS[table], schema, table,
+                               ', '.join(GROUPS)), (table,))
+    counted = db.execute("SELECT IFNULL(sum(Count), 0) FROM MsgStats WHERE Source IN ({})".format(sources),
+                         tables).fetchone()[0]
+    logger.info('Counted {} messages into MsgStats'.format(counted))
+    return counted
+
+
+def _text(value):
+    return '' if value is None else value
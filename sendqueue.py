@@ -0,0 +1,238 @@
+import threading
+import time
+from collections import deque, namedtuple
+from logging import getLogger
+logger = getLogger('itchat')
+
+# prefixes itchat's Core.send reads as file, picture, text and video
+MEDIA_PREFIXES = ('@fil@', '@img@', '@vid@')
+TEXT_PREFIX = '@msg@'
+# seconds between two sweeps of the buckets of idle recipients
+PRUNE_INTERVAL = 60
+
+Item = namedtuple("Item", ("msg", "mediaId", "queued", "attempts"))
+
+
+class TokenBucket:
+    """
+    rate tokens a second up to burst; a rate of 0 is unlimited.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def delay(self, now):
+        """
+        :return: seconds until a token is available
+        """
+        if not self.rate:
+            return 0
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
+
+    def full(self, now):
+        """
+        :return: True if the bucket has refilled, so a new one would behave the same
+        """
+        return not self.rate or self.tokens + (now - self.last) * self.rate >= self.burst
+
+
+class SendQueue:
+    """
+    Outgoing messages sent by worker threads, so producing a reply never waits on the network.
+    Sends are paced by a global and a per-recipient token bucket; the messages of one recipient
+    go out one at a time in order, texts waiting for the same recipient are joined into one send,
+    and a failed send is retried with exponential backoff.
+    """
+
+    def __init__(self, send, workers=2, queueSize=1000, rate=5, burst=10, chatRate=1, chatBurst=3,
+                 coalesce=True, maxLength=2000, retries=3, backoff=1, maxBackoff=30, metrics=None):
+        """
+        :param send: fn(msg, toUserName, mediaId) -> truthy on success, like Core.send
+        :param workers: number of threads
+        :param queueSize: messages waiting at most, put() blocks beyond
+        :param rate: sends per second of the account, 0 is unlimited
+        :param burst: sends the account may make at once
+        :param chatRate: sends per second to one recipient, 0 is unlimited
+        :param chatBurst: sends one recipient may get at once
+        :param coalesce: join the texts waiting for a recipient with newlines
+        :param maxLength: characters of a joined text at most
+        :param retries: attempts after the first one before a message is given up
+        :param backoff: seconds before the first retry, doubled up to maxBackoff
+        :param metrics: metrics.Metrics observing "sendLatency", from put() to delivery
+        """
+        self.send = send
+        self.queueSize = max(int(queueSize), 1)
+        self.bucket = TokenBucket(rate, burst)
+        self.chatRate = chatRate
+        self.chatBurst = chatBurst
+        self.coalesce = coalesce
+        self.maxLength = maxLength
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.latency = metrics
+        self.pending = {}  # toUserName: deque of Item
+        self.buckets = {}  # toUserName: TokenBucket, dropped by _prune once idle and full again
+        self.pruned = time.monotonic()
+        self.notBefore = {}  # toUserName: monotonic time of the next retry
+        self.ready = deque()  # recipients having pending messages and no send running
+        self.size = 0
+        self.alive = True
+        self.metrics = {"sent": 0, "coalesced": 0, "retried": 0, "failed": 0}
+        lock = threading.Lock()
+        self.work = threading.Condition(lock)
+        self.space = threading.Condition(lock)
+        self.threads = []
+        for i in range(max(int(workers), 1)):
+            thread = threading.Thread(target=self._loop, name='Sender-{}'.format(i))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, msg, toUserName, mediaId=None):
+        with self.work:
+            while self.size >= self.queueSize and self.alive:
+                self.space.wait()
+            if not self.alive:
+                raise RuntimeError('SendQueue is closed')
+            queue = self.pending.get(toUserName)
+            if queue is None:
+                queue = self.pending[toUserName] = deque()
+                self.ready.append(toUserName)
+                self.work.notify()
+            queue.append(Item(msg, mediaId, time.monotonic(), 0))
+            self.size += 1
+
+    def _next(self):
+        """
+        Take the next batch a recipient may be sent, waiting for its tokens.
+        :return: (toUserName, [Item]), None once closed and drained
+        """
+        with self.work:
+            while True:
+                if not self.pending and not self.alive:
+                    return None
+                now = time.monotonic()
+                if now - self.pruned >= PRUNE_INTERVAL:
+                    self._prune(now)
+                wait = self.bucket.delay(now)
+                if not wait:
+                    waits = []
+                    for toUserName in self.ready:
+                        bucket = self.buckets.get(toUserName)
+                        if bucket is None:
+                            bucket = self.buckets[toUserName] = TokenBucket(self.chatRate, self.chatBurst)
+                        _wait = max(bucket.delay(now), self.notBefore.get(toUserName, 0) - now)
+                        if _wait <= 0:
+                            self.ready.remove(toUserName)
+                            self.bucket.take()
+                            bucket.take()
+                            return toUserName, self._batch(self.pending[toUserName])
+                        waits.append(_wait)
+                    wait = min(waits, default=None)
+                self.work.wait(wait)
+
+    def _prune(self, now):
+        """
+        Drop the buckets of the recipients with nothing pending whose bucket has refilled.
+        """
+        self.pruned = now
+        for toUserName in [i for i, bucket in self.buckets.items() if i not in self.pending and bucket.full(now)]:
+            del self.buckets[toUserName]
+
+    def _batch(self, queue):
+        item = queue.popleft()
+        batch = [item]
+        if self.coalesce and _text(item) is not None:
+            length = len(_text(item))
+            while queue and _text(queue[0]) is not None and length + 1 + len(_text(queue[0])) <= self.maxLength:
+                length += 1 + len(_text(queue[0]))
+                batch.append(queue.popleft())
+        return batch
+
+    def _loop(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            toUserName, batch = task
+            if len(batch) > 1:
+                msg, mediaId = TEXT_PREFIX + '\n'.join(_text(i) for i in batch), None
+            else:
+                msg, mediaId = batch[0].msg, batch[0].mediaId
+            try:
+                ok = self.send(msg, toUserName, mediaId)
+            except Exception as e:
+                logger.warning('Sending to {} failed: {!r}'.format(toUserName, e))
+                ok = False
+            now = time.monotonic()
+            with self.work:
+                queue = self.pending.get(toUserName)
+                if queue is None:  # dropped by close()
+                    continue
+                if ok:
+                    self.size -= len(batch)
+                    self.space.notify_all()
+                    self.notBefore.pop(toUserName, None)
+                    self.metrics["sent"] += 1
+                    self.metrics["coalesced"] += len(batch) - 1
+                    if self.latency:
+                        for item in batch:
+                            self.latency.observe("sendLatency", now - item.queued)
+                elif batch[0].attempts < self.retries:
+                    self.metrics["retried"] += 1
+                    queue.extendleft(reversed([i._replace(attempts=i.attempts + 1) for i in batch]))
+                    self.notBefore[toUserName] = now + min(self.backoff * 2 ** batch[0].attempts, self.maxBackoff)
+                else:
+                    self.size -= len(batch)
+                    self.space.notify_all()
+                    self.notBefore.pop(toUserName, None)
+                    self.metrics["failed"] += len(batch)
+                    logger.warning('Give up sending {} message(s) to {}'.format(len(batch), toUserName))
+                if queue:
+                    self.ready.append(toUserName)
+                else:
+                    del self.pending[toUserName]
+                self.work.notify_all()
+
+    def info(self):
+        with self.work:
+            return dict(self.metrics, pending=self.size, recipients=len(self.pending), buckets=len(self.buckets))
+
+    def close(self, timeout=None):
+        """
+        Stop accepting messages and send what is pending within timeout seconds; messages
+        still pending then are dropped.
+        """
+        with self.work:
+            self.alive = False
+            self.work.notify_all()
+            self.space.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        with self.work:
+            if self.size:
+                logger.warning('Drop {} unsent message(s)'.format(self.size))
+            self.pending.clear()
+            self.ready.clear()
+            self.size = 0
+            self.work.notify_all()
+
+
+def _text(item):
+    """
+    :return: the text of a plain text message, None for media
+    """
+    if item.mediaId is not None or not isinstance(item.msg, str) or item.msg[:5] in MEDIA_PREFIXES:
+        return None
+    return item.msg[5:] if item.msg[:5] == TEXT_PREFIX else item.msg
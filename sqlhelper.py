@@ -1,50 +1,228 @@
-from collections import Iterable
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from collections.abc import Iterable
+from functools import lru_cache, wraps
+from itertools import chain
 from logging import getLogger
 logger = getLogger('sql')
 
+# host parameters one statement may bind, SQLITE_MAX_VARIABLE_NUMBER of the default build
+MAX_VARIABLES = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+# operators of a range condition like {"CreateTime": {">=": since, "<": until}}
+OPERATORS = ("=", "!=", "<>", "<", "<=", ">", ">=", "LIKE", "GLOB")
+CONFLICTS = ("ROLLBACK", "ABORT", "FAIL", "IGNORE", "REPLACE")
+# the row of a single-row INSERT, followed by an optional upsert clause
+VALUES = re.compile(r'\bVALUES\s*(\(\s*\?(?:\s*,\s*\?)*\s*\))', re.IGNORECASE)
+
+
+class SqlCache:
+    """
+    Bounded LRU of generated statements keyed on the normalized arguments of the builder.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = max(int(maxsize), 1)
+        self.data = OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            _sql = self.data.get(key)
+            if _sql is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.data.move_to_end(key)
+            return _sql
+
+    def put(self, key, _sql):
+        with self.lock:
+            self.data[key] = _sql
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.data), "maxsize": self.maxsize}
+
+
+def _freeze(value):
+    """
+    Hashable key for a builder argument; iterables keep their iteration order because
+    it decides the order of the generated columns.
+    """
+    if isinstance(value, str) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return type(value), value
+    if isinstance(value, dict):
+        return dict, tuple((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, Iterable):
+        return type(value), tuple(_freeze(v) for v in value)
+    hash(value)
+    return value
+
+
+def _memoized(fn):
+    @wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        cache = self.cache
+        if cache is None:
+            return fn(self, *args, **kwargs)
+        try:
+            key = fn.__name__, _freeze(args), _freeze(sorted(kwargs.items()))
+        except TypeError:
+            return fn(self, *args, **kwargs)
+        _sql = cache.get(key)
+        if _sql is None:
+            _sql = fn(self, *args, **kwargs)
+            cache.put(key, _sql)
+        return _sql
+    return wrapper
+
+
+class _Where(tuple):
+    """
+    Shape of a dict condition: (column, spec) pairs, spec being "=" for a value, None for
+    IS NULL, the length of an IN list or the operators of a range. Statements are built and
+    memoized from the shape only, so every value of a column shares one statement.
+    """
+
+
+def _shape(condition):
+    shape = []
+    for column, value in condition.items():
+        if value is None:
+            spec = None
+        elif isinstance(value, dict):
+            spec = tuple(op.strip().upper() for op in value)
+            for op in spec:
+                if op not in OPERATORS:
+                    raise ValueError('Unknown operator {!r} of column {}'.format(op, column))
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            spec = len(value)
+        else:
+            spec = '='
+        shape.append((column, spec))
+    return _Where(shape)
+
+
+def _params(condition):
+    """
+    :return: the values of a dict condition in the order of its placeholders
+    """
+    params = []
+    for value in condition.values():
+        if value is None:
+            continue
+        if isinstance(value, dict):
+            params.extend(value.values())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            params.extend(value)
+        else:
+            params.append(value)
+    return params
+
+
+def _condition(condition, logic='and'):
+    """
+    :return: the condition as sql without "WHERE"
+    """
+    if isinstance(condition, str):
+        condition = condition.strip()
+        if condition.lower().startswith('where '):
+            condition = condition[6:].strip()
+        return condition
+    if not isinstance(condition, Iterable):
+        raise TypeError('Arg Condition Must str or Iterable')
+    join = ' ' + logic.upper() + ' '
+    if not isinstance(condition, _Where):
+        return join.join('='.join((i, '?')) for i in condition)
+    parts = []
+    for column, spec in condition:
+        if spec is None:
+            parts.append('{} IS NULL'.format(column))
+        elif spec == '=':
+            parts.append('{} = ?'.format(column))
+        elif isinstance(spec, int):
+            parts.append('{} IN ({})'.format(column, ', '.join('?' * spec)))
+        else:
+            _range = ' AND '.join('{} {} ?'.format(column, op) for op in spec)
+            parts.append('({})'.format(_range) if len(spec) > 1 and len(condition) > 1 else _range)
+    return join.join(parts)
+
+
+@lru_cache(maxsize=64)
+def _expand(sql, rows):
+    match = VALUES.search(sql)
+    return sql[:match.start(1)] + ', '.join([match.group(1)] * rows) + sql[match.end(1):]
+
 
 # _rowid_
 class SqliteHelper:
+    """
+    Builds the statements; each instance keeps its own statement cache, so bots of one
+    process configure theirs independently.
+    """
     show_tables = '''SELECT name FROM sqlite_master WHERE type="table" ORDER BY name'''
 
-    @staticmethod
-    def select(table_name, column='', condition='', limit='', order='',  **kwargs):
+    def __init__(self, cache=0):
+        """
+        :param cache: number of generated statements to memoize, 0 is off
+        """
+        self.cache: SqlCache = SqlCache(cache) if cache else None
+
+    def enable_cache(self, maxsize=256):
+        """
+        Memoize the generated statements; off by default.
+        :param maxsize: number of statements kept, least recently used are evicted
+        """
+        self.cache = SqlCache(maxsize)
+
+    def disable_cache(self):
+        self.cache = None
+
+    def cache_info(self):
+        return self.cache.info() if self.cache else None
+
+    def select(self, table_name, column='', condition='', limit='', order='', **kwargs):
         """
         :param table_name: str like "sqlite_master"
         :param column: the column_name you want to query; str: name or
                         iterable tuple/list/set and element is str
                         Do not need "where"
         :param condition: str like "type=table";
-                          dict like {"type": "table"};
+                          dict like {"type": "table"} is bound as parameters: a list/tuple/set value
+                          makes IN (...), a dict value like {">=": 1, "<": 9} a range, None IS NULL;
                           ["type"] or ("type",) will generate type=?
         :param limit: int or int string
         :param order: order by column :str column name
         :param kwargs:
                      logic: and/or apply in condition's logic; default: and
                      desc: Boolean missing is ASC True is DESC
-        :return: sql
+                     group: GROUP BY column(s), str or Iterable
+        :return: sql, or (sql, params) when condition is a dict
         """
+        if isinstance(condition, dict):
+            return self._select(table_name, column, _shape(condition), limit, order, **kwargs), \
+                _params(condition)
+        return self._select(table_name, column, condition, limit, order, **kwargs)
+
+    @_memoized
+    def _select(self, table_name, column='', condition='', limit='', order='', **kwargs):
         if column:
             column = column if isinstance(column, str) else ', '.join(column)
         else:
             column = '*'
         if condition:
-            if isinstance(condition, str):
-                condition = condition.strip()
-                if condition.lower().startswith('where '):
-                    condition = condition.split('where ', 1)[-1].split()
-            elif isinstance(condition, Iterable):
-                join = ' ' + kwargs.get('logic', 'and').upper() + ' '
-                if isinstance(condition, dict):
-                    condition = join.join(('='.join((i, '"{}"'.format(v) if isinstance(v, str) else str(v)))
-                                           for i, v in condition.items()))
-                else:
-                    condition = join.join('='.join((i, '?')) for i in condition)
-            else:
-                raise TypeError('Arg Condition Must str or Iterable')
-            condition = ' WHERE ' + condition
+            condition = ' WHERE ' + _condition(condition, kwargs.get('logic', 'and'))
         else:
             condition = ''
+        group = kwargs.get('group')
+        if group:
+            condition += ' GROUP BY ' + (group.strip() if isinstance(group, str) else ', '.join(group))
         if limit:
             limit = ' LIMIT {}'.format(int(limit))
         else:
@@ -56,11 +234,11 @@ class SqliteHelper:
         else:
             order = ''
         _sql = '''SELECT {} FROM {}'''.format(column, table_name) + condition + order + limit
-        logger.info(_sql)
+        logger.debug(_sql)
         return _sql
 
-    @staticmethod
-    def create_table(table_name, column, **kwargs):
+    @_memoized
+    def create_table(self, table_name, column, **kwargs):
         """
         :param table_name: str
         :param column: str: "id INT AUTOINCREMENT PRIMARY KEY, UserName CHAR"
@@ -93,19 +271,43 @@ class SqliteHelper:
         else:
             other = ''
         _sql = '''CREATE TABLE {} ({})'''.format(table_name, column + other)
-        logger.info(_sql)
+        logger.debug(_sql)
         return _sql
 
-    @staticmethod
-    def insert(table_name, column):
+    @_memoized
+    def create_index(self, table_name, column, index_name='', unique=False):
+        """
+        :param table_name: str
+        :param column: str: "User, CreateTime" or Iterable like ("User", "CreateTime")
+        :param index_name: default is table_name and columns joined by "_"
+        :param unique: create a UNIQUE index
+        :return: sql, "IF NOT EXISTS" makes it safe to run every time
+        """
+        if isinstance(column, str):
+            column = [i.strip() for i in column.split(',')]
+        index_name = index_name or '_'.join([table_name] + [i.split()[0] for i in column])
+        _sql = '''CREATE {}INDEX IF NOT EXISTS {} ON {} ({})'''.format(
+            'UNIQUE ' if unique else '', index_name, table_name, ', '.join(column))
+        logger.debug(_sql)
+        return _sql
+
+    @_memoized
+    def insert(self, table_name, column, conflict=''):
         """
         :param table_name:
-        :param column:
+        :param column: int number of columns, str "a, b" or Iterable of column names
+        :param conflict: IGNORE/REPLACE/... makes INSERT OR IGNORE/REPLACE/...
         :return:
         """
+        if conflict:
+            if conflict.upper() not in CONFLICTS:
+                raise ValueError('conflict must be one of {}'.format(CONFLICTS))
+            verb = 'INSERT OR {} INTO'.format(conflict.upper())
+        else:
+            verb = 'INSERT INTO'
         if isinstance(column, int):
             values = ', '.join('?'*column)
-            _sql = '''INSERT INTO {} VALUES ({})'''.format(table_name, values)
+            _sql = '''{} {} VALUES ({})'''.format(verb, table_name, values)
         else:
             if isinstance(column, str):
                 column = column.strip()
@@ -113,20 +315,71 @@ class SqliteHelper:
             else:
                 values = len(column)
                 column = ', '.join(_ for _ in column)
-            _sql = '''INSERT INTO {} ({}) VALUES ({})'''.format(
-                table_name, column, ", ".join('?'*values))
-        logger.info(_sql)
+            _sql = '''{} {} ({}) VALUES ({})'''.format(
+                verb, table_name, column, ", ".join('?'*values))
+        logger.debug(_sql)
+        return _sql
+
+    @_memoized
+    def upsert(self, table_name, column, key, update=None):
+        """
+        :param column: str "a, b" or Iterable of column names, as insert
+        :param key: the column(s) of the PRIMARY KEY or UNIQUE constraint that conflicts
+        :param update: the columns set from the new row when key exists, default all but key;
+                       dict like {"Count": "Count + excluded.Count"} of sql expressions;
+                       empty makes DO NOTHING
+        :return: sql inserting a row or updating the existing row of key
+        """
+        key = [i.strip() for i in key.split(',')] if isinstance(key, str) else list(key)
+        columns = [i.strip() for i in column.split(',')] if isinstance(column, str) else list(column)
+        if update is None:
+            update = [i for i in columns if i not in key]
+        elif isinstance(update, str):
+            update = [i.strip() for i in update.split(',')]
+        if isinstance(update, dict):
+            action = 'DO UPDATE SET ' + ', '.join(' = '.join(i) for i in update.items())
+        elif update:
+            action = 'DO UPDATE SET ' + ', '.join('{0} = excluded.{0}'.format(i) for i in update)
+        else:
+            action = 'DO NOTHING'
+        _sql = '{} ON CONFLICT({}) {}'.format(self.insert(table_name, columns), ', '.join(key), action)
+        logger.debug(_sql)
         return _sql
 
     @staticmethod
-    def update(table_name, column, condition, **kwargs):
+    def bulk(sql, rows, limit=MAX_VARIABLES):
+        """
+        Split rows of a single-row INSERT, like those of insert and upsert, into multi-row
+        VALUES statements binding at most limit parameters each.
+        :param sql: statement with one VALUES (?, ...) row
+        :param rows: sequences of parameters
+        :param limit: host parameters a statement may bind, see db.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+        :return: generator of (sql, params)
+        """
+        match = VALUES.search(sql)
+        if match is None:
+            raise ValueError('No single-row VALUES in {}'.format(sql))
+        size = max(limit // match.group(1).count('?'), 1)
+        rows = rows if isinstance(rows, list) else list(rows)
+        for i in range(0, len(rows), size):
+            chunk = rows[i:i + size]
+            yield _expand(sql, len(chunk)), list(chain.from_iterable(chunk))
+
+    def update(self, table_name, column, condition, **kwargs):
         """
         :param table_name:
-        :param column:
-        :param condition:
-        :param kwargs:
-        :return:
+        :param column: str "a = ?"; dict like {"a": "a + 1"} of sql expressions;
+                       tuple/list of names will generate a = ?
+        :param condition: as select
+        :param kwargs: logic: and/or apply in condition's logic; default: and
+        :return: sql, or (sql, params) when condition is a dict, params following the ones of column
         """
+        if isinstance(condition, dict):
+            return self._update(table_name, column, _shape(condition), **kwargs), _params(condition)
+        return self._update(table_name, column, condition, **kwargs)
+
+    @_memoized
+    def _update(self, table_name, column, condition, **kwargs):
         if isinstance(column, str):
             pass
         elif isinstance(column, dict):
@@ -135,24 +388,10 @@ class SqliteHelper:
             column = ', '.join(' = '.join((i, "?")) for i in column)
         else:
             raise TypeError()
-        if isinstance(condition, str):
-            condition = condition.strip()
-            if condition.lower().startswith('where '):
-                condition = condition.split('where ', 1)[-1].split()
-        elif isinstance(condition, Iterable):
-            join = ' ' + kwargs.get('logic', 'and').upper() + ' '
-            if isinstance(condition, dict):
-                condition = join.join(('='.join((i, '"{}"'.format(v) if isinstance(v, str) else str(v)))
-                                       for i, v in condition.items()))
-            else:
-                condition = join.join('='.join((i, '?')) for i in condition)
-        else:
-            raise TypeError('Arg Condition Must str or Iterable')
-        _sql = "UPDATE {} SET {} WHERE {}".format(table_name, column, condition)
-        logger.info(_sql)
+        _sql = "UPDATE {} SET {} WHERE {}".format(table_name, column, _condition(condition, kwargs.get('logic', 'and')))
+        logger.debug(_sql)
         return _sql
 
-
 sqlitehelper = SqliteHelper()
 #
 # if __name__ == '__main__':
@@ -0,0 +1,261 @@
+"""
+Runs many accounts from one config file, spread over a pool of worker processes:
+
+    python supervisor.py accounts.json
+
+{"workers": 4,                 # processes, default the number of cores
+ "baseDir": "accounts",        # workDir of an account defaults to baseDir/name
+ "restartDelay": 5,            # seconds before restarting a logged out account, doubled up to maxRestartDelay
+ "maxRestartDelay": 300,
+ "statsInterval": 10,          # seconds between two reports of an account to the supervisor
+ "shutdownTimeout": 60,
+ "metricsPort": 8900,          # serve the stats of every account on 127.0.0.1, see metrics.Metrics.serve
+ "logging": {"rate": 5},       # loghelper.LogPipeline of each worker process
+ "accounts": [{"name": "alice", "setting": {...}, "login": {"hotReload": true, "enableCmdQR": 2}}]}
+
+"setting" is passed to Bot, "login" to Bot.auto_login.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from queue import Empty
+from loghelper import LogPipeline
+from metrics import Metrics
+logger = logging.getLogger('itchat')
+
+OPTIONS = {"workers": None, "baseDir": "accounts", "restartDelay": 5, "maxRestartDelay": 300,
+           "statsInterval": 10, "shutdownTimeout": 60, "metricsPort": None, "logging": None}
+
+
+class Account:
+    """
+    Keeps one Bot logged in on a thread of a worker process: logs in, runs it, reports its
+    stats and starts a new Bot with exponential backoff when it logs out or fails.
+    """
+
+    def __init__(self, config, options, events):
+        """
+        :param config: {"name", "workDir", "setting", "login"}
+        :param options: supervisor options, see OPTIONS
+        :param events: multiprocessing queue the reports are put in
+        """
+        self.name = config["name"]
+        self.setting = dict(config.get("setting") or {})
+        self.setting.pop("logging", None)  # the logging pipeline is per process
+        self.setting["dir"] = dict(self.setting.get("dir") or {}, workDir=config["workDir"])
+        self.login = dict({"hotReload": True}, **(config.get("login") or {}))
+        self.options = options
+        self.events = events
+        self.bot = None
+        self.restarts = 0
+        self.stopping = threading.Event()
+
+    def run(self):
+        from test import Bot
+        delay = self.options["restartDelay"]
+        while not self.stopping.is_set():
+            started = time.time()
+            try:
+                self.bot = Bot(**self.setting)
+                self.report("logging in")
+                self.bot.auto_login(**self.login)
+                if self.bot.alive and not self.stopping.is_set():
+                    self.bot.run(blockThread=False)
+                    self.report("running")
+                    while self.bot.alive and not self.stopping.wait(self.options["statsInterval"]):
+                        self.report("running")
+            except (Exception, SystemExit):
+                logger.exception('Account {} failed'.format(self.name))
+            if self.stopping.is_set():
+                break
+            if time.time() - started > self.options["maxRestartDelay"]:
+                delay = self.options["restartDelay"]  # it ran for a while, start over the backoff
+            self.restarts += 1
+            self.report("restarting")
+            logger.warning('Restart account {} in {}s'.format(self.name, delay))
+            self.stopping.wait(delay)
+            delay = min(delay * 2, self.options["maxRestartDelay"])
+        self.shutdown()
+        self.report("stopped")
+
+    def stop(self):
+        self.stopping.set()
+        if self.bot is not None:
+            self.bot.isLogging = False  # ends a login waiting for the QR code to be scanned
+
+    def shutdown(self):
+        """
+        Flush and close the database; the session is kept so a hot reload logs in again.
+        """
+        bot = self.bot
+        if bot is None:
+            return
+        if bot.alive:
+            bot.alive = False
+            if bot.useHotReload:
+                bot.dump_login_status()
+        try:
+            bot.exit_callback()
+        except Exception:
+            logger.exception('Exit of account {} failed'.format(self.name))
+
+    def report(self, state):
+        stats = None
+        if state == "running":
+            try:
+                stats = self.bot.stats()
+            except Exception as e:
+                stats = {"error": repr(e)}
+        self.events.put((self.name, {"state": state, "restarts": self.restarts, "pid": os.getpid(),
+                                     "time": time.time(), "stats": stats}))
+
+
+def worker(index, accounts, options, stopEvent, events):
+    """
+    Target of a worker process: runs each account on a thread until stopEvent is set.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor decides when to stop
+    terminated = threading.Event()
+
+    def terminate(signum, frame):
+        # a SIGTERM of its own stops the accounts gracefully, a SIGTERM while stopping means the
+        # supervisor gave up waiting
+        if terminated.is_set() or stopEvent.is_set():
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+        terminated.set()
+
+    signal.signal(signal.SIGTERM, terminate)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - worker {} - %(name)s - %(levelname)s - %(message)s'
+                        .format(index))
+    pipeline = LogPipeline(**options["logging"]).start() if options.get("logging") else None
+    runners = [Account(i, options, events) for i in accounts]
+    threads = []
+    for runner in runners:
+        thread = threading.Thread(target=runner.run, name='Account-{}'.format(runner.name))
+        thread.start()
+        threads.append(thread)
+    while not (stopEvent.wait(1) or terminated.is_set()):
+        pass
+    for runner in runners:
+        runner.stop()
+    deadline = time.time() + options["shutdownTimeout"]
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+    if pipeline:
+        pipeline.stop()
+
+
+class Supervisor:
+    """
+    Starts the worker processes, restarts the ones that die, collects the reports of the
+    accounts and stops everything on SIGINT/SIGTERM, each Bot through its exit_callback.
+    """
+
+    def __init__(self, accounts, **options):
+        """
+        :param accounts: list of {"name", "workDir", "setting", "login"}, see the module doc
+        :param options: see OPTIONS
+        """
+        self.options = dict(OPTIONS, **options)
+        names = [i["name"] for i in accounts]
+        if len(set(names)) != len(names):
+            raise ValueError('account names must be unique')
+        accounts = [dict(i, workDir=os.path.abspath(i.get("workDir") or os.path.join(self.options["baseDir"], i["name"])))
+                    for i in accounts]
+        size = max(min(self.options["workers"] or os.cpu_count() or 1, len(accounts)), 1)
+        self.groups = [accounts[i::size] for i in range(size)]
+        # spawned, not forked: itchat threads and sqlite connections do not survive a fork
+        self.context = multiprocessing.get_context("spawn")
+        self.stopEvent = self.context.Event()
+        self.events = self.context.Queue()
+        self.processes = [None] * size
+        self.restarts = [0] * size
+        self.nextStart = [0] * size
+        self.accounts = {name: {"state": "starting", "restarts": 0} for name in names}
+        self.stopping = threading.Event()
+        self.server = None
+
+    def start(self):
+        for i in range(len(self.groups)):
+            self._spawn(i)
+        if self.options["metricsPort"] is not None:
+            self.server = Metrics().serve(self.options["metricsPort"], stats=self.stats)
+        return self
+
+    def _spawn(self, i):
+        process = self.context.Process(target=worker, name='Worker-{}'.format(i),
+                                       args=(i, self.groups[i], self.options, self.stopEvent, self.events))
+        process.start()
+        self.processes[i] = process
+        logger.info('Worker {} (pid {}) runs {}'.format(i, process.pid, ', '.join(a["name"] for a in self.groups[i])))
+
+    def run(self):
+        """
+        Supervise until SIGINT or SIGTERM, then shut down gracefully.
+        """
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: self.stopping.set())
+        self.start()
+        try:
+            while not self.stopping.is_set():
+                self.poll(1)
+        finally:
+            self.stop()
+
+    def poll(self, timeout=0):
+        """
+        Take the reports of the accounts and restart the dead workers.
+        """
+        try:
+            name, status = self.events.get(timeout=timeout)
+            while True:
+                self.accounts[name] = status
+                name, status = self.events.get_nowait()
+        except Empty:
+            pass
+        now = time.time()
+        for i, process in enumerate(self.processes):
+            if process is not None and not process.is_alive() and not self.stopEvent.is_set():
+                if not self.nextStart[i]:
+                    delay = min(self.options["restartDelay"] * 2 ** self.restarts[i], self.options["maxRestartDelay"])
+                    self.nextStart[i] = now + delay
+                    logger.warning('Worker {} exited with {}, restart in {}s'.format(i, process.exitcode, delay))
+                elif now >= self.nextStart[i]:
+                    self.restarts[i] += 1
+                    self.nextStart[i] = 0
+                    self._spawn(i)
+
+    def stop(self):
+        self.stopEvent.set()
+        deadline = time.time() + self.options["shutdownTimeout"] + 5
+        for process in self.processes:
+            if process is not None:
+                process.join(max(deadline - time.time(), 0))
+                if process.is_alive():
+                    logger.warning('Worker {} did not stop in time, terminate it'.format(process.name))
+                    process.terminate()
+        self.poll()
+        if self.server:
+            self.server.shutdown()
+            self.server = None
+
+    def stats(self):
+        return {"workers": {process.name: {"pid": process.pid, "alive": process.is_alive(), "restarts": self.restarts[i],
+                                           "accounts": [a["name"] for a in self.groups[i]]}
+                            for i, process in enumerate(self.processes) if process is not None},
+                "accounts": dict(self.accounts)}
+
+
+if __name__ == '__main__':
+    import argparse
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Run many wechathelper accounts')
+    parser.add_argument('config', help='JSON file, see the doc of supervisor.py')
+    with open(parser.parse_args().config, encoding='utf-8') as f:
+        config = json.load(f)
+    Supervisor(config.pop("accounts"), **config).run()
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import traceback
 import threading
@@ -10,8 +11,25 @@ from itchat import Core
 from itchat import content, utils, config
 from itchat.components.login import push_login
 from itchat.components.register import logger, Queue, templates, set_logging, test_connect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from sqlhelper import sqlitehelper
+from sqlhelper import SqliteHelper, sqlitehelper
+from dbhelper import BatchWriter, ReadPool, apply_pragmas, fts_init, fts_rebuild
+from workers import KeyedPool
+from sendqueue import SendQueue
+from deadletter import DeadLetters
+from mediahelper import MediaStore
+from contacthelper import ContactCache, ContactSync, MemberIds, upgrade_groups
+from partition import Partitions
+from export import export
+from metrics import Metrics
+from dispatch import Dispatcher
+from dedupe import RecentIds
+from retention import Retention
+from rollup import GROUPS, MSG_STATS_TABLE, MsgStats, day
+from compress import PACKED_COLUMNS, pack, register
+from loghelper import LazyTime, LogPipeline
 
 
 class Bot(Core):
@@ -20,30 +38,119 @@ class Bot(Core):
         self.filehelper = self.self = templates.User
         self.db: sqlite3.Connection = None
         self.cursor: sqlite3.Cursor = None
-        self.errorMsgList = []
-        for key in self.functionDict.keys():
-            __msgDict = {}.fromkeys(content.INCOME_MSG)
-            for _ in __msgDict.keys():
-                __msgDict[_] = {}
-            self.functionDict[key] = __msgDict
+        self.writer: BatchWriter = None
+        self.readers: ReadPool = None
+        self.replyPool: KeyedPool = None
+        self.replyThread: threading.Thread = None
+        self.replyDone: threading.Event = None  # set once the reply loop of run() has returned
+        self.sendQueue: SendQueue = None
+        self.deadLetters: DeadLetters = None
+        self.mediaStore: MediaStore = None
+        self.contactSync: ContactSync = None
+        self.contactCache: ContactCache = None
+        self.resolved = set()
+        self.partitions: Partitions = None
+        self.recentIds: RecentIds = None
+        self.retention: Retention = None
+        self.msgStats: MsgStats = None
+        self.memberIds: MemberIds = None
+        self.dbPath = None
+        self.metrics: Metrics = None
+        self.metricsServer = None
+        self.logPipeline: LogPipeline = None
+        self.exitLock = threading.Lock()
+        self.exited = False
+        self.dispatcher = Dispatcher(((templates.User, "FriendChat", "FriendMsgs"),
+                                      (templates.MassivePlatform, "MpChat", "MpMsgs"),
+                                      (templates.Chatroom, "GroupChat", "GroupMsgs")))
         self.setting = {
-            "database": {"dir": "", "table_info": {}},
+            "database": {"dir": "", "table_info": {},
+                         # multiRow writes the rows of a batch with multi-row INSERT statements
+                         "writer": {"batchSize": 500, "maxDelay": 1, "multiRow": True},
+                         # auto_vacuum only applies to new databases, "python dbhelper.py <uin>.db vacuum"
+                         # switches an existing one
+                         "profile": {"auto_vacuum": "INCREMENTAL",
+                                     "journal_mode": "WAL",
+                                     "synchronous": "NORMAL",
+                                     "cache_size": -16000,  # KiB when negative
+                                     "mmap_size": 256 * 1024 * 1024,
+                                     "temp_store": "MEMORY"},
+                         "readers": 2,
+                         "sqlCache": 0,  # number of generated statements to memoize, 0 is off
+                         "fts": None,  # like {"tokenize": "trigram"} to index message Content and Comments
+                         # like {"minSize": 256, "level": 6} to store long Content and Comments compressed,
+                         # see compress.py; "python dbhelper.py <uin>.db compress" compresses the older rows
+                         "compress": None,
+                         # like {"period": "month", "writable": 2, "readOnly": True} to store messages
+                         # in one database file per period
+                         "partition": None},
+            # reply functions run on workers, in order within a chat; 0 workers runs them on the reply thread
+            # with run(useAsyncio=True) workers size the executor and concurrency bounds the running handlers;
+            # on exit the handlers get closeTimeout seconds to finish before the database is closed
+            "reply": {"workers": 4, "queueSize": 100, "policy": "block", "concurrency": 100, "closeTimeout": 10},
+            # replies are sent by workers paced by a global and a per-recipient token bucket, texts
+            # waiting for one recipient are joined; 0 workers sends them inline; see sendqueue.SendQueue
+            "send": {"workers": 2, "queueSize": 1000, "rate": 5, "burst": 10, "chatRate": 1, "chatBurst": 3,
+                     "coalesce": True, "maxLength": 2000, "retries": 3, "backoff": 1, "maxBackoff": 30,
+                     "closeTimeout": 5},
+            # failed saves are kept in the DeadLetters table and retried with exponential backoff
+            "deadLetter": {"bufferSize": 100, "batchSize": 100, "interval": 30,
+                           "backoff": 60, "maxBackoff": 3600, "maxAttempts": 10, "maxRows": 10000},
+            # messages whose MsgId was seen within window seconds are dropped before being saved or
+            # replied to, the ids are seeded from the database at login; orIgnore also inserts messages
+            # with INSERT OR IGNORE so duplicates older than the window do not fail a batch; None is off
+            "dedupe": {"window": 86400, "maxSize": 100000, "orIgnore": False},
+            # like {"tables": {"SystemMsgs": 30, "GroupMsgs": 365}} to delete rows older than that many days
+            # every interval seconds, in writer batches of about maxTime seconds, see retention.Retention
+            "retention": None,
+            # saved messages are counted per day, chat, sender and MsgType into MsgStats, see Bot.msg_stats;
+            # "python dbhelper.py <uin>.db msg-stats" counts the messages saved before; None is off
+            "msgStats": {"interval": 10},
+            # group members are numbered in GroupMembers and GroupMsgs.FromUser holds the MemberId, the
+            # ids of maxSize members are kept in memory; None stores str((actualUserName, actualNickName))
+            "members": {"maxSize": 10000},
+            # pictures, voice, video and files are downloaded into mediaDir, 0 workers disables it
+            "media": {"workers": 4, "maxPending": 1000, "chunkSize": 64 * 1024, "timeout": 60},
+            # Friends, Groups and Mps follow the contact list, delay debounces contact change events;
+            # with warmStart messages are received before the contacts are fetched, the lists of the
+            # session come from <uin>.contacts.db, a full fetch runs in the background and the user of
+            # a message is fetched on first use until then
+            "contact": {"historySize": 50, "delay": 5, "warmStart": True},
+            # like {"queueSize": 10000, "rate": 5, "burst": 20, "sample": 1.0, "structured": "kv"} to write
+            # the logs on a background thread, rate-limited and sampled per chat; see loghelper.LogPipeline
+            "logging": None,
+            # per-stage latency histograms and rates for Bot.stats(); port serves them on 127.0.0.1
+            "metrics": {"enabled": False, "window": 60, "port": None},
             "dir": {"workDir": ".",
                     "dataDir": 'data',
                     "tempDir": os.path.join("data", "temp"),
                     "mediaDir": os.path.join("data", "media")},
         }
-        if kwargs.get("dir"):
-            dir_update = kwargs.pop("dir")
-            _ = dir_update.get("workDir")
-            if _:
-                if not os.path.exists(_):
-                    os.makedirs(_)
-                os.chdir(_)
-                logger.info("Create work dir successfully")
-                dir_update.pop("workDir")
-            self.setting["dir"].update(dir_update)
-        self.setting.update(kwargs)
+        # a dict merges into the default one, so database={"fts": None} keeps its other keys
+        for key, value in kwargs.items():
+            if isinstance(value, dict) and isinstance(self.setting.get(key), dict):
+                self.setting[key] = dict(self.setting[key], **value)
+            else:
+                self.setting[key] = value
+        # paths are made absolute from workDir instead of changing the working directory,
+        # so several bots can share a process
+        workDir = os.path.abspath(self.setting["dir"]["workDir"])
+        self.setting["dir"] = {key: workDir if key == "workDir" else os.path.join(workDir, path)
+                               for key, path in self.setting["dir"].items()}
+        if self.setting["database"]["dir"]:
+            self.setting["database"] = dict(self.setting["database"],
+                                            dir=os.path.join(workDir, self.setting["database"]["dir"]))
+        self.insertMsg = INSERT_MSG_OR_IGNORE if (self.setting["dedupe"] or {}).get("orIgnore") else INSERT_MSG
+        self.errorMsgList = deque(maxlen=self.setting["deadLetter"].get("bufferSize", 100))
+        self.sqlitehelper = SqliteHelper(self.setting["database"].get("sqlCache"))
+        if self.setting["logging"]:
+            self.logPipeline = LogPipeline(**self.setting["logging"]).start()
+        if self.setting["metrics"].get("enabled"):
+            self.metrics = Metrics(self.setting["metrics"].get("window", 60))
+            self.metrics.gauge("msgQueue", self.msgList.qsize)
+            self.metrics.gauge("writeQueue", lambda: self.writer.queue.qsize() if self.writer else 0)
+            self.metrics.gauge("replyPending", lambda: self.replyPool.info()["pending"] if self.replyPool else 0)
+            self.metrics.gauge("sendQueue", lambda: self.sendQueue.size if self.sendQueue else 0)
         for path in self.setting["dir"].values():
             if not os.path.exists(path):
                 os.makedirs(path)
@@ -89,10 +196,11 @@ class Bot(Core):
                 logger.info('Log in time out, reloading QR code.')
         else:
             return  # log in process is stopped by user
-        logger.info('Loading the contact, this may take a little while.')
         self.web_init()
         self.show_mobile_login()
-        self.get_contact(True)
+        if not self.setting["contact"].get("warmStart"):
+            logger.info('Loading the contact, this may take a little while.')
+            self.get_contact(True)
         if hasattr(loginCallback, '__call__'):
             if os.path.exists(picDir or config.DEFAULT_QR):
                 os.remove(picDir or config.DEFAULT_QR)
@@ -128,30 +236,43 @@ class Bot(Core):
                        loginCallback=loginCallback, exitCallback=exitCallback)
 
     def msg_register(self, msgType, isFriendChat=False,
-                     isGroupChat=False, isMpChat=False, fType="rf"):
+                     isGroupChat=False, isMpChat=False, fType="rf", replace=False):
+        """
+        Add the decorated function to the handler chain of each slot; handlers of a slot run
+        in registration order, each result of an rf is sent and each (sql, args) of an sf saved.
+        :param replace: drop the functions registered before instead, e.g. to change how a type is saved
+        """
         if not (isinstance(msgType, list) or isinstance(msgType, tuple)):
             msgType = [msgType]
 
         def _msg_register(fn):
-            for _msgType in msgType:
-                if isFriendChat:
-                    self.functionDict['FriendChat'][_msgType][fType] = fn
-                if isGroupChat:
-                    self.functionDict['GroupChat'][_msgType][fType] = fn
-                if isMpChat:
-                    self.functionDict['MpChat'][_msgType][fType] = fn
-                if not any((isFriendChat, isGroupChat, isMpChat)):
-                    self.functionDict['FriendChat'][_msgType][fType] = fn
+            self.dispatcher.register(_chat_kinds(isFriendChat, isGroupChat, isMpChat), msgType, fType, fn, replace)
             return fn
 
         return _msg_register
+
+    def middleware_register(self, msgType, isFriendChat=False,
+                            isGroupChat=False, isMpChat=False, fType="rf"):
+        """
+        Wrap each handler of the slots in the decorated fn(msg, handler), which returns
+        handler(msg) or skips it by returning None.
+        """
+        if not (isinstance(msgType, list) or isinstance(msgType, tuple)):
+            msgType = [msgType]
+
+        def _middleware_register(fn):
+            self.dispatcher.use(_chat_kinds(isFriendChat, isGroupChat, isMpChat), msgType, fType, fn)
+            return fn
+
+        return _middleware_register
             
     def sf_init(self):
         register = partial(self.msg_register, fType="sf")
 
-        def re_format(t, l):
-            _time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
-            logger.info('{}: {}'.format(_time, l))
+        def re_format(t, l, *args, chat=None, **fields):
+            # formatted by the handler only if the record is written, see setting["logging"]
+            if logger.isEnabledFor(logging.INFO):
+                logger.info('%s: ' + l, LazyTime(t), *args, extra={"chat": chat, "fields": fields})
 
         def re_wrapper(fn):
             def _re(msg):
@@ -161,16 +282,18 @@ class Bot(Core):
                 _type, _content, comments = fn(msg)
                 if isinstance(msg['User'], (templates.User, templates.MassivePlatform)):
                     _from = 1 if msg.fromUserName == self.storageClass.userName else 2
-                    _log = "{} {} {} message {}".format(["Send to", "Receive from"][_from - 1],
-                                                        _user, msg.type, (_content or ''))
+                    re_format(_time, "%s %s %s message %s", ["Send to", "Receive from"][_from - 1],
+                              _user, msg.type, (_content or ''), chat=_user, msgId=_id, msgType=_type)
                 elif isinstance(msg['User'], templates.Chatroom):
                     _from = msg.actualNickName
-                    _log = "{} send {} message {} at {}".format(_from, msg.type,
-                                                                (_content or ''), _user)
-                    _from = str((msg.actualUserName, _from))
+                    re_format(_time, "%s send %s message %s at %s", _from, msg.type,
+                              (_content or ''), _user, chat=_user, msgId=_id, msgType=_type)
+                    if self.memberIds:
+                        _from = self.memberIds.get(_user, _from or msg.actualUserName)
+                    else:
+                        _from = str((msg.actualUserName, _from))
                 else:
                     raise NotImplementedError(msg)
-                re_format(_time, _log)
                 return None, (_id, _time, _user, _from, _type, _content, comments)
             return _re
 
@@ -206,13 +329,28 @@ class Bot(Core):
         def _fn(msg):
             return process_pic(msg)
 
+        @register(content.RECORDING, isFriendChat=True, isMpChat=True, isGroupChat=True)
+        @re_wrapper
+        def _fn(msg):
+            return 34, "#voice#", msg.get("VoiceLength")
+
+        @register(content.VIDEO, isFriendChat=True, isMpChat=True, isGroupChat=True)
+        @re_wrapper
+        def _fn(msg):
+            return 43, "#video#", msg.get("PlayLength")
+
+        @register(content.ATTACHMENT, isFriendChat=True, isMpChat=True, isGroupChat=True)
+        @re_wrapper
+        def _fn(msg):
+            return 49, "#file#", msg.get("FileName")
+
         def sys_wrapper(fn):
             def _re(msg):
                 _time = (msg.get("CreateTime", round(time.time())))
                 _infoType, _name, _log = fn(msg)
                 _sql = "INSERT INTO SystemMsgs VALUES (?, ?, ?)"
-                re_format(_time, _log)
-                self.cursor(_sql, (_time, _infoType, _name))
+                re_format(_time, "%s", _log, chat=_name, infoType=_infoType)
+                return _sql, (_time, _infoType, _name)
             return _re
 
         @register(content.SYSTEM)
@@ -230,6 +368,8 @@ class Bot(Core):
                     log = "open the dialog with {} on the phone".format(name)
             elif msg.systemInfo == 'chatrooms':
                 name = None
+                if self.contactSync:
+                    self.contactSync.schedule()
                 if msg.text:
                     infoType = 5  # GroupChat operation
                     log = "GroupChat operation probably"
@@ -260,53 +400,317 @@ class Bot(Core):
         try:
             msg = self.msgList.get(timeout=2)
         except Queue.Empty:
-            self.db.commit()
+            pass
         else:
-            if isinstance(msg['User'], templates.User):
-                replyFn = self.functionDict['FriendChat'].get(msg['Type'])
-                _table = "FriendMsgs"
-            elif isinstance(msg['User'], templates.MassivePlatform):
-                replyFn = self.functionDict['MpChat'].get(msg['Type'])
-                _table = "MpMsgs"
-            elif isinstance(msg['User'], templates.Chatroom):
-                replyFn = self.functionDict['GroupChat'].get(msg['Type'])
-                _table = "GroupMsgs"
-            saveFn = replyFn.get('sf')
-            replyFn = replyFn.get('rf')
-            if saveFn:
-                try:
-                    _sql = "INSERT INTO {} VALUES (?, ?, ?, ?, ?, ?, ?)".format(_table)
-                    sql, args = saveFn(msg)
-                    sql = sql or _sql
-                    self.cursor.execute(sql, args)
-                except:
-                    info = traceback.format_exc()
-                    self.errorMsgList.append((msg, info))
-                    logger.warning(info)
-
-            if replyFn:
+            if msg is None:  # put by exit_callback to wake up the asyncio bridge
+                return
+            slot = self.route(msg)
+            if slot is None or self.duplicate(msg):
+                return
+            metrics = self.metrics
+            if metrics:
+                self.observe_queue(msg, slot.kind)
+            saved = False
+            for saveFn in slot.sf:
                 try:
-                    r = replyFn(msg)
+                    start = metrics and time.perf_counter()
+                    r = _result(saveFn(msg))
+                    if metrics:
+                        metrics.observe("sf", time.perf_counter() - start)
                     if r is not None:
-                        self.send(r, msg.get('FromUserName'))
-                except:
-                    logger.warning(traceback.format_exc())
+                        sql, args = r
+                        if sql is None:
+                            sql, args = self.insertMsg.format(slot.table), self.pack(args)
+                        self.save(sql, args, msg)
+                        saved = True
+                except Exception as e:
+                    self.save_error(None, None, msg, e, traceback.format_exc())
+            if saved:
+                self.save_media(msg, slot.table)
+
+            if slot.rf:
+                if self.replyPool:
+                    try:
+                        self.replyPool.submit(msg['User'].get('UserName') or msg.get('FromUserName'),
+                                              self.reply, slot.rf, msg)
+                    except RuntimeError as e:  # closed by exit_callback
+                        logger.warning('Drop the reply to {}: {}'.format(msg.get('FromUserName'), e))
+                else:
+                    self.reply(slot.rf, msg)
+
+    def route(self, msg):
+        """
+        :return: dispatch.Slot with the message table and handler chains, None if msg is not handled
+        """
+        if self.contactCache and not msg['User'].get('NickName'):
+            self.resolve(msg)
+        return self.dispatcher.route(msg)
+
+    def resolve(self, msg):
+        """
+        Fetch the contact of a message whose user is not loaded yet, once per user name, and
+        put it in msg['User'].
+        """
+        userName = msg['User'].get('UserName') or msg['User'].get('userName')
+        if not userName or userName in self.resolved:
+            return
+        self.resolved.add(userName)  # a failed lookup is not retried
+        try:
+            if userName.startswith('@@'):
+                self.update_chatroom(userName)
+            else:
+                self.update_friend(userName)
+        except Exception:
+            logger.exception('Fetching the contact {} failed'.format(userName))
+            return
+        user = self.search_chatrooms(userName=userName) if userName.startswith('@@') else \
+            self.search_mps(userName=userName) or self.search_friends(userName=userName)
+        if user:
+            msg['User'] = user
+            self.contactCache.metrics["resolved"] += 1
+
+    def refresh_contacts(self):
+        """
+        Fetch the whole contact list, then cache it and sync the contact tables. Members of
+        chatrooms are fetched by itchat when a chatroom is first used.
+        """
+        try:
+            self.get_contact(True)
+            self.contactCache.metrics["refreshed"] = round(time.time())
+            # saved here only: by the time exitCallback runs, itchat's logout has emptied the lists
+            self.contactCache.save(self.storageClass)
+        except Exception:
+            logger.exception('Contact refresh failed')
+        if self.contactSync:
+            self.contactSync.schedule()
+
+    def dump_login_status(self, fileDir=None):
+        if self.contactCache is None:
+            return super().dump_login_status(fileDir)
+        # the contact lists are in the cache, the pickle keeps the session only
+        storage = self.storageClass
+        dumps = storage.dumps
+        storage.dumps = lambda: dict(dumps(), **{name: [] for name in ContactCache.LISTS})
+        try:
+            return super().dump_login_status(fileDir)
+        finally:
+            del storage.dumps
+
+    def duplicate(self, msg):
+        """
+        :return: True if the MsgId of msg was already seen, counting it
+        """
+        if self.recentIds is None or msg.get('MsgId') is None:
+            return False
+        if self.recentIds.seen(msg['MsgId'], msg.get('CreateTime')):
+            if self.metrics:
+                self.metrics.mark("duplicates")
+            return True
+        return False
+
+    def seed_recent_ids(self):
+        """
+        Remember the MsgIds stored within the dedupe window, so messages received again after a
+        reconnect or a hot reload are known.
+        """
+        since = round(time.time()) - self.recentIds.window
+        for _since, _until, keys in reversed(self.windows(since)):  # oldest first, like the rows of a window
+            condition, args = "CreateTime >= ?", (_since,)
+            if _until is not None:
+                condition, args = condition + " AND CreateTime < ?", args + (_until,)
+            with self.read(_since, _until, keys) as db:
+                for table, _ in HISTORY_TABLES.values():
+                    self.recentIds.seed(db.execute(
+                        "SELECT CAST(MsgId AS TEXT), CreateTime FROM {} WHERE {} ORDER BY CreateTime".format(
+                            table, condition), args))
+        logger.info('Remember {} recent messages'.format(len(self.recentIds.ids)))
+
+    def pack(self, args):
+        """
+        Compress Content and Comments of the args of a message row if setting["database"]["compress"].
+        """
+        options = self.setting["database"].get("compress")
+        if not options:
+            return args
+        return args[:5] + tuple(pack(i, options.get("minSize", 256), options.get("level", 6)) for i in args[5:])
+
+    def read_columns(self, table, prefix=''):
+        """
+        :return: the columns of a message table, compressed ones through unpack()
+        """
+        info = self.setting["database"]["table_info"].get(table) or TABLE_INFO[table]
+        return ["unpack({0}{1}) AS {1}".format(prefix, name) if name in PACKED_COLUMNS else prefix + name
+                for name in (i.split()[0] for i in info["columns"])]
+
+    def save(self, sql, args, msg):
+        if self.partitions:
+            sql = self.partitions.route(sql, msg.get('CreateTime'))
+        self.writer.put(sql, args, msg)
+
+    def committed(self, rows):
+        """
+        commitCallback of the writer: the rows it committed, see dbhelper.BatchWriter.
+        """
+        if self.memberIds:
+            self.memberIds.written(rows)
+        if self.msgStats:
+            self.msgStats.written(rows)
+
+    def save_media(self, msg, table):
+        if self.mediaStore and msg['Type'] in MEDIA_TYPES and not msg.get('HasProductId'):
+            self.mediaStore.submit(msg, table)
+
+    def observe_queue(self, msg, chatType):
+        """
+        Record the wait of msg since it was sent and count it for its chat type.
+        """
+        self.metrics.observe("queue", max(time.time() - (msg.get('CreateTime') or time.time()), 0))
+        self.metrics.mark(chatType)
+
+    def reply(self, replyFns, msg):
+        for replyFn in replyFns:
+            try:
+                start = self.metrics and time.perf_counter()
+                r = _result(replyFn(msg))
+                if self.metrics:
+                    self.metrics.observe("rf", time.perf_counter() - start)
+                if r is not None:
+                    self.deliver(r, msg.get('FromUserName'))
+            except:
+                logger.warning(traceback.format_exc())
+
+    async def async_reply(self):
+        """
+        The asyncio counterpart of the configured_reply loop.
+        Messages are handed over from msgList by a thread blocking on it, so nothing polls;
+        coroutine handlers are awaited on the loop, plain reply functions, send and database
+        writes run on an executor. Messages of one chat are handled in order.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        executor = ThreadPoolExecutor(self.setting["reply"].get("workers") or None, 'ReplyExecutor')
+        semaphore = asyncio.Semaphore(self.setting["reply"].get("concurrency", 100))
+        tails = {}
+
+        def bridge():
+            while self.alive:
+                msg = self.msgList.get()
+                loop.call_soon_threadsafe(queue.put_nowait, msg)
+                if msg is None:
+                    break
+            else:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        def release(task, key):
+            if tails.get(key) is task:
+                del tails[key]
+
+        bridgeThread = threading.Thread(target=bridge, name='MsgBridge')
+        bridgeThread.setDaemon(True)
+        bridgeThread.start()
+        while True:
+            msg = await queue.get()
+            if msg is None or not self.alive:
+                break
+            key = msg['User'].get('UserName') or msg.get('FromUserName')
+            task = loop.create_task(self.async_handle(msg, executor, tails.get(key), semaphore))
+            task.add_done_callback(partial(release, key=key))
+            tails[key] = task
+        if tails:
+            await asyncio.wait(list(tails.values()))
+        executor.shutdown()
+
+    async def async_handle(self, msg, executor, previous=None, semaphore=None):
+        """
+        :param previous: the task of the chat's previous message, awaited first
+        :param semaphore: bounds the messages handled at once, taken after previous is done so
+                          a chat waiting on itself does not hold a permit other chats need
+        """
+        if previous is not None:
+            await asyncio.wait([previous])
+        if semaphore is None:
+            return await self._async_handle(msg, executor)
+        async with semaphore:
+            return await self._async_handle(msg, executor)
+
+    async def _async_handle(self, msg, executor):
+        loop = asyncio.get_running_loop()
+        metrics = self.metrics
+        if self.contactCache and not msg['User'].get('NickName'):  # resolve fetches over HTTP, as route does
+            await loop.run_in_executor(executor, self.resolve, msg)
+        slot = self.dispatcher.route(msg)
+        if slot is None or self.duplicate(msg):
+            return
+        if metrics:
+            self.observe_queue(msg, slot.kind)
+        saved = False
+        for saveFn in slot.sf:
+            try:
+                start = metrics and time.perf_counter()
+                r = saveFn(msg)
+                if asyncio.iscoroutine(r):
+                    r = await r
+                if metrics:
+                    metrics.observe("sf", time.perf_counter() - start)
+                if r is not None:
+                    sql, args = r
+                    if sql is None:
+                        sql, args = self.insertMsg.format(slot.table), self.pack(args)
+                    self.save(sql, args, msg)  # writer.put only queues the row
+                    saved = True
+            except Exception as e:
+                self.save_error(None, None, msg, e, traceback.format_exc())
+        if saved:
+            self.save_media(msg, slot.table)
+        for replyFn in slot.rf:
+            try:
+                start = metrics and time.perf_counter()
+                if asyncio.iscoroutinefunction(replyFn):
+                    r = await replyFn(msg)
+                else:
+                    r = await loop.run_in_executor(executor, replyFn, msg)
+                if asyncio.iscoroutine(r):  # an async handler wrapped in middleware
+                    r = await r
+                if metrics:
+                    metrics.observe("rf", time.perf_counter() - start)
+                if r is not None:
+                    await loop.run_in_executor(executor, self.deliver, r, msg.get('FromUserName'))
+            except:
+                logger.warning(traceback.format_exc())
 
-    def run(self, debug=False, blockThread=True):
+    def run(self, debug=False, blockThread=True, useAsyncio=False):
+        """
+        :param useAsyncio: handle messages on an asyncio event loop, handlers may be "async def"
+        """
         logger.info('Start auto replying.')
         if debug:
             set_logging(loggingLevel=logging.DEBUG)
+        if self.metrics and self.setting["metrics"].get("port") is not None and not self.metricsServer:
+            self.metricsServer = self.metrics.serve(self.setting["metrics"]["port"], stats=self.stats)
+        if self.setting["send"].get("workers") and not self.sendQueue:
+            self.sendQueue = SendQueue(self.send, metrics=self.metrics,
+                                       **{k: v for k, v in self.setting["send"].items() if k != "closeTimeout"})
+        if self.setting["reply"].get("workers") and not (self.replyPool or useAsyncio):
+            self.replyPool = KeyedPool(self.setting["reply"]["workers"], self.setting["reply"].get("queueSize", 100),
+                                       self.setting["reply"].get("policy", "block"), name='ReplyWorker')
+        self.replyDone = threading.Event()
 
         def reply_fn():
+            self.replyThread = threading.current_thread()
             try:
-                while self.alive:
-                    self.configured_reply()
+                if useAsyncio:
+                    asyncio.run(self.async_reply())
+                else:
+                    while self.alive:
+                        self.configured_reply()
             except KeyboardInterrupt:
                 if self.useHotReload:
                     self.dump_login_status()
                 self.alive = False
                 logger.debug('itchat received an ^C and exit.')
                 logger.info('Bye~')
+            finally:
+                self.replyDone.set()
 
         if blockThread:
             reply_fn()
@@ -321,14 +725,26 @@ class Bot(Core):
             logger.warning('Fail to login, if use auto_login with "hotReload" ,\
             please delete the "pkl"("statusStorageDir") and try login again')
             sys.exit()
+        self.exited = False
+        if self.logPipeline:  # stopped by the exit_callback of the last login
+            self.logPipeline.start()
         self.filehelper = self.update_friend(userName='filehelper')
         self.self = self.update_friend(userName=self.storageClass.userName)
-        self.db, self.cursor = db_init(self.self.uin,
-                                       (self.setting["database"]["dir"] or self.setting["dir"]["dataDir"]),
-                                       self.setting["database"]["table_info"])
+        db_dir = self.setting["database"]["dir"] or self.setting["dir"]["dataDir"]
+        profile = self.setting["database"].get("profile")
+        if self.setting["contact"].get("warmStart"):
+            self.contactCache = ContactCache(os.path.join(db_dir, '{}.contacts.db'.format(self.self.uin)))
+            try:
+                self.contactCache.load(self.storageClass)
+            except Exception:
+                logger.exception('Loading the cached contacts failed')
+        self.db, self.cursor = db_init(self.self.uin, db_dir,
+                                       self.setting["database"]["table_info"], profile,
+                                       self.setting["database"].get("fts"))
         self.cursor.row_factory = sqlite3.Row
+        # before the writer starts, which owns self.db from then on until exit_callback
         self.cursor.execute(
-            sqlitehelper.select(
+            self.sqlitehelper.select(
                 "User",
                 ("datetime(LoginTime,'unixepoch','localtime')",
                  "LoginTime"),
@@ -341,23 +757,380 @@ class Bot(Core):
                 row[0], time_length(time.time() - row["LoginTime"])))
         else:
             self.cursor.execute(
-                sqlitehelper.insert("User", 4),
+                self.sqlitehelper.insert("User", 4),
                 (self.storageClass.userName, self.storageClass.nickName,
                  round(time.time()), None)
             )
             logger.info('Login initialization successfully and starting listening messages'.format(
                 self.storageClass.nickName))
             self.db.commit()
+        self.dbPath = os.path.join(db_dir, str(self.self.uin) + '.db')
+        self.readers = ReadPool(self.dbPath, self.setting["database"].get("readers", 2), profile)
+        self.writer = BatchWriter(self.db, errorCallback=self.save_error, metrics=self.metrics,
+                                  **self.setting["database"].get("writer", {})).start()
+        if self.setting["database"].get("partition"):
+            table_info = dict(TABLE_INFO, **self.setting["database"]["table_info"])
+            table_info = {table: table_info[table] for table in PARTITIONED_TABLES}
+            self.partitions = Partitions(db_dir, self.self.uin, PARTITIONED_TABLES, self.writer,
+                                         partial(create_tables, table_info=table_info,
+                                                 fts=self.setting["database"].get("fts")),
+                                         profile=profile, **self.setting["database"]["partition"])
+        self.deadLetters = DeadLetters(self.writer, self.readers, route=self.partitions and self.partitions.route,
+                                       **self.setting["deadLetter"]).start()
+        self.deadLetters.recent.extend(self.errorMsgList)
+        self.errorMsgList = self.deadLetters.recent
+        if self.setting["media"].get("workers"):
+            self.mediaStore = MediaStore(self, self.setting["dir"]["mediaDir"], self.setting["dir"]["tempDir"],
+                                         self.writer, route=self.partitions and self.partitions.route,
+                                         **self.setting["media"])
+        if self.setting["members"]:
+            self.memberIds = MemberIds(self.writer, self.readers, **self.setting["members"])
+        if self.setting["msgStats"]:
+            self.msgStats = MsgStats(self.writer, **self.setting["msgStats"]).start()
+        if self.memberIds or self.msgStats:
+            self.writer.commitCallback = self.committed
+        if self.setting["retention"] and self.setting["retention"].get("tables"):
+            self.retention = Retention(self.writer, partitions=self.partitions, **self.setting["retention"]).start()
+        if self.setting["dedupe"]:
+            self.recentIds = RecentIds(self.setting["dedupe"].get("window", 86400),
+                                       self.setting["dedupe"].get("maxSize", 100000))
+            self.seed_recent_ids()
+        self.contactSync = ContactSync(self, self.writer, self.readers,
+                                       **{k: v for k, v in self.setting["contact"].items() if k != "warmStart"})
+        if self.contactCache:
+            refreshThread = threading.Thread(target=self.refresh_contacts, name='ContactRefresh')
+            refreshThread.setDaemon(True)
+            refreshThread.start()
+        else:
+            self.contactSync.schedule()
+
+    def history(self, name, chatType="FriendChat", before=None, since=None, until=None, limit=50):
+        """
+        Page through a conversation from the newest message backwards. Pages are addressed by
+        keyset instead of OFFSET so every page costs one index seek whatever its depth.
+        :param name: the chat as stored in the message table: RemarkName or NickName
+        :param chatType: FriendChat/GroupChat/MpChat
+        :param before: (CreateTime, MsgId) returned by the previous page
+        :param since: only messages with CreateTime >= since
+        :param until: only messages with CreateTime < until
+        :param limit: page size
+        :return: rows, (CreateTime, MsgId) for the next page or None at the end
+        """
+        table, column = HISTORY_TABLES[chatType]
+        return self.page(table, ["{} = ?".format(column)], [name], before, since, until, limit)
+
+    def member_history(self, name, chatRoom=None, before=None, since=None, until=None, limit=50):
+        """
+        Page through the messages of a group member across groups from the newest backwards,
+        addressed by keyset like history.
+        :param name: the member's name in the groups, as GroupMembers.Name
+        :param chatRoom: only in this group
+        :return: rows, (CreateTime, MsgId) for the next page or None at the end
+        """
+        members = {"Name": name}
+        if chatRoom is not None:
+            members["ChatRoom"] = chatRoom
+        _sql, args = self.sqlitehelper.select("GroupMembers", "MemberId", members)
+        return self.page("GroupMsgs", ["FromUser IN ({})".format(_sql)], args, before, since, until, limit)
+
+    def page(self, table, condition, args, before=None, since=None, until=None, limit=50):
+        """
+        The page of history and member_history: rows of table matching condition from the
+        newest backwards. Partitions are read window by window, newest first, until the page
+        is full, so a range may span more partitions than a connection can attach.
+        :return: rows, (CreateTime, MsgId) for the next page or None at the end
+        """
+        if before:
+            condition, args = condition + ["(CreateTime, MsgId) < (?, ?)"], list(args) + list(before)
+            if until is None or before[0] < until:
+                until = before[0] + 1
+        rows = []
+        for _since, _until, keys in self.windows(since, until):
+            _condition, _args = list(condition), list(args)
+            if _since is not None:
+                _condition.append("CreateTime >= ?")
+                _args.append(_since)
+            if _until is not None:
+                _condition.append("CreateTime < ?")
+                _args.append(_until)
+            with self.read(_since, _until, keys) as db:
+                rows.extend(db.execute(self.sqlitehelper.select(table, self.read_columns(table), ' AND '.join(_condition),
+                                                           limit=limit - len(rows),
+                                                           order=("CreateTime DESC", "MsgId DESC")),
+                                       _args).fetchall())
+            if len(rows) >= limit:
+                break
+        if len(rows) < limit:
+            return rows, None
+        return rows, (rows[-1]["CreateTime"], rows[-1]["MsgId"])
+
+    def search(self, query, chatType=None, name=None, since=None, until=None, limit=50):
+        """
+        Full-text search over message Content and Comments, needs setting["database"]["fts"].
+        :param query: FTS5 query like 'hello' or '"exact phrase"' or 'foo OR bar'
+        :param chatType: FriendChat/GroupChat/MpChat, default all of them
+        :param name: only the chat with this name
+        :param since: only messages with CreateTime >= since
+        :param until: only messages with CreateTime < until
+        :param limit: number of hits
+        :return: list of rows: ChatType, Chat, FromUser, CreateTime, MsgId, MsgType, Content, Snippet, Rank;
+                 Rank is the bm25 score of the hit in its own index (a table of main or of a partition).
+                 Scores of different indexes do not compare, so hits are ordered by their place in
+                 their index, then newest first: the best hit of every index comes before the second ones
+        """
+        if not self.setting["database"].get("fts"):
+            raise ValueError('search needs the full-text index, set setting["database"]["fts"] like '
+                             '{"tokenize": "trigram"}')
+        # trigram tokens are 3 characters, shorter terms (common in Chinese) fall back to a scan
+        scan = len(query) < 3 and self.setting["database"]["fts"].get("tokenize", "trigram") == "trigram"
+        hits = []  # (place in its index, -CreateTime, row)
+        for _since, _until, keys in self.windows(since, until):
+            schemas = ['main'] + ['p' + key for key in keys or ()]
+            with self.read(_since, _until, keys) as db:
+                for _chatType, schema in ((i, j) for i in ([chatType] if chatType else HISTORY_TABLES) for j in schemas):
+                    table, column = HISTORY_TABLES[_chatType]
+                    fts = table + 'Fts'
+                    if scan:
+                        condition, args = ["(unpack(m.Content) LIKE ? OR unpack(m.Comments) LIKE ?)"], \
+                                          ['%{}%'.format(query)] * 2
+                    else:
+                        condition, args = ["{} MATCH ?".format(fts)], [query]
+                    if name is not None:
+                        condition.append("m.{} = ?".format(column))
+                        args.append(name)
+                    if _since is not None:
+                        condition.append("m.CreateTime >= ?")
+                        args.append(_since)
+                    if _until is not None:
+                        condition.append("m.CreateTime < ?")
+                        args.append(_until)
+                    columns = ["'{}' AS ChatType".format(_chatType), "m.{} AS Chat".format(column), "m.FromUser",
+                               "m.CreateTime", "m.MsgId", "m.MsgType", "unpack(m.Content) AS Content"]
+                    if scan:
+                        _sql = self.sqlitehelper.select("{}.{} AS m".format(schema, table),
+                                                   columns + ["unpack(m.Content) AS Snippet", "0 AS Rank"],
+                                                   ' AND '.join(condition), limit=limit, order="m.CreateTime", desc=True)
+                    else:
+                        _sql = self.sqlitehelper.select(
+                            "{0}.{1} JOIN {0}.{2} AS m ON m.rowid = {1}.rowid".format(schema, fts, table),
+                            columns + ["snippet({}, -1, '[', ']', '...', 16) AS Snippet".format(fts), "rank AS Rank"],
+                            ' AND '.join(condition), limit=limit, order="rank")
+                    hits.extend((0 if scan else i, -row["CreateTime"], row)
+                                for i, row in enumerate(db.execute(_sql, args).fetchall()))
+        hits.sort(key=lambda hit: hit[:2])
+        return [hit[2] for hit in hits[:limit]]
+
+    def windows(self, since=None, until=None):
+        """
+        :return: list of (since, until, keys) covering [since, until) newest first, see
+                 partition.Partitions.windows; one window without partitions
+        """
+        if self.partitions:
+            return self.partitions.windows(since, until)
+        return [(since, until, None)]
+
+    def read(self, since=None, until=None, keys=None):
+        """
+        :return: context manager of a read-only connection; with partitions it sees the ones
+                 overlapping [since, until), or keys, through views named after the message tables
+        """
+        if self.partitions:
+            return self.partitions.connect(self.dbPath, since, until, self.setting["database"].get("profile"), keys)
+        return self.readers.connection()
+
+    def rebuild_fts(self):
+        """
+        Index the messages stored before the full-text index was enabled; runs on the writer.
+        """
+        return self.writer.submit(lambda db: [fts_rebuild(db, table) for table, _ in HISTORY_TABLES.values()])
+
+    def deliver(self, msg, toUserName):
+        """
+        Send a reply through sendQueue, or right away when it is off. A reply made after
+        exit_callback closed sendQueue is dropped rather than sent around its rate limit.
+        """
+        sendQueue = self.sendQueue
+        if sendQueue:
+            sendQueue.put(msg, toUserName)
+        elif self.exited and self.setting["send"].get("workers"):
+            logger.warning('Drop a reply to {}, the send queue is closed'.format(toUserName))
+        else:
+            self.send(msg, toUserName)
+
+    def send(self, msg, toUserName=None, mediaId=None):
+        if not self.metrics:
+            return super().send(msg, toUserName, mediaId)
+        start = time.perf_counter()
+        try:
+            return super().send(msg, toUserName, mediaId)
+        finally:
+            self.metrics.observe("send", time.perf_counter() - start)
+
+    def stats(self):
+        """
+        :return: dict of the pipeline metrics, empty unless setting["metrics"]["enabled"],
+                 and the counters of the reply pool, writer-side helpers and statement cache
+        """
+        stats = self.metrics.stats() if self.metrics else {}
+        for name, value in (("reply", self.replyPool and self.replyPool.info()),
+                            ("send", self.sendQueue and self.sendQueue.info()),
+                            ("deadLetters", self.deadLetters and self.deadLetters.metrics),
+                            ("media", self.mediaStore and self.mediaStore.metrics),
+                            ("contacts", self.contactSync and self.contactSync.metrics),
+                            ("contactCache", self.contactCache and self.contactCache.metrics),
+                            ("dedupe", self.recentIds and self.recentIds.info()),
+                            ("retention", self.retention and self.retention.metrics),
+                            ("msgStats", self.msgStats and self.msgStats.info()),
+                            ("members", self.memberIds and self.memberIds.info()),
+                            ("sqlCache", self.sqlitehelper.cache_info()),
+                            ("logging", self.logPipeline and self.logPipeline.info())):
+            if value:
+                stats[name] = dict(value)
+        return stats
+
+    def msg_stats(self, since=None, until=None, source=None, chat=None, groupBy=("Day", "Source", "Chat")):
+        """
+        Message counts from MsgStats, a few rows per day and chat whatever the number of messages.
+        :param since: count the whole local days from the one of this time
+        :param until: to the one of this time
+        :param source: message table(s) like "GroupMsgs" or ("FriendMsgs", "GroupMsgs")
+        :param chat: chat(s) as stored in the message table
+        :param groupBy: of Day, Source, Chat, Sender and MsgType
+        :return: list of dict of the groupBy columns and Count, by groupBy
+        """
+        groupBy = [groupBy] if isinstance(groupBy, str) else list(groupBy)
+        for column in groupBy:
+            if column not in GROUPS:
+                raise ValueError('Can not group by {}, only by {}'.format(column, GROUPS))
+        condition = {}
+        if since is not None or until is not None:
+            condition["Day"] = {}
+            if since is not None:
+                condition["Day"][">="] = day(since)
+            if until is not None:
+                condition["Day"]["<="] = day(until)
+        if source is not None:
+            condition["Source"] = source if isinstance(source, (list, tuple, set)) else [source]
+        if chat is not None:
+            condition["Chat"] = chat if isinstance(chat, (list, tuple, set)) else [chat]
+        if self.msgStats:
+            self.msgStats.flush()
+        rows = self.readers.fetchall(*self.sqlitehelper.select(
+            "MsgStats", groupBy + ["sum(Count) AS Count"], condition, order=groupBy, group=groupBy))
+        return [dict(row) for row in rows]
+
+    def export(self, output, **kwargs):
+        """
+        Stream the stored messages to a JSONL or CSV file, see export.export for the options.
+        :return: number of rows written
+        """
+        self.writer.flush()
+        return export(self.dbPath, output, **kwargs)
+
+    def save_error(self, sql, args, msg, exc, info=''):
+        """
+        Called when a save function or the write of its row fails; the message goes to DeadLetters.
+        A row that failed as its partition was sealed meanwhile is written again by reroute instead.
+        """
+        if self.partitions and sql and 'no such table: p' in str(exc) and \
+                threading.current_thread() is self.writer.thread:
+            # its partition was sealed after the row was routed to it
+            _sql = self.partitions.reroute(sql, (msg or {}).get('CreateTime'))
+            try:
+                self.writer.db.execute(_sql, args)
+                return
+            except Exception as e:
+                sql, exc, info = _sql, e, ''
+        info = info or ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+        logger.warning('{}{} {}'.format(info, sql or '', args or ''))
+        if self.deadLetters:
+            self.deadLetters.add(msg, exc, info, sql, args)
+        else:
+            self.errorMsgList.append((msg, info))
 
     def exit_callback(self):
-        now = round(time.time())
-        self.cursor.execute("UPDATE User SET LogoutTime = ? where userName = ?", (now, self.storageClass.userName))
-        self.cursor.execute(
-            sqlitehelper.select("User", "logoutTime - LoginTime", {"userName": self.storageClass.userName}))
-        _ = self.cursor.fetchone()[0]
-        self.db.commit()
-        self.db.close()
-        logger.info("Logout! Online in {} at this login periods".format(time_length(_)))
+        # itchat's logout and supervisor.Account.shutdown may both call this, from different threads
+        with self.exitLock:
+            if self.exited:
+                return
+            self.exited = True
+            self._exit()
+
+    def _exit(self):
+        # stop taking messages and let the handlers finish first, their saves and replies
+        # still need the writer and the send queue
+        self.alive = False
+        # itchat's msgList.put wraps what it gets in a Message, the sentinel must bypass it
+        Queue.Queue.put(self.msgList, None)
+        timeout = self.setting["reply"].get("closeTimeout", 10)
+        if self.replyDone is not None and threading.current_thread() is not self.replyThread:
+            if not self.replyDone.wait(timeout):
+                logger.warning('The reply loop did not stop within {} seconds'.format(timeout))
+        if self.replyPool:
+            self.replyPool.close(timeout)
+            self.replyPool = None
+        if self.metricsServer:
+            self.metricsServer.shutdown()
+            self.metricsServer = None
+        if self.sendQueue:
+            self.sendQueue.close(self.setting["send"].get("closeTimeout", 5))
+            self.sendQueue = None
+        if self.contactSync:
+            self.contactSync.cancel()
+        if self.mediaStore:
+            self.mediaStore.close()
+        if self.deadLetters:
+            self.deadLetters.stop()
+        if self.retention:
+            self.retention.stop()
+        if self.msgStats:
+            self.msgStats.stop()
+        if self.writer:
+            self.writer.close()
+        if self.readers:
+            self.readers.close()
+            self.readers = None
+        if self.db is not None:
+            now = round(time.time())
+            self.cursor.execute("UPDATE User SET LogoutTime = ? where userName = ?",
+                                (now, self.storageClass.userName))
+            self.cursor.execute(
+                *self.sqlitehelper.select("User", "logoutTime - LoginTime", {"userName": self.storageClass.userName}))
+            _ = self.cursor.fetchone()[0]
+            self.db.commit()
+            self.db.close()
+            self.db = self.cursor = None
+            logger.info("Logout! Online in {} at this login periods".format(time_length(_)))
+        if self.logPipeline:
+            self.logPipeline.stop()
+
+
+INSERT_MSG = "INSERT INTO {} VALUES (?, ?, ?, ?, ?, ?, ?)"
+INSERT_MSG_OR_IGNORE = "INSERT OR IGNORE INTO {} VALUES (?, ?, ?, ?, ?, ?, ?)"
+# tables stored in Bot.partitions when setting["database"]["partition"] is set
+PARTITIONED_TABLES = ("FriendMsgs", "GroupMsgs", "MpMsgs", "SystemMsgs")
+# messages whose media goes to Bot.mediaStore
+MEDIA_TYPES = (content.PICTURE, content.RECORDING, content.VIDEO, content.ATTACHMENT)
+
+# chat type: (message table, column holding the chat name)
+HISTORY_TABLES = {
+    "FriendChat": ("FriendMsgs", "User"),
+    "GroupChat": ("GroupMsgs", "ChatRoom"),
+    "MpChat": ("MpMsgs", "NickName"),
+}
+
+
+def _chat_kinds(isFriendChat, isGroupChat, isMpChat):
+    kinds = [kind for kind, flag in (("FriendChat", isFriendChat), ("GroupChat", isGroupChat),
+                                     ("MpChat", isMpChat)) if flag]
+    return kinds or ["FriendChat"]
+
+
+def _result(r):
+    """
+    Run a coroutine returned by an "async def" handler outside of the asyncio run mode.
+    """
+    return asyncio.run(r) if asyncio.iscoroutine(r) else r
 
 
 def time_length(length):
@@ -370,105 +1143,152 @@ def time_length(length):
     return ' '.join((str(round(length, 2)), "Hours"))
 
 
-def db_init(uin, db_dir='', table_info=None):
+TABLE_INFO = {
+    "User": {
+        "columns": ("UserName CHAR(65) NOT NULL",
+                    "NickName VARCHAR NOT NULL",
+                    "LoginTime INT(10) NOT NULL",
+                    "LogoutTime INT(10)"),
+        "unique": ("UserName", "LoginTime")
+    },
+    "Friends": {
+        "columns": ("UserId INT(4) NOT NULL",
+                    "NickName VARCHAR",
+                    "RemarkName VARCHAR",
+                    "Province CHAR(3)",
+                    "City CHAR(3)",
+                    "Sex INT(1)",
+                    "StarFriend INT(1)",
+                    "AttrStatus INT",
+                    "SnsFlag INT",
+                    "ContactFlag INT",
+                    "HeadImgUrl VARCHAR",
+                    "History VARCHAR"),  # 历史更改
+        "primary_key": "UserId"
+    },
+    "Groups": {
+        "columns": ("GroupId INT(4) NOT NULL",
+                    "EncryChatRoomId VARCHAR --stable across sessions, known once the members are fetched\n",
+                    "NickName VARCHAR",
+                    "IsOwner INT(1)",
+                    "ContactFlag INT",
+                    "MemberCount INT",
+                    "HeadImgUrl VARCHAR",
+                    "MemberList VARCHAR",
+                    "History VARCHAR"),
+        "primary_key": "GroupId",
+        "indexes": (("NickName",), ("EncryChatRoomId",))
+    },
+    "Mps": {
+        "columns": ("NickName VARCHAR",
+                    "Province CHAR(3)",
+                    "City CHAR(3)",
+                    "SnsFlag INT",
+                    "ContactFlag INT",
+                    "HeadImgUrl VARCHAR",
+                    "History VARCHAR"),
+        "primary_key": "NickName"
+    },
+    "FriendMsgs": {
+        "columns": ("MsgId NUMERIC NOT NULL",
+                    "CreateTime INT(10) NOT NULL",
+                    # "UserId INT(4) NOT NULL",
+                    "User VARCHAR",
+                    "FromUser INT(1) --0: Bot; 1: Self; 2: User\n",
+                    "MsgType INT(2)",
+                    "Content BLOG",
+                    "Comments TEXT"),
+        "primary_key": ("MsgId", "CreateTime"),
+        "indexes": (("User", "CreateTime", "MsgId"),)
+    },
+    "GroupMsgs": {
+        "columns": ("MsgId NUMERIC NOT NULL",
+                    "CreateTime INT(10) NOT NULL",
+                    "ChatRoom VARCHAR",
+                    "FromUser INT --GroupMembers.MemberId, str((UserName, NickName)) before it\n",
+                    "MsgType INT(2)",
+                    "Content BLOG",
+                    "Comments TEXT"),
+        "primary_key": ("MsgId", "CreateTime"),
+        "indexes": (("ChatRoom", "CreateTime", "MsgId"), ("FromUser", "CreateTime", "MsgId"))
+    },
+    "MpMsgs": {
+        "columns": ("MsgId NUMERIC NOT NULL",
+                    "CreateTime INT(10) NOT NULL",
+                    "NickName VARCHAR",
+                    "FromUser INT(1) --0: Bot; 1: Self;2: User\n",
+                    "MsgType INT(2)",
+                    "Content BLOG",
+                    "Comments TEXT"),
+        "primary_key": ("MsgId", "CreateTime"),
+        "indexes": (("NickName", "CreateTime", "MsgId"),)
+    },
+    "SystemMsgs": {
+        "columns": ("CreateTime INT(10) NOT NULL",
+                    "Type INT(1) NOT NULL--0:; 1:; 2:;\n",
+                    "Comments TEXT"),
+        "indexes": (("CreateTime",),)
+    },
+    "DeadLetters": {
+        "columns": ("Id INTEGER PRIMARY KEY",
+                    "FailTime INT(10) NOT NULL",
+                    "MsgId NUMERIC",
+                    "Sql VARCHAR --NULL: the save function failed, nothing to replay\n",
+                    "Args TEXT --json\n",
+                    "Message TEXT --json of the compact message\n",
+                    "ErrorClass VARCHAR",
+                    "Error TEXT",
+                    "Attempts INT NOT NULL DEFAULT 0",
+                    "NextTry INT(10)"),
+        "indexes": (("NextTry",),)
+    },
+    "GroupMembers": {
+        "columns": ("MemberId INTEGER PRIMARY KEY",
+                    "ChatRoom VARCHAR NOT NULL --as GroupMsgs.ChatRoom\n",
+                    "Name VARCHAR NOT NULL --actualNickName, the name in the group\n",
+                    "FirstSeen INT(10)"),
+        "indexes": ({"columns": ("ChatRoom", "Name"), "unique": True}, ("Name",))
+    },
+    "MsgStats": MSG_STATS_TABLE,
+    "MediaMsgs": {
+        "columns": ("Md5 CHAR(16)",
+                    "Type VARCHAR",
+                    "Content VARCHAR",
+                    "Comment VARCHAR",
+                    "FileName VARCHAR"),
+        "primary_key": (),
+        "indexes": ({"columns": ("Md5",), "unique": True},)
+    },
+}
+
+
+def db_init(uin, db_dir='', table_info=None, profile=None, fts=None):
     """
     :param uin: user's uin
     :param db_dir: the database dir
-    :param table_info: add table to initialize
+    :param table_info: add table to initialize;
+                       {"Table": {"columns": ..., "primary_key": ..., "unique": ...,
+                                  "indexes": (("Column1", "Column2"), {"columns": ..., "unique": True})}}
+    :param profile: pragmas like {"journal_mode": "WAL", "synchronous": "NORMAL"}, see dbhelper.apply_pragmas
+    :param fts: like {"tokenize": "trigram"} to keep a full-text index of the message tables
     :return: database connection
     """
-    table_info_default = {
-        "User": {
-            "columns": ("UserName CHAR(65) NOT NULL",
-                        "NickName VARCHAR NOT NULL",
-                        "LoginTime INT(10) NOT NULL",
-                        "LogoutTime INT(10)"),
-            "unique": ("UserName", "LoginTime")
-        },
-        "Friends": {
-            "columns": ("UserId INT(4) NOT NULL",
-                        "NickName VARCHAR",
-                        "RemarkName VARCHAR",
-                        "Province CHAR(3)",
-                        "City CHAR(3)",
-                        "Sex INT(1)",
-                        "StarFriend INT(1)",
-                        "AttrStatus INT",
-                        "SnsFlag INT",
-                        "ContactFlag INT",
-                        "HeadImgUrl VARCHAR",
-                        "History VARCHAR"),  # 历史更改
-            "primary_key": "UserId"
-        },
-        "Groups": {
-            "columns": ("NickName VARCHAR",
-                        "IsOwner INT(1)",
-                        "ContactFlag INT",
-                        "MemberCount INT",
-                        "HeadImgUrl VARCHAR",
-                        "MemberList VARCHAR",
-                        "History VARCHAR"),
-        },
-        "Mps": {
-            "columns": ("NickName VARCHAR",
-                        "Province CHAR(3)",
-                        "City CHAR(3)",
-                        "SnsFlag INT",
-                        "ContactFlag INT",
-                        "HeadImgUrl VARCHAR",
-                        "History VARCHAR"),
-            "primary_key": "NickName"
-        },
-        "FriendMsgs": {
-            "columns": ("MsgId NUMERIC NOT NULL",
-                        "CreateTime INT(10) NOT NULL",
-                        # "UserId INT(4) NOT NULL",
-                        "User VARCHAR",
-                        "FromUser INT(1) --0: Bot; 1: Self; 2: User\n",
-                        "MsgType INT(2)",
-                        "Content BLOG",
-                        "Comments TEXT"),
-            "primary_key": ("MsgId", "CreateTime")
-        },
-        "GroupMsgs": {
-            "columns": ("MsgId NUMERIC NOT NULL",
-                        "CreateTime INT(10) NOT NULL",
-                        "ChatRoom VARCHAR",
-                        "FromUser VARCHAR",
-                        "MsgType INT(2)",
-                        "Content BLOG",
-                        "Comments TEXT"),
-            "primary_key": ("MsgId", "CreateTime")
-        },
-        "MpMsgs": {
-            "columns": ("MsgId NUMERIC NOT NULL",
-                        "CreateTime INT(10) NOT NULL",
-                        "NickName VARCHAR",
-                        "FromUser INT(1) --0: Bot; 1: Self;2: User\n",
-                        "MsgType INT(2)",
-                        "Content BLOG",
-                        "Comments TEXT"),
-            "primary_key": ("MsgId", "CreateTime")
-        },
-        "SystemMsgs": {
-            "columns": ("CreateTime INT(10) NOT NULL",
-                        "Type INT(1) NOT NULL--0:; 1:; 2:;\n",
-                        "Comments TEXT"),
-        },
-        "MediaMsgs": {
-            "columns": ("Md5 CHAR(16)",
-                        "Type VARCHAR",
-                        "Content VARCHAR",
-                        "Comment VARCHAR",
-                        "FileName VARCHAR"),
-            "primary_key": ()
-        },
-    }
-    if table_info is not None:
-        table_info_default.update(table_info)
-    table_info = table_info_default
+    table_info = dict(TABLE_INFO, **(table_info or {}))
     db_name = str(uin) + '.db'
     db = sqlite3.connect(os.path.join(db_dir, db_name), check_same_thread=False)
+    register(db)
+    apply_pragmas(db, profile)
+    upgrade_groups(db)
+    cursor = create_tables(db, table_info, fts, db_name)
+    logger.info("Database initialise for user {} successfully".format(uin))
+    return db, cursor
+
+
+def create_tables(db, table_info, fts=None, db_name=''):
+    """
+    Create the missing tables and indexes of table_info, then the full-text index if fts.
+    :return: cursor
+    """
     cursor = db.execute(sqlitehelper.show_tables)
     tables = set()
     for _ in cursor:
@@ -485,9 +1305,18 @@ def db_init(uin, db_dir='', table_info=None):
                 )
             )
             logger.info("Create table {} in database {} successfully".format(table, db_name))
-    logger.info("Database initialise for user {} successfully".format(uin))
+        for index in info.get("indexes", ()):
+            if isinstance(index, dict):
+                cursor.execute(sqlitehelper.create_index(table, index["columns"], unique=index.get("unique")))
+            else:
+                cursor.execute(sqlitehelper.create_index(table, index))
+    if fts is not None:
+        for table, _ in HISTORY_TABLES.values():
+            if table in table_info and fts_init(db, table, tokenize=fts.get("tokenize", "trigram")):
+                logger.info("Indexing the existing messages of {}, this may take a while".format(table))
+                fts_rebuild(db, table)
     db.commit()
-    return db, cursor
+    return cursor
 
 
 if __name__ == '__main__':
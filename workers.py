@@ -0,0 +1,112 @@
+import threading
+from collections import deque
+from logging import getLogger
+logger = getLogger('itchat')
+
+POLICIES = ("block", "drop_new", "drop_old")
+
+
+class KeyedPool:
+    """
+    Fixed set of threads running tasks submitted under a key.
+    Tasks sharing a key run one at a time in submission order, tasks with different keys
+    run in parallel, so one slow conversation only delays itself.
+    """
+
+    def __init__(self, workers=4, queueSize=100, policy="block", name="Worker"):
+        """
+        :param workers: number of threads
+        :param queueSize: pending tasks allowed per key
+        :param policy: what submit does when a key's queue is full:
+                       block: wait for room, which slows down the producer
+                       drop_new: discard the submitted task
+                       drop_old: discard the oldest pending task of that key
+        :param name: prefix of the thread names
+        """
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of {}'.format(POLICIES))
+        self.queueSize = max(int(queueSize), 1)
+        self.policy = policy
+        self.pending = {}  # key: deque of (fn, args)
+        self.ready = deque()  # keys having pending tasks and no running task
+        self.scheduled = set()  # keys in ready or running
+        self.dropped = 0
+        self.alive = True
+        lock = threading.Lock()
+        self.work = threading.Condition(lock)
+        self.space = threading.Condition(lock)
+        self.threads = []
+        for i in range(max(int(workers), 1)):
+            thread = threading.Thread(target=self._loop, name='{}-{}'.format(name, i))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, fn, *args):
+        """
+        :return: False if the task was dropped
+        """
+        with self.work:
+            if not self.alive:
+                raise RuntimeError('KeyedPool is closed')
+            queue = self.pending.get(key)
+            if queue is None:
+                queue = self.pending[key] = deque()
+            if len(queue) >= self.queueSize:
+                if self.policy == "drop_new":
+                    self.dropped += 1
+                    return False
+                elif self.policy == "drop_old":
+                    queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(queue) >= self.queueSize and self.alive:
+                        self.space.wait()
+                    if not self.alive:  # closed while waiting, no worker would run the task
+                        raise RuntimeError('KeyedPool is closed')
+            queue.append((fn, args))
+            if key not in self.scheduled:
+                self.scheduled.add(key)
+                self.ready.append(key)
+                self.work.notify()
+        return True
+
+    def _loop(self):
+        while True:
+            with self.work:
+                while not self.ready:
+                    if not self.alive:
+                        return
+                    self.work.wait()
+                key = self.ready.popleft()
+                fn, args = self.pending[key].popleft()
+                self.space.notify_all()
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception('Task of {} failed'.format(key))
+            with self.work:
+                if self.pending[key]:
+                    self.ready.append(key)
+                    self.work.notify()
+                else:
+                    del self.pending[key]
+                    self.scheduled.discard(key)
+
+    def info(self):
+        with self.work:
+            return {"workers": len(self.threads),
+                    "pending": sum(len(i) for i in self.pending.values()),
+                    "conversations": len(self.pending),
+                    "dropped": self.dropped}
+
+    def close(self, timeout=None):
+        """
+        Stop accepting tasks, run what is pending and stop the threads.
+        """
+        with self.work:
+            self.alive = False
+            self.work.notify_all()
+            self.space.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)